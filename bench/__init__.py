@@ -0,0 +1,4 @@
+"""
+Нагрузочный бенчмарк SnapSell Bot: фейковые Telegram Bot API, Gemini
+и Pollinations на localhost и генератор нагрузки (python -m bench.run).
+"""
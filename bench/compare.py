@@ -0,0 +1,53 @@
+"""
+Сравнение двух результатов бенчмарка: python -m bench.compare base.json new.json [--threshold 10]
+Код выхода 1, если задержки/память выросли или пропускная способность упала больше порога (%).
+"""
+
+import argparse
+import json
+import sys
+
+
+def metrics(result: dict) -> dict:
+    """Плоский словарь: имя → (значение, больше — хуже)."""
+    out = {"throughput per_minute": (result["throughput"]["per_minute"], False)}
+    for stage, s in result["stages_s"].items():
+        for p in ("p50", "p95", "p99"):
+            if p in s:
+                out[f"{stage} {p}, s"] = (s[p], True)
+    lock = result["db_lock_wait_ms"]
+    for p in ("p99", "total"):
+        if p in lock:
+            out[f"db lock wait {p}, ms"] = (lock[p], True)
+    out["max rss, MB"] = (result["memory_mb"]["max_rss"], True)
+    return out
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare two SnapSell benchmark results")
+    parser.add_argument("base")
+    parser.add_argument("new")
+    parser.add_argument("--threshold", type=float, default=10.0, help="допустимое ухудшение, %%")
+    args = parser.parse_args()
+
+    with open(args.base, encoding="utf-8") as f:
+        base = json.load(f)
+    with open(args.new, encoding="utf-8") as f:
+        new = json.load(f)
+    print(f"base: {base['meta'].get('commit')}  new: {new['meta'].get('commit')}")
+
+    old_m, new_m = metrics(base), metrics(new)
+    regressions = 0
+    for name, (value, higher_is_worse) in new_m.items():
+        if name not in old_m:
+            continue
+        old = old_m[name][0]
+        delta = (value - old) / old * 100 if old else 0.0
+        worse = delta > args.threshold if higher_is_worse else -delta > args.threshold
+        regressions += worse
+        print(f"{name:<28}{old:>12}{value:>12}{delta:>+9.1f}%{'  ⚠' if worse else ''}")
+    sys.exit(1 if regressions else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,264 @@
+"""
+Фейковые апстримы для бенчмарка: Telegram Bot API, Gemini, Pollinations.
+Задержки и доля ошибок задаются распределениями; по запросам каждого
+пользователя трекер отмечает время этапов (скачивание, анализ, сцены, отправка).
+
+Пользователь узнаётся по маркеру: в байтах фото — BENCHUSER:<id>;,
+в ответе Gemini и, значит, в промтах сцен — benchuser<id>.
+"""
+
+import asyncio
+import base64
+import email
+import json
+import random
+import re
+import time
+import urllib.parse
+from collections import Counter
+from http import HTTPStatus
+
+from httpserver import Request, Response
+
+PHOTO_MARKER = re.compile(rb"BENCHUSER:(\d+);")
+PROMPT_MARKER = re.compile(r"benchuser(\d+)")
+FILE_ID = re.compile(r"bench-(\d+)-")
+INLINE_DATA = re.compile(rb'"data": "([A-Za-z0-9+/=]+)"')
+
+SCENE_KEYS = ("display", "lifestyle", "interior", "closeup")
+
+
+class Latency:
+    """
+    Распределение задержки в секундах из строки:
+    const:0.2 | uniform:0.5,2 | lognormal:1.5,0.4 (медиана, sigma).
+    """
+
+    def __init__(self, spec: str):
+        self.spec = spec
+        kind, _, params = spec.partition(":")
+        values = [float(v) for v in params.split(",") if v]
+        if kind == "const" and len(values) == 1:
+            self._sample = lambda: values[0]
+        elif kind == "uniform" and len(values) == 2:
+            self._sample = lambda: random.uniform(*values)
+        elif kind == "lognormal" and len(values) == 2:
+            median, sigma = values
+            self._sample = lambda: median * random.lognormvariate(0, sigma)
+        else:
+            raise ValueError(f"Bad latency spec: {spec!r}")
+
+    def sample(self) -> float:
+        return max(0.0, self._sample())
+
+    async def sleep(self):
+        await asyncio.sleep(self.sample())
+
+
+def fake_jpeg(size: int, marker: bytes = b"") -> bytes:
+    """JPEG-подобные байты нужного размера: бот их пересылает, но не декодирует."""
+    head = b"\xff\xd8\xff\xe0\x00\x10JFIF\x00\x01\x01\x00\x00\x01\x00\x01\x00\x00"
+    pad = max(0, size - len(head) - len(marker) - 2)
+    return head + marker + random.randbytes(pad) + b"\xff\xd9"
+
+
+class Tracker:
+    """Отметки этапов по пользователям; одна активная генерация на пользователя."""
+
+    def __init__(self):
+        self.runs: dict[int, dict] = {}
+        self.finished: list[dict] = []
+
+    def begin(self, uid: int) -> asyncio.Future:
+        run = {"uid": uid, "marks": {"begin": time.perf_counter()},
+               "future": asyncio.get_running_loop().create_future()}
+        self.runs[uid] = run
+        return run["future"]
+
+    def mark(self, uid: int | None, name: str, first: bool = True):
+        """first=True — запоминаем первое наступление, иначе — последнее."""
+        run = self.runs.get(uid)
+        if run is None:
+            return
+        if first and name in run["marks"]:
+            return
+        run["marks"][name] = time.perf_counter()
+
+    def finish(self, uid: int | None, outcome: str):
+        run = self.runs.pop(uid, None)
+        if run is None:
+            return
+        run["marks"]["done"] = time.perf_counter()
+        run["outcome"] = outcome
+        future = run.pop("future")
+        self.finished.append(run)
+        if not future.done():
+            future.set_result(outcome)
+
+
+def _form_params(req: Request) -> dict:
+    """Параметры вызова Bot API: urlencoded, multipart или JSON."""
+    ctype = req.headers.get("content-type", "")
+    if ctype.startswith("application/json"):
+        return json.loads(req.body or b"{}")
+    if ctype.startswith("multipart/form-data"):
+        msg = email.message_from_bytes(b"Content-Type: " + ctype.encode() + b"\r\n\r\n" + req.body)
+        params = {}
+        for part in msg.get_payload():
+            name = part.get_param("name", header="content-disposition")
+            if name and part.get_filename() is None:
+                params[name] = part.get_payload(decode=True).decode()
+        return params
+    return dict(urllib.parse.parse_qsl(req.body.decode()))
+
+
+class FakeTelegram:
+    def __init__(self, tracker: Tracker, latency: Latency, photo_bytes: int,
+                 is_success, is_failure):
+        self.tracker = tracker
+        self.latency = latency
+        self.photo_bytes = photo_bytes
+        self.is_success = is_success
+        self.is_failure = is_failure
+        self.calls = Counter()
+        self._message_id = 0
+
+    def _message(self, chat_id, **extra) -> dict:
+        self._message_id += 1
+        return {"message_id": self._message_id, "date": int(time.time()),
+                "chat": {"id": int(chat_id), "type": "private"}, **extra}
+
+    def _photo(self) -> list:
+        self._message_id += 1
+        file_id = f"sent-{self._message_id}"
+        return [{"file_id": file_id, "file_unique_id": file_id, "width": 1024, "height": 1024}]
+
+    async def handle(self, req: Request) -> Response:
+        if req.path.startswith("/file/bot"):
+            return await self._download(req)
+        method = req.path.rsplit("/", 1)[-1]
+        self.calls[method] += 1
+        params = _form_params(req)
+        chat_id = params.get("chat_id")
+        uid = int(chat_id) if chat_id else None
+
+        if method in ("sendPhoto", "sendMediaGroup"):
+            self.tracker.mark(uid, "upload_start")
+        await self.latency.sleep()
+
+        if method == "getMe":
+            result = {"id": 1, "is_bot": True, "first_name": "SnapSell Bench", "username": "snapsell_bench_bot"}
+        elif method in ("sendMessage", "editMessageText"):
+            text = params.get("text", "")
+            result = self._message(chat_id, text=text)
+            if self.is_success(text):
+                self.tracker.finish(uid, "ok")
+            elif self.is_failure(text):
+                self.tracker.finish(uid, "failed")
+        elif method == "getFile":
+            file_id = params["file_id"]
+            m = FILE_ID.match(file_id)
+            self.tracker.mark(int(m.group(1)) if m else None, "download_start")
+            result = {"file_id": file_id, "file_unique_id": file_id, "file_size": self.photo_bytes,
+                      "file_path": f"photos/{file_id}.jpg"}
+        elif method == "sendPhoto":
+            result = self._message(chat_id, photo=self._photo())
+        elif method == "sendMediaGroup":
+            count = len(json.loads(params.get("media", "[]")))
+            result = [self._message(chat_id, photo=self._photo()) for _ in range(count)]
+        else:
+            # sendChatAction, deleteMessage, answerCallbackQuery, setWebhook...
+            result = True
+        return Response(body=json.dumps({"ok": True, "result": result}).encode(),
+                        content_type="application/json")
+
+    async def _download(self, req: Request) -> Response:
+        self.calls["download"] += 1
+        m = FILE_ID.search(req.path)
+        uid = int(m.group(1)) if m else 0
+        await self.latency.sleep()
+        self.tracker.mark(uid, "download_end")
+        return Response(body=fake_jpeg(self.photo_bytes, b"BENCHUSER:%d;" % uid), content_type="image/jpeg")
+
+
+class FakeGemini:
+    """generateContent и streamGenerateContent (SSE, ответ порциями)."""
+
+    def __init__(self, tracker: Tracker, latency: Latency, error_rate: float, chunks: int = 4):
+        self.tracker = tracker
+        self.latency = latency
+        self.error_rate = error_rate
+        self.chunks = chunks
+        self.calls = Counter()
+
+    @staticmethod
+    def _analysis(uid: int, compact: bool) -> str:
+        info = {
+            "product_en": f"ceramic mug benchuser{uid}",
+            "product_ru": "керамическая кружка",
+            "category": "home_decor",
+            "colors": ["white", "blue"],
+            "style": "minimalist",
+            "material": "ceramic",
+            "features": "glossy glaze, round handle",
+        }
+        if not compact:
+            info["scenes"] = {
+                key: f"Professional commercial photography, ceramic mug benchuser{uid}, {key} scene, "
+                     f"photorealistic, 8K resolution, sharp focus, commercial product photography"
+                for key in SCENE_KEYS
+            }
+        return json.dumps(info, ensure_ascii=False)
+
+    async def handle(self, req: Request) -> Response:
+        stream = req.path.endswith(":streamGenerateContent")
+        m = INLINE_DATA.search(req.body)
+        marker = PHOTO_MARKER.search(base64.b64decode(m.group(1))) if m else None
+        uid = int(marker.group(1)) if marker else 0
+        self.calls["requests"] += 1
+        self.tracker.mark(uid, "analyze_start")
+
+        total = self.latency.sample()
+        if random.random() < self.error_rate:
+            self.calls["errors"] += 1
+            await asyncio.sleep(total / 2)
+            return Response(HTTPStatus.SERVICE_UNAVAILABLE, b'{"error": {"code": 503}}',
+                            content_type="application/json")
+
+        text = self._analysis(uid, compact=b'"responseSchema"' in req.body)
+        if not stream:
+            await asyncio.sleep(total)
+            self.tracker.mark(uid, "analyze_end")
+            body = {"candidates": [{"content": {"parts": [{"text": text}]}}]}
+            return Response(body=json.dumps(body).encode(), content_type="application/json")
+
+        async def events():
+            step = -(-len(text) // self.chunks)
+            for i in range(0, len(text), step):
+                await asyncio.sleep(total / self.chunks)
+                event = {"candidates": [{"content": {"parts": [{"text": text[i:i + step]}]}}]}
+                yield b"data: " + json.dumps(event).encode() + b"\r\n\r\n"
+            self.tracker.mark(uid, "analyze_end")
+
+        return Response(stream=events(), content_type="text/event-stream")
+
+
+class FakePollinations:
+    def __init__(self, tracker: Tracker, latency: Latency, error_rate: float, image_bytes: int):
+        self.tracker = tracker
+        self.latency = latency
+        self.error_rate = error_rate
+        self.image_bytes = image_bytes
+        self.calls = Counter()
+
+    async def handle(self, req: Request) -> Response:
+        m = PROMPT_MARKER.search(urllib.parse.unquote(req.path))
+        uid = int(m.group(1)) if m else None
+        self.calls["requests"] += 1
+        self.tracker.mark(uid, "render_start")
+        await self.latency.sleep()
+        if random.random() < self.error_rate:
+            self.calls["errors"] += 1
+            return Response(random.choice((HTTPStatus.TOO_MANY_REQUESTS, HTTPStatus.BAD_GATEWAY)))
+        self.tracker.mark(uid, "render_end", first=False)
+        return Response(body=fake_jpeg(self.image_bytes), content_type="image/jpeg")
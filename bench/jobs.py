@@ -0,0 +1,150 @@
+"""
+Проверка учёта генераций в режиме JOB_QUEUE (worker.py) на фейковых апстримах.
+
+Сценарии:
+  * задача доставлена — списана ровно одна генерация, статус done,
+    а к сообщению с кнопками (ref) строка generations уже видна другому процессу;
+  * задачу трижды прерывают (потеря аренды, остановка воркера) и её
+    добивает reap() — генерация возвращена ровно один раз.
+
+Запуск из корня репозитория (код выхода 1 — расхождение в балансе):
+    python -m bench.jobs
+"""
+
+import asyncio
+import os
+import sqlite3
+import sys
+import tempfile
+
+from bench.fakes import FakeGemini, FakePollinations, FakeTelegram, Latency, Tracker
+from bench.run import start_fake
+
+USER_ID = 1001
+PAID = 4
+LEASE = 0.6
+RENDER_S = 1.0  # дольше аренды: задача гарантированно живёт несколько heartbeat'ов
+
+
+async def wait_claim(db, worker: str) -> dict | None:
+    """Следующая попытка: ждём, пока истечёт аренда предыдущей."""
+    for _ in range(50):
+        row = await db.claim_job(worker, LEASE, 3)
+        if row is not None:
+            return row
+        await asyncio.sleep(0.1)
+    return None
+
+
+async def check() -> list[str]:
+    workdir = tempfile.mkdtemp(prefix="snapsell-jobs-")
+    db_path = os.path.join(workdir, "jobs.db")
+    visible = []  # сколько генераций с ref видно в момент каждого сообщения об успехе
+
+    def on_message(text: str) -> bool:
+        if "Готово!" in text:
+            # Отдельное соединение — как у процесса бота, которому не виден буфер воркера
+            with sqlite3.connect(db_path) as other:
+                visible.append(other.execute("SELECT COUNT(*) FROM generations WHERE ref IS NOT NULL").fetchone()[0])
+        return False
+
+    tracker = Tracker()
+    telegram = FakeTelegram(tracker, Latency("const:0.01"), 50_000,
+                            is_success=on_message, is_failure=lambda text: False)
+    gemini = FakeGemini(tracker, Latency("const:0.05"), 0.0)
+    pollinations = FakePollinations(tracker, Latency(f"const:{RENDER_S}"), 0.0, 50_000)
+    servers = []
+    urls = []
+    for fake in (telegram, gemini, pollinations):
+        server, url = await start_fake(fake.handle)
+        servers.append(server)
+        urls.append(url)
+
+    os.environ.update({
+        "BOT_TOKEN": "123456:BENCH",
+        "GEMINI_API_KEY": "bench",
+        "TELEGRAM_BASE_URL": f"{urls[0]}/bot",
+        "TELEGRAM_FILE_URL": f"{urls[0]}/file/bot",
+        "GEMINI_BASE_URL": urls[1],
+        "POLLINATIONS_BASE_URL": urls[2],
+        "DB_PATH": db_path,
+        "RENDER_CACHE_DIR": os.path.join(workdir, "render_cache"),
+        "JOB_QUEUE": "1",
+        "JOB_LEASE": str(LEASE),
+        "JOB_MAX_ATTEMPTS": "3",
+        "TELEGRAM_RATE_LIMIT": "0",
+        "DB_FLUSH_INTERVAL": "60",  # буфер записи не сбрасывается сам за время проверки
+    })
+
+    import bot as snapsell
+    import worker
+    from telegram.ext import ExtBot
+
+    db = snapsell.db
+    tg = ExtBot("123456:BENCH", base_url=f"{urls[0]}/bot", base_file_url=f"{urls[0]}/file/bot")
+    await tg.initialize()
+    await snapsell.http.start()
+    errors = []
+
+    async def paid_left() -> int:
+        return (await db.get_account(USER_ID)).paid_left
+
+    async def enqueue(n: int) -> int:
+        reservation = await db.reserve_generation(USER_ID)
+        # Своё фото на задачу (маркер в file_id) — анализ и сцены не берутся из кэша
+        return await db.enqueue_job(USER_ID, USER_ID, n, 10_000 + n, f"bench-{USER_ID + n}-{n}",
+                                    f"jobs{n}", reservation.charged)
+
+    try:
+        await db.ensure_user(USER_ID, "bench", "bench")
+        await db.set_plan(USER_ID, "basic", generations=PAID)
+
+        # ── Доставка ──
+        job_id = await enqueue(1)
+        row = await wait_claim(db, "w1")
+        await worker.run_with_lease(tg, "w1", row)
+        status = db.sync._read().execute("SELECT status FROM jobs WHERE id = ?", (job_id,)).fetchone()[0]
+        if status != "done" or await paid_left() != PAID - 1:
+            errors.append(f"delivered job: status {status}, paid_left {await paid_left()} (want done, {PAID - 1})")
+        if visible != [1]:
+            errors.append(f"delivered job: generations with ref visible at success message {visible} (want [1])")
+
+        # ── Прерывания и reap ──
+        before = await paid_left()
+        job_id = await enqueue(2)
+        for attempt in range(3):
+            row = await wait_claim(db, "w1")
+            if row is None:
+                errors.append(f"attempt {attempt + 1}: job was not reclaimed")
+                break
+            task = asyncio.create_task(worker.run_with_lease(tg, "w1", row))
+            await asyncio.sleep(LEASE / 2)
+            if attempt == 1:
+                task.cancel()  # остановка воркера
+            else:
+                with db.sync._write() as conn:  # аренду перехватил другой воркер
+                    conn.execute("UPDATE jobs SET worker = 'thief' WHERE id = ?", (job_id,))
+            await asyncio.gather(task, return_exceptions=True)
+        await asyncio.sleep(LEASE + 0.1)
+        await worker.reap(tg)
+        if await paid_left() != before:
+            errors.append(f"cancelled x3 + reap: paid_left {await paid_left()} (want {before})")
+    finally:
+        await snapsell.http.close()
+        await tg.shutdown()
+        db.close()
+        for server in servers:
+            server.close()
+    return errors
+
+
+def main():
+    errors = asyncio.run(check())
+    for error in errors:
+        print(f"FAIL {error}")
+    print("OK" if not errors else f"{len(errors)} failed")
+    sys.exit(1 if errors else 0)
+
+
+if __name__ == "__main__":
+    main()
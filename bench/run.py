@@ -0,0 +1,266 @@
+"""
+Нагрузочный прогон конвейера handle_photo без реальных Telegram, Gemini и Pollinations.
+
+Фейковые апстримы поднимаются на localhost, бот работает в этом же процессе
+(Application без updater), N пользователей параллельно присылают фото.
+Отчёт: пропускная способность, p50/p95/p99 по этапам, ожидание блокировки
+записи SQLite, пик памяти. Результат — JSON в bench/results/ для сравнения
+между коммитами (python -m bench.compare old.json new.json).
+
+Запуск из корня репозитория:
+    python -m bench.run --users 50 --photos 2 \\
+        --gemini-latency lognormal:2,0.3 --pollinations-latency lognormal:6,0.5 \\
+        --pollinations-error-rate 0.05 --env GENERATION_WORKERS=16
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import platform
+import resource
+import subprocess
+import tempfile
+import threading
+import time
+from datetime import datetime
+from pathlib import Path
+
+from bench.fakes import FakeGemini, FakePollinations, FakeTelegram, Latency, Tracker
+from httpserver import serve
+
+ROOT = Path(__file__).resolve().parent.parent
+RESULTS_DIR = Path(__file__).resolve().parent / "results"
+
+# Этап → (начальная отметка, конечная отметка)
+STAGES = {
+    "queue":    ("begin", "download_start"),   # резерв, статус, очередь планировщика
+    "download": ("download_start", "download_end"),
+    "analyze":  ("analyze_start", "analyze_end"),
+    "render":   ("render_start", "render_end"),
+    "deliver":  ("upload_start", "done"),
+    "total":    ("begin", "done"),
+}
+
+
+class TimedLock:
+    """Обёртка над threading.Lock: копит время ожидания захвата."""
+
+    def __init__(self, lock: threading.Lock):
+        self._lock = lock
+        self.waits: list[float] = []
+
+    def acquire(self, *args, **kwargs):
+        start = time.perf_counter()
+        acquired = self._lock.acquire(*args, **kwargs)
+        self.waits.append(time.perf_counter() - start)
+        return acquired
+
+    def release(self):
+        self._lock.release()
+
+    def __enter__(self):
+        return self.acquire()
+
+    def __exit__(self, *exc):
+        self.release()
+
+
+def percentiles(values: list[float], scale: float = 1.0) -> dict:
+    if not values:
+        return {"count": 0}
+    values = sorted(values)
+
+    def rank(p: float) -> float:
+        return round(values[min(len(values) - 1, int(p / 100 * len(values)))] * scale, 3)
+
+    return {
+        "count": len(values),
+        "mean":  round(sum(values) / len(values) * scale, 3),
+        "p50":   rank(50),
+        "p95":   rank(95),
+        "p99":   rank(99),
+        "max":   round(values[-1] * scale, 3),
+    }
+
+
+def git_revision() -> dict:
+    def git(*args) -> str:
+        return subprocess.run(["git", *args], cwd=ROOT, capture_output=True, text=True).stdout.strip()
+    try:
+        return {"commit": git("rev-parse", "--short", "HEAD"), "dirty": bool(git("status", "--porcelain", "-uno"))}
+    except OSError:
+        return {"commit": None, "dirty": None}
+
+
+def photo_update(update_id: int, uid: int, n: int, photo_bytes: int) -> dict:
+    file_id = f"bench-{uid}-{n}"
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": {"id": uid, "type": "private"},
+            "from": {"id": uid, "is_bot": False, "first_name": f"user{uid}"},
+            "photo": [{"file_id": file_id, "file_unique_id": f"u{uid}n{n}",
+                       "width": 1024, "height": 1024, "file_size": photo_bytes}],
+        },
+    }
+
+
+async def start_fake(handler) -> tuple:
+    server = await serve(handler, "127.0.0.1", 0)
+    return server, f"http://127.0.0.1:{server.sockets[0].getsockname()[1]}"
+
+
+async def bench(args) -> dict:
+    tracker = Tracker()
+    holder = {}
+    telegram = FakeTelegram(
+        tracker, Latency(args.telegram_latency), args.photo_kb * 1024,
+        is_success=lambda text: text.startswith(holder["bot"].SUCCESS),
+        is_failure=lambda text: text.startswith("❌") or text.startswith(holder["bot"].PAYWALL),
+    )
+    gemini = FakeGemini(tracker, Latency(args.gemini_latency), args.gemini_error_rate)
+    pollinations = FakePollinations(
+        tracker, Latency(args.pollinations_latency), args.pollinations_error_rate, args.scene_kb * 1024
+    )
+    tg_server, tg_url = await start_fake(telegram.handle)
+    gm_server, gm_url = await start_fake(gemini.handle)
+    pl_server, pl_url = await start_fake(pollinations.handle)
+
+    # Конфиг читается при импорте — окружение задаём до import bot
+    workdir = tempfile.mkdtemp(prefix="snapsell-bench-")
+    env = {
+        "BOT_TOKEN": "123456:BENCH",
+        "GEMINI_API_KEY": "bench",
+        "TELEGRAM_BASE_URL": f"{tg_url}/bot",
+        "TELEGRAM_FILE_URL": f"{tg_url}/file/bot",
+        "GEMINI_BASE_URL": gm_url,
+        "POLLINATIONS_BASE_URL": pl_url,
+        "DB_PATH": os.path.join(workdir, "bench.db"),
+        "RENDER_CACHE_DIR": os.path.join(workdir, "render_cache"),
+        "FREE_GENERATIONS": str(args.photos + 1),
+        "JOB_QUEUE": "0",
+    }
+    env.update(dict(kv.split("=", 1) for kv in args.env))
+    os.environ.update(env)
+
+    import bot as snapsell
+    from telegram import Update
+    holder["bot"] = snapsell
+    lock = TimedLock(snapsell.db.sync._lock)
+    snapsell.db.sync._lock = lock
+
+    app = snapsell.build_application(updater=False)
+    await app.initialize()
+    await app.post_init(app)
+    await app.start()
+
+    update_ids = iter(range(1, 10 ** 9))
+
+    async def user(uid: int):
+        await asyncio.sleep(args.ramp * (uid - 1) / max(1, args.users))
+        for n in range(args.photos):
+            done = tracker.begin(uid)
+            update = photo_update(next(update_ids), uid, n, args.photo_kb * 1024)
+            await app.update_queue.put(Update.de_json(update, app.bot))
+            try:
+                await asyncio.wait_for(done, timeout=args.timeout)
+            except asyncio.TimeoutError:
+                tracker.finish(uid, "timeout")
+
+    started = time.perf_counter()
+    await asyncio.gather(*(user(uid) for uid in range(1, args.users + 1)))
+    elapsed = time.perf_counter() - started
+
+    await app.stop()
+    await app.post_shutdown(app)
+    await app.shutdown()
+    for server in (tg_server, gm_server, pl_server):
+        server.close()
+
+    runs = tracker.finished
+    outcomes = {o: sum(1 for r in runs if r["outcome"] == o) for o in ("ok", "failed", "timeout")}
+    stages = {}
+    for stage, (start, end) in STAGES.items():
+        stages[stage] = percentiles([
+            r["marks"][end] - r["marks"][start] for r in runs
+            if r["outcome"] == "ok" and start in r["marks"] and end in r["marks"]
+        ])
+    self_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children_rss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+
+    return {
+        "meta": {
+            "timestamp": datetime.now().isoformat(timespec="seconds"),
+            **git_revision(),
+            "python": platform.python_version(),
+            "args": vars(args),
+            "env": {k: v for k, v in env.items() if k not in ("BOT_TOKEN", "GEMINI_API_KEY", "DB_PATH", "RENDER_CACHE_DIR")},
+        },
+        "throughput": {
+            "generations": outcomes["ok"],
+            "failed": outcomes["failed"],
+            "timeouts": outcomes["timeout"],
+            "elapsed_s": round(elapsed, 3),
+            "per_minute": round(outcomes["ok"] / elapsed * 60, 2) if elapsed else 0,
+        },
+        "stages_s": stages,
+        "db_lock_wait_ms": {**percentiles(lock.waits, scale=1000), "total": round(sum(lock.waits) * 1000, 1)},
+        # ru_maxrss в Linux — килобайты
+        "memory_mb": {"max_rss": round(self_rss / 1024, 1), "children_max_rss": round(children_rss / 1024, 1)},
+        "upstream_calls": {
+            "telegram": dict(telegram.calls),
+            "gemini": dict(gemini.calls),
+            "pollinations": dict(pollinations.calls),
+        },
+    }
+
+
+def print_report(result: dict):
+    t = result["throughput"]
+    print(f"\nГенераций: {t['generations']} ok, {t['failed']} failed, {t['timeouts']} timeout "
+          f"за {t['elapsed_s']} с — {t['per_minute']}/мин")
+    print(f"{'этап':<10}{'n':>6}{'p50':>9}{'p95':>9}{'p99':>9}{'max':>9}")
+    for stage, s in result["stages_s"].items():
+        if s["count"]:
+            print(f"{stage:<10}{s['count']:>6}{s['p50']:>9}{s['p95']:>9}{s['p99']:>9}{s['max']:>9}")
+    lock = result["db_lock_wait_ms"]
+    if lock["count"]:
+        print(f"DB lock wait, мс: p50 {lock['p50']}, p99 {lock['p99']}, max {lock['max']}, всего {lock['total']}")
+    mem = result["memory_mb"]
+    print(f"Пик памяти, МБ: {mem['max_rss']} (дочерние процессы: {mem['children_max_rss']})")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="SnapSell load benchmark")
+    parser.add_argument("--users", type=int, default=20, help="одновременных пользователей")
+    parser.add_argument("--photos", type=int, default=1, help="фото от каждого (последовательно)")
+    parser.add_argument("--ramp", type=float, default=0.0, help="секунд на запуск всех пользователей")
+    parser.add_argument("--timeout", type=float, default=300.0, help="лимит на одну генерацию, с")
+    parser.add_argument("--telegram-latency", default="const:0.05")
+    parser.add_argument("--gemini-latency", default="lognormal:2,0.3")
+    parser.add_argument("--gemini-error-rate", type=float, default=0.0)
+    parser.add_argument("--pollinations-latency", default="lognormal:5,0.4")
+    parser.add_argument("--pollinations-error-rate", type=float, default=0.0)
+    parser.add_argument("--photo-kb", type=int, default=150, help="размер входного фото")
+    parser.add_argument("--scene-kb", type=int, default=200, help="размер сгенерированной сцены")
+    parser.add_argument("--env", action="append", default=[], metavar="KEY=VALUE",
+                        help="переопределение настроек бота, можно несколько раз")
+    parser.add_argument("--out", help="файл результата (по умолчанию bench/results/<время>-<коммит>.json)")
+    args = parser.parse_args()
+
+    result = asyncio.run(bench(args))
+    print_report(result)
+
+    out = Path(args.out) if args.out else RESULTS_DIR / (
+        f"{datetime.now():%Y%m%d-%H%M%S}-{result['meta']['commit'] or 'nogit'}.json"
+    )
+    out.parent.mkdir(parents=True, exist_ok=True)
+    out.write_text(json.dumps(result, ensure_ascii=False, indent=2), encoding="utf-8")
+    print(f"Результат: {out}")
+
+
+if __name__ == "__main__":
+    main()
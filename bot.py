@@ -7,12 +7,18 @@ import asyncio
 import logging
 import os
 import base64
+import functools
+import hashlib
 import json
 import re
+import secrets
 import httpx
+from concurrent.futures import ProcessPoolExecutor
 from io import BytesIO
+from dataclasses import dataclass
 from datetime import datetime
 from pathlib import Path
+from typing import Callable
 
 # ── Загружаем .env автоматически (без лишних библиотек) ──
 _env = Path(__file__).parent / ".env"
@@ -25,7 +31,7 @@ if _env.exists():
 
 from telegram import (
     Update, InlineKeyboardMarkup, InlineKeyboardButton,
-    LabeledPrice, InputMediaPhoto
+    LabeledPrice, InputMediaPhoto, InputMediaDocument
 )
 from telegram.ext import (
     Application, CommandHandler, MessageHandler, CallbackQueryHandler,
@@ -33,8 +39,18 @@ from telegram.ext import (
 )
 from telegram.constants import ParseMode, ChatAction
 
-from db import Database
+from db import Database, AsyncDatabase, Reservation
 from config import config
+from http_clients import HttpClients
+from render_cache import RenderCache, render_key
+from scheduler import GenerationScheduler, SingleFlight, PLAN_PRIORITY
+from imaging import pick_photo_size, prepare_for_analysis
+from postprocess import PRESETS, render_preset, file_name
+from gemini_stream import SceneStreamParser
+from scene_prompts import CATEGORIES, template_scene_prompt
+from rendering import AIMDLimiter, RenderEngine
+from ratelimit import TelegramRateLimiter
+import metrics
 
 logging.basicConfig(
     format="%(asctime)s | %(levelname)s | %(name)s | %(message)s",
@@ -42,7 +58,47 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-db = Database()
+db = AsyncDatabase(
+    Database(
+        config.DB_PATH, config.USER_CACHE_SIZE, config.USER_CACHE_TTL,
+        analysis_cache_bytes=config.ANALYSIS_CACHE_MB * 1024 * 1024,
+        flush_interval=config.DB_FLUSH_INTERVAL,
+        flush_size=config.DB_FLUSH_SIZE,
+    ),
+    max_workers=config.DB_THREADS,
+    on_call=lambda method, seconds: metrics.DB_CALL_SECONDS.labels(method).observe(seconds),
+)
+http = HttpClients()
+renders = RenderCache(
+    db, config.RENDER_CACHE_DIR,
+    disk_bytes=config.RENDER_CACHE_DISK_MB * 1024 * 1024,
+    max_entries=config.RENDER_CACHE_ENTRIES,
+)
+# Процессы для CPU-тяжёлой работы с изображениями (создаются при первой задаче)
+image_pool = ProcessPoolExecutor(max_workers=config.IMAGE_WORKERS)
+scheduler = GenerationScheduler(config.GENERATION_WORKERS, per_user=config.GENERATION_PER_USER)
+# (user_id, file_unique_id) → ref генерации (None — не удалась); повторы фото ждут первый запуск
+inflight = SingleFlight()
+
+metrics.GaugeFunc("snapsell_generations_in_flight", "Generations being processed", lambda: {(): scheduler.active})
+metrics.GaugeFunc("snapsell_generations_queued", "Generations waiting for a worker", lambda: {(): scheduler.queued})
+metrics.GaugeFunc(
+    "snapsell_cache_lookups_total", "Analysis and render cache lookups",
+    lambda: {
+        (cache, result): db.sync.cache_counters[f"{cache}_{result}"]
+        for cache in ("analysis", "render") for result in ("hits", "misses")
+    },
+    labels=("cache", "result"), kind="counter",
+)
+
+# Глубина очереди worker.py — в /metrics и в /admin. Считает watch_jobs() в фоне:
+# рендер метрик идёт в event loop и не должен ждать SQLite
+job_counts = {"queued": 0, "running": 0}
+if config.JOB_QUEUE:
+    metrics.GaugeFunc(
+        "snapsell_jobs", "Generation jobs in the worker queue by status",
+        lambda: {(status,): n for status, n in job_counts.items()}, labels=("status",),
+    )
 
 # ─────────────────────────────────────────────
 # ТЕКСТЫ
@@ -75,6 +131,19 @@ SEND_PHOTO_PROMPT = """
 ANALYZING = "🔍 *Шаг 1/3* — Анализирую товар..."
 PROMPTING  = "✍️ *Шаг 2/3* — Создаю сцены для фото..."
 RENDERING  = "🎨 *Шаг 3/3* — Генерирую изображения..."
+PROGRESS   = "🎨 *Шаг 3/3* — {done}/{total} готово..."
+JOB_QUEUED = "⏳ *В очереди* — начнём через несколько секунд..."
+QUEUED     = "⏳ *В очереди* — ваше место: *{pos}*\nНачнём, как только освободится генератор."
+REGEN_UNAVAILABLE = (
+    "⚠️ Перегенерация недоступна: лимит — {limit} на одну генерацию, "
+    "а для старых генераций анализ товара не сохранился. Пришлите фото заново."
+)
+DUPLICATE        = "⏳ Это фото уже генерируется — сцены придут ответом на первое сообщение."
+DUPLICATE_DONE   = "✅ Готово — сцены выше, ответом на первое фото. Повторно генерация не списана."
+DUPLICATE_FAILED = "❌ Генерация этого фото не удалась, попытка не списана. Пришлите фото ещё раз."
+ALBUM_STARTED  = "📦 *Альбом: {total} товаров* — генерирую по {concurrency} одновременно..."
+ALBUM_PROGRESS = "📦 *Альбом* — {done}/{total} готово..."
+ALBUM_QUEUED   = "⏳ *Альбом в очереди* — ваше место: *{pos}*"
 
 PAYWALL = """
 ⭐ *Бесплатные попытки закончились*
@@ -93,35 +162,62 @@ SUCCESS = """
 SCENES = [
     {
         "emoji": "🏪",
+        "key": "display",
         "name": "Витрина",
         "prompt_desc": "elegant product display on a premium marble table or illuminated store shelf, professional studio lighting with soft shadows, clean minimal background, high-end retail photography"
     },
     {
         "emoji": "🧍",
+        "key": "lifestyle",
         "name": "Лайфстайл",
         "prompt_desc": "lifestyle photography with a person naturally using or wearing the product, warm natural light, blurred modern interior background, authentic candid moment, editorial style"
     },
     {
         "emoji": "🏠",
+        "key": "interior",
         "name": "Интерьер",
         "prompt_desc": "product beautifully arranged in a cozy Scandinavian home interior, morning window light, minimalist decor, atmospheric depth of field, hygge aesthetic"
     },
     {
         "emoji": "🔍",
+        "key": "closeup",
         "name": "Крупный план",
         "prompt_desc": "extreme close-up macro photography of the product, dramatic side lighting highlighting texture and material, ultra-sharp details, dark luxury background, premium hero shot"
     }
 ]
 
+SCENE_INDEX = {scene["key"]: i for i, scene in enumerate(SCENES)}
+
+
+@dataclass
+class GenerationJob:
+    """Одна генерация: чей запрос, куда отвечать и что уже известно о товаре."""
+    user_id:      int
+    chat_id:      int
+    message_id:   int            # сообщение с фото — на него отвечаем
+    file_id:      str
+    file_key:     str            # ключ кэша анализа по file_unique_id
+    reservation:  Reservation
+    is_document:  bool = False   # оригинал файлом — всегда уменьшаем перед анализом
+    product_info: dict | None = None
+    ref:          str = ""       # ссылка на генерацию для кнопок; пусто — создаётся при запуске
+    notify:       bool = True    # False — без итогового сообщения (товар альбома)
+    # Товар альбома: сцены отправляются только после предыдущего товара
+    deliver_after: asyncio.Future | None = None
+    # False — задача worker.py: отменённую доделает другой воркер, возврат только при окончательной неудаче
+    refund_on_cancel: bool = True
+    # True — кнопки под результатом обработает другой процесс (бот): журнал пишется сразу
+    durable:      bool = False
+
+
+# Версия формата анализа — входит в ключ кэша, при смене промта кэш не смешивается
+ANALYSIS_VERSION = "v1" if config.ANALYSIS_MODE == "full" else "v1c"
+
 # ─────────────────────────────────────────────
 # ВСПОМОГАТЕЛЬНЫЕ ФУНКЦИИ
 # ─────────────────────────────────────────────
 
-async def analyze_product_with_gemini(image_bytes: bytes, mime_type: str = "image/jpeg") -> dict:
-    """Используем Google Gemini для анализа товара и генерации промтов."""
-    b64 = base64.standard_b64encode(image_bytes).decode("utf-8")
-
-    PROMPT = """You are a professional commercial photographer and product marketing expert.
+FULL_PROMPT = """You are a professional commercial photographer and product marketing expert.
 
 Analyze this product image carefully and return ONLY a valid JSON object (no markdown, no explanation):
 
@@ -148,6 +244,63 @@ Each scene prompt MUST:
 - End with: "photorealistic, 8K resolution, sharp focus, commercial product photography"
 """
 
+COMPACT_PROMPT = """You are a product marketing expert.
+Analyze the product in this image and describe it with the JSON fields of the response schema.
+product_en: concise English product name (e.g. 'ceramic coffee mug'); product_ru: the same in Russian;
+colors: 1-2 main colors; style: one word; material: main material or empty string;
+features: 2-3 key visual characteristics, comma separated.
+"""
+
+COMPACT_SCHEMA = {
+    "type": "OBJECT",
+    "properties": {
+        "product_en": {"type": "STRING"},
+        "product_ru": {"type": "STRING"},
+        "category":   {"type": "STRING", "enum": CATEGORIES},
+        "colors":     {"type": "ARRAY", "items": {"type": "STRING"}},
+        "style":      {"type": "STRING", "enum": [
+            "modern", "vintage", "luxury", "casual", "minimalist", "bohemian", "sporty", "classic",
+        ]},
+        "material":   {"type": "STRING"},
+        "features":   {"type": "STRING"},
+    },
+    "required": ["product_en", "product_ru", "category", "colors", "style", "material", "features"],
+}
+
+IMAGE_PLACEHOLDER = "\x00image\x00"
+
+
+def build_json_body(payload: dict, image: bytes | memoryview) -> bytes:
+    """
+    JSON-тело запроса с картинкой в base64. Картинка не проходит через
+    json.dumps и str: base64 кодируется один раз и вклеивается вместо плейсхолдера.
+    """
+    head, tail = json.dumps(payload).encode("ascii").split(json.dumps(IMAGE_PLACEHOLDER).encode("ascii"))
+    return b"".join((head, b'"', base64.standard_b64encode(image), b'"', tail))
+
+
+async def analyze_product_with_gemini(image: bytes | memoryview, mime_type: str = "image/jpeg",
+                                      on_scene: Callable[[str, str], None] | None = None) -> dict:
+    """
+    Используем Google Gemini для анализа товара и генерации промтов.
+    С on_scene ответ читается потоком (SSE): on_scene(key, prompt) вызывается,
+    как только промт сцены пришёл целиком, не дожидаясь конца ответа.
+    """
+
+    if config.ANALYSIS_MODE == "compact":
+        # Только атрибуты по строгой схеме — промты сцен собираются локально
+        prompt, generation_config = COMPACT_PROMPT, {
+            "temperature": 0.2,
+            "maxOutputTokens": 300,
+            "responseMimeType": "application/json",
+            "responseSchema": COMPACT_SCHEMA,
+        }
+    else:
+        prompt, generation_config = FULL_PROMPT, {
+            "temperature": 0.4,
+            "maxOutputTokens": 2000,
+        }
+
     payload = {
         "contents": [
             {
@@ -155,30 +308,45 @@ Each scene prompt MUST:
                     {
                         "inline_data": {
                             "mime_type": mime_type,
-                            "data": b64
+                            "data": IMAGE_PLACEHOLDER
                         }
                     },
-                    {"text": PROMPT}
+                    {"text": prompt}
                 ]
             }
         ],
-        "generationConfig": {
-            "temperature": 0.4,
-            "maxOutputTokens": 2000,
-        }
+        "generationConfig": generation_config,
     }
 
-    url = (
-        f"https://generativelanguage.googleapis.com/v1beta/models/"
-        f"gemini-1.5-flash:generateContent?key={config.GEMINI_API_KEY}"
-    )
-
-    async with httpx.AsyncClient(timeout=60) as client:
-        resp = await client.post(url, json=payload)
+    body = build_json_body(payload, image)
+    headers = {"Content-Type": "application/json"}
+
+    if on_scene is not None and config.GEMINI_STREAM:
+        parser = SceneStreamParser(list(SCENE_INDEX), on_scene)
+        async with http.gemini.stream(
+            "POST", "/v1beta/models/gemini-1.5-flash:streamGenerateContent",
+            params={"key": config.GEMINI_API_KEY, "alt": "sse"},
+            content=body, headers=headers,
+        ) as resp:
+            if resp.is_error:
+                await resp.aread()
+            resp.raise_for_status()
+            async for line in resp.aiter_lines():
+                parser.feed_sse_line(line)
+        raw = parser.text
+    else:
+        resp = await http.gemini.post(
+            "/v1beta/models/gemini-1.5-flash:generateContent",
+            params={"key": config.GEMINI_API_KEY},
+            content=body, headers=headers,
+        )
         resp.raise_for_status()
         data = resp.json()
+        raw = data["candidates"][0]["content"]["parts"][0]["text"]
 
-    raw = data["candidates"][0]["content"]["parts"][0]["text"]
+    if config.ANALYSIS_MODE == "compact":
+        # responseMimeType=application/json — ответ без markdown-обёртки
+        return json.loads(raw)
     raw = re.sub(r"```json|```", "", raw).strip()
     return json.loads(raw)
 
@@ -188,12 +356,179 @@ async def generate_image_pollinations(prompt: str, seed: int = 42, width: int =
     # Кодируем промт
     import urllib.parse
     encoded = urllib.parse.quote(prompt)
-    url = f"https://image.pollinations.ai/prompt/{encoded}?width={width}&height={height}&seed={seed}&model=flux&nologo=true&enhance=true"
+    url = f"/prompt/{encoded}?width={width}&height={height}&seed={seed}&model=flux&nologo=true&enhance=true"
 
-    async with httpx.AsyncClient(timeout=120, follow_redirects=True) as client:
-        resp = await client.get(url)
-        resp.raise_for_status()
-        return resp.content
+    resp = await http.pollinations.get(url)
+    resp.raise_for_status()
+    return resp.content
+
+
+engine = RenderEngine(
+    generate_image_pollinations,
+    AIMDLimiter(
+        config.POLLINATIONS_CONCURRENCY,
+        minimum=config.POLLINATIONS_MIN_CONCURRENCY,
+        maximum=config.POLLINATIONS_MAX_CONNECTIONS,
+    ),
+    retries=config.RENDER_RETRIES,
+)
+metrics.GaugeFunc(
+    "snapsell_pollinations_requests", "Pollinations concurrency: limit and in flight",
+    lambda: {("limit",): int(engine.limiter.limit), ("in_flight",): engine.limiter.in_flight},
+    labels=("state",),
+)
+
+
+async def render_scene(prompt: str, seed: int, width: int = 1024, height: int = 1024) -> str | bytes:
+    """Сцена из кэша (file_id или байты с диска) либо новая генерация."""
+    key = render_key(prompt, seed, width, height)
+    cached = await renders.lookup(key)
+    if cached is not None:
+        metrics.SCENES.labels("cached").inc()
+        return cached
+    try:
+        with metrics.STAGE_SECONDS.labels("render_scene").time():
+            img = await engine.render(prompt, seed=seed, width=width, height=height)
+    except Exception:
+        metrics.SCENES.labels("failed").inc()
+        raise
+    metrics.SCENES.labels("rendered").inc()
+    await renders.store_bytes(key, img)
+    return img
+
+
+class StatusMessage:
+    """
+    Статусное сообщение генерации по chat_id/message_id (работает и в worker.py).
+    Правки не ждут лимитов Telegram: отправляется последний текст, а
+    промежуточные, которые устарели, пока ждали очереди, отбрасываются.
+    """
+
+    def __init__(self, bot, chat_id: int, message_id: int):
+        self.bot = bot
+        self.chat_id = chat_id
+        self.message_id = message_id
+        self._pending: tuple[str, dict] | None = None
+        self._sender: asyncio.Task | None = None
+        self._deleted = False
+
+    async def edit_text(self, text: str, **kwargs):
+        if self._deleted:
+            return
+        self._pending = (text, kwargs)
+        if self._sender is None or self._sender.done():
+            self._sender = asyncio.create_task(self._send())
+
+    async def _send(self):
+        while self._pending is not None:
+            text, kwargs = self._pending
+            self._pending = None
+            try:
+                await self.bot.edit_message_text(text, chat_id=self.chat_id, message_id=self.message_id, **kwargs)
+            except Exception as e:
+                logger.warning(f"Status edit failed in chat {self.chat_id}: {e}")
+
+    async def delete(self):
+        # Правка, ещё ждущая лимита, уже не нужна
+        self._deleted = True
+        self._pending = None
+        if self._sender is not None and not self._sender.done():
+            self._sender.cancel()
+            await asyncio.gather(self._sender, return_exceptions=True)
+        await self.bot.delete_message(self.chat_id, self.message_id)
+
+
+async def send_scenes(bot, job: GenerationJob, images: dict[int, str | bytes],
+                      cache_keys: list[str]) -> dict[int, str]:
+    """Отправляет готовые сцены альбомом (или одним фото). Возвращает {сцена: file_id}."""
+    order = sorted(images)
+    media = []
+    for n, i in enumerate(order):
+        scene_cfg = SCENES[i]
+        caption = f"{scene_cfg['emoji']} *{scene_cfg['name']}*" if n == 0 else ""
+        image = images[i]
+        media.append(
+            InputMediaPhoto(
+                # file_id из кэша отправляется без повторной загрузки
+                media=image if isinstance(image, str) else BytesIO(image),
+                caption=caption,
+                parse_mode=ParseMode.MARKDOWN if caption else None
+            )
+        )
+    reply = {"reply_to_message_id": job.message_id, "allow_sending_without_reply": True}
+    with metrics.STAGE_SECONDS.labels("upload").time():
+        if len(media) == 1:
+            sent = [await bot.send_photo(
+                job.chat_id, photo=media[0].media, caption=media[0].caption,
+                parse_mode=ParseMode.MARKDOWN, **reply
+            )]
+        else:
+            sent = await bot.send_media_group(job.chat_id, media=media, **reply)
+    file_ids = {}
+    for i, msg in zip(order, sent):
+        if msg.photo:
+            file_ids[i] = msg.photo[-1].file_id
+            if not isinstance(images[i], str):
+                await renders.store_file_id(cache_keys[i], file_ids[i])
+    return file_ids
+
+
+async def deliver_album(bot, job: GenerationJob, factories, cache_keys, status_msg, on_delivered) -> dict[int, str]:
+    """Сцены, успевшие к дедлайну, — одним альбомом; опоздавшие и упавшие — следом."""
+    done, pending = await RenderEngine.gather_partial(factories, deadline=config.SCENE_DEADLINE)
+    sent = {}
+    if done:
+        await status_msg.delete()
+        sent.update(await send_scenes(bot, job, done, cache_keys))
+        await on_delivered()
+
+    late, errors = {}, []
+    if pending:
+        finished, unfinished = await asyncio.wait(pending.values(), timeout=config.SCENE_LATE_DEADLINE)
+        for task in unfinished:
+            task.cancel()
+        for i, task in pending.items():
+            if task in finished and task.exception() is None:
+                late[i] = task.result()
+            elif task in finished:
+                errors.append(task.exception())
+    if late:
+        if not sent:
+            await status_msg.delete()
+        sent.update(await send_scenes(bot, job, late, cache_keys))
+        await on_delivered()
+    if not sent:
+        raise errors[0] if errors else asyncio.TimeoutError("no scenes rendered")
+    return sent
+
+
+async def deliver_streaming(bot, job: GenerationJob, factories, cache_keys, status_msg, on_delivered) -> dict[int, str]:
+    """Каждая сцена отправляется сразу по готовности, статус показывает «2/4 готово»."""
+    sent, errors = {}, []
+    deadline = config.SCENE_DEADLINE + config.SCENE_LATE_DEADLINE
+    async for i, result in RenderEngine.stream(factories, deadline=deadline):
+        if isinstance(result, Exception):
+            errors.append(result)
+            continue
+        sent.update(await send_scenes(bot, job, {i: result}, cache_keys))
+        await on_delivered()
+        if len(sent) < len(factories):
+            await status_msg.edit_text(
+                PROGRESS.format(done=len(sent), total=len(factories)), parse_mode=ParseMode.MARKDOWN
+            )
+    if not sent:
+        raise errors[0] if errors else asyncio.TimeoutError("no scenes rendered")
+    await status_msg.delete()
+
+    # Итоговый альбом собирается из file_id — без повторной загрузки
+    if config.STREAM_FINAL_ALBUM and len(sent) > 1:
+        await send_scenes(bot, job, sent, cache_keys)
+    return sent
+
+
+def scene_seed(user_id: int, scene: int, variant: int = 0) -> int:
+    """Уникальный seed на пользователя и сцену; variant — номер перегенерации."""
+    return user_id % 9999 + scene * 1000 + variant * 100_000
 
 
 def build_scene_prompt(product_info: dict, scene_key: str, scene_cfg: dict) -> str:
@@ -201,14 +536,8 @@ def build_scene_prompt(product_info: dict, scene_key: str, scene_cfg: dict) -> s
     base = product_info.get("scenes", {}).get(scene_key, "")
     if base:
         return base
-    # Fallback если Claude не вернул сцены
-    name = product_info.get("product_en", "product")
-    colors = ", ".join(product_info.get("colors", ["neutral"]))
-    style = product_info.get("style", "modern")
-    return (
-        f"Professional commercial photography, {name}, {colors} colors, {style} style, "
-        f"{scene_cfg['prompt_desc']}, photorealistic, 8K resolution, sharp focus, commercial product photography"
-    )
+    # Компактный анализ (или Gemini не вернул сцены) — шаблон по категории
+    return template_scene_prompt(product_info, scene_key, scene_cfg["prompt_desc"])
 
 
 # ─────────────────────────────────────────────
@@ -217,8 +546,8 @@ def build_scene_prompt(product_info: dict, scene_key: str, scene_cfg: dict) -> s
 
 async def cmd_start(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
-    db.ensure_user(user.id, user.username or "", user.first_name or "")
-    free_left = max(0, config.FREE_GENERATIONS - db.get_uses(user.id))
+    await db.ensure_user(user.id, user.username or "", user.first_name or "")
+    free_left = (await db.get_account(user.id)).free_left
 
     kb = InlineKeyboardMarkup([[
         InlineKeyboardButton("📸 Загрузить фото товара", callback_data="send_photo")
@@ -248,24 +577,22 @@ async def cmd_help(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
 
 
 async def cmd_balance(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
-    user_id = update.effective_user.id
-    db.ensure_user(user_id)
-    uses = db.get_uses(user_id)
-    plan = db.get_plan(user_id)
-    is_paid = plan in ("basic", "pro")
+    user = update.effective_user
+    user_id = user.id
+    await db.ensure_user(user_id, user.username or "", user.first_name or "")
+    account = await db.get_account(user_id)
+    is_paid = account.plan in ("basic", "pro")
 
     if is_paid:
-        if plan == "pro":
+        if account.plan == "pro":
             text = "⭐ *Тариф PRO* — безлимитные генерации"
         else:
-            remaining = db.get_paid_remaining(user_id)
-            text = f"💎 *Тариф Базовый* — осталось генераций: *{remaining}*"
+            text = f"💎 *Тариф Базовый* — осталось генераций: *{account.paid_left}*"
     else:
-        free_left = max(0, config.FREE_GENERATIONS - uses)
         text = (
             f"🆓 *Бесплатный план*\n"
-            f"Использовано: {uses} / {config.FREE_GENERATIONS}\n"
-            f"Осталось: *{free_left}*"
+            f"Использовано: {account.free_uses} / {config.FREE_GENERATIONS}\n"
+            f"Осталось: *{account.free_left}*"
         )
 
     kb = InlineKeyboardMarkup([[
@@ -278,6 +605,37 @@ async def cmd_plans(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     await show_plans_message(update.message)
 
 
+async def cmd_admin(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
+    if not config.ADMIN_ID or update.effective_user.id != config.ADMIN_ID:
+        return
+    stats = await db.get_stats()
+    lines = [
+        "📊 *Статистика*",
+        f"Пользователей: *{stats['total_users']}* (платных: {stats['paid_users']})",
+        f"Генераций: *{stats['total_gens']}* (сегодня: {stats['today_gens']})",
+    ]
+    for days in (7, 30):
+        by_plan = await db.get_stats_range(days)
+        gens = sum(v["generations"] for v in by_plan.values())
+        new_users = sum(v["new_users"] for v in by_plan.values())
+        per_plan = ", ".join(
+            f"{plan} {v['generations']}" for plan, v in sorted(by_plan.items()) if v["generations"]
+        ) or "—"
+        purchases = ", ".join(
+            f"{plan} {v['purchases']}" for plan, v in sorted(by_plan.items()) if v["purchases"]
+        ) or "—"
+        lines += [
+            "",
+            f"*За {days} дн.*",
+            f"Генераций: {gens} ({per_plan})",
+            f"Новых пользователей: {new_users}",
+            f"Покупок: {purchases}",
+        ]
+    # Имена метрик с подчёркиваниями — в блоке кода, чтобы Markdown их не разбирал
+    lines += ["", "*Метрики процесса*", "```", *(metrics.summary() or ["—"]), "```"]
+    await update.message.reply_text("\n".join(lines), parse_mode=ParseMode.MARKDOWN)
+
+
 async def cb_handler(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
@@ -293,6 +651,130 @@ async def cb_handler(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
         plan = data.split("_", 1)[1]
         await initiate_payment(query, ctx, plan)
 
+    elif data.startswith("fmt:"):
+        # fmt:<пресет>[:<ref>] — выбор формата; с ref — сразу отправить файлы
+        _, preset, *ref = data.split(":")
+        await db.set_preset(query.from_user.id, "" if preset == "none" else preset)
+        if preset in PRESETS:
+            await query.edit_message_text(f"✅ Формат файлов: *{PRESETS[preset]['title']}*", parse_mode=ParseMode.MARKDOWN)
+        else:
+            await query.edit_message_text("✅ Файлы для маркетплейса отключены")
+        if ref and preset in PRESETS:
+            await send_bundle(ctx.bot, query.message.chat_id, query.from_user.id, ref[0], preset)
+
+    elif data.startswith("regen:"):
+        # regen:<ref>:<сцена> — одна сцена заново
+        _, ref, scene = data.split(":")
+        await regenerate_scene(ctx.bot, query.message.chat_id, query.from_user.id, ref, int(scene))
+
+    elif data.startswith("bundle:"):
+        ref = data.split(":", 1)[1]
+        account = await db.get_account(query.from_user.id)
+        if account.preset in PRESETS:
+            await send_bundle(ctx.bot, query.message.chat_id, query.from_user.id, ref, account.preset)
+        else:
+            await query.message.reply_text(
+                "📦 Для какой площадки подготовить файлы?", reply_markup=preset_keyboard(ref)
+            )
+
+
+def preset_keyboard(ref: str = "") -> InlineKeyboardMarkup:
+    suffix = f":{ref}" if ref else ""
+    rows = [[InlineKeyboardButton(cfg["title"], callback_data=f"fmt:{key}{suffix}")] for key, cfg in PRESETS.items()]
+    if not ref:
+        rows.append([InlineKeyboardButton("Без файлов", callback_data="fmt:none")])
+    return InlineKeyboardMarkup(rows)
+
+
+async def cmd_format(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
+    user = update.effective_user
+    await db.ensure_user(user.id, user.username or "", user.first_name or "")
+    account = await db.get_account(user.id)
+    current = PRESETS[account.preset]["title"] if account.preset in PRESETS else "не выбран"
+    await update.message.reply_text(
+        f"📦 *Файлы для маркетплейса*\n"
+        f"Под результатом появится кнопка — сцены придут файлами нужного размера и формата.\n\n"
+        f"Сейчас: *{current}*",
+        parse_mode=ParseMode.MARKDOWN,
+        reply_markup=preset_keyboard(),
+    )
+
+
+async def send_bundle(bot, chat_id: int, user_id: int, ref: str, preset: str):
+    """Сцены генерации ref файлами под пресет: кадрирование и сжатие — в пуле процессов."""
+    generation = await db.get_generation(ref)
+    if not generation or generation["user_id"] != user_id or not generation["scenes"]:
+        await bot.send_message(chat_id, "⚠️ Генерация не найдена — возможно, она слишком старая.")
+        return
+
+    await bot.send_chat_action(chat_id, ChatAction.UPLOAD_DOCUMENT)
+    loop = asyncio.get_running_loop()
+
+    async def prepare(i: int, file_id: str) -> bytes:
+        file = await bot.get_file(file_id)
+        data = await file.download_as_bytearray()
+        return await loop.run_in_executor(image_pool, render_preset, bytes(data), preset)
+
+    order = sorted(generation["scenes"])
+    with metrics.STAGE_SECONDS.labels("postprocess").time():
+        files = await asyncio.gather(*(prepare(i, generation["scenes"][i]) for i in order))
+
+    width, height = PRESETS[preset]["size"]
+    caption = f"📦 {PRESETS[preset]['title']}: {width}×{height}"
+    names = [file_name(preset, i, SCENES[i]["key"]) for i in order]
+    if len(files) == 1:
+        await bot.send_document(chat_id, document=BytesIO(files[0]), filename=names[0], caption=caption)
+        return
+    # Подпись у последнего документа — Telegram показывает её под всей группой
+    await bot.send_media_group(chat_id, media=[
+        InputMediaDocument(BytesIO(data), filename=name, caption=caption if n == len(files) - 1 else None)
+        for n, (data, name) in enumerate(zip(files, names))
+    ])
+
+
+async def regenerate_scene(bot, chat_id: int, user_id: int, ref: str, scene: int):
+    """
+    Одна сцена заново с другим seed: анализ товара — из журнала генераций,
+    без Gemini и без списания генерации (лимит SCENE_REGENERATIONS на генерацию).
+    """
+    if not 0 <= scene < len(SCENES):
+        return
+    claim = await db.claim_regeneration(ref, user_id, config.SCENE_REGENERATIONS)
+    if claim is None:
+        await bot.send_message(chat_id, REGEN_UNAVAILABLE.format(limit=config.SCENE_REGENERATIONS))
+        return
+    scene_cfg = SCENES[scene]
+    prompt = build_scene_prompt(claim["product_info"], scene_cfg["key"], scene_cfg)
+    seed = scene_seed(user_id, scene, variant=claim["regens"])
+    account = await db.get_account(user_id)
+
+    async def run():
+        await bot.send_chat_action(chat_id, ChatAction.UPLOAD_PHOTO)
+        with metrics.STAGE_SECONDS.labels("regenerate").time():
+            image = await render_scene(prompt, seed=seed)
+        kb = InlineKeyboardMarkup([[
+            InlineKeyboardButton("🔄 Ещё вариант", callback_data=f"regen:{ref}:{scene}")
+        ]])
+        sent = await bot.send_photo(
+            chat_id, photo=image if isinstance(image, str) else BytesIO(image),
+            caption=f"🔄 {scene_cfg['emoji']} *{scene_cfg['name']}* — вариант {claim['regens'] + 1}",
+            parse_mode=ParseMode.MARKDOWN, reply_markup=kb,
+        )
+        file_id = sent.photo[-1].file_id
+        if not isinstance(image, str):
+            await renders.store_file_id(render_key(prompt, seed, 1024, 1024), file_id)
+        await db.set_generation_scene(ref, scene, file_id)
+
+    try:
+        await scheduler.submit(user_id, account.plan, run)
+    except asyncio.CancelledError:
+        await db.release_regeneration(ref)
+        raise
+    except Exception as e:
+        logger.error(f"Scene regeneration failed for user {user_id}: {e}")
+        await db.release_regeneration(ref)
+        await bot.send_message(chat_id, "❌ Не получилось перегенерировать сцену. Попробуйте ещё раз.")
+
 
 async def show_plans_message(message):
     text = (
@@ -344,10 +826,11 @@ async def successful_payment(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
 
     if payload.startswith("plan_basic_"):
-        db.set_plan(user_id, "basic", generations=30)
+        await db.set_plan(user_id, "basic", generations=30)
         text = "✅ *Оплата прошла!* Вам зачислено *30 генераций*.\nОтправьте фото товара!"
     elif payload.startswith("plan_pro_"):
-        db.set_plan(user_id, "pro", days=30)
+        await db.set_plan(user_id, "pro", days=30)
+        pro_changed.set()
         text = "✅ *PRO активирован!* У вас безлимитные генерации на 30 дней.\nОтправьте фото товара!"
     else:
         text = "✅ Оплата получена!"
@@ -356,109 +839,561 @@ async def successful_payment(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
 
 
 async def handle_photo(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
-    user = update.effective_user
-    db.ensure_user(user.id, user.username or "", user.first_name or "")
+    # Для анализа не нужен оригинал 2560px — берём наименьший достаточный размер
+    photo = pick_photo_size(update.message.photo, config.ANALYSIS_MIN_SIDE)
+    if album_mode(update):
+        await collect_album(update, ctx, AlbumItem(update.message.message_id, photo.file_id, photo.file_unique_id))
+        return
+    await start_generation(update, ctx, photo.file_id, photo.file_unique_id)
+
+
+async def handle_document(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
+    """Фото, отправленное файлом: оригинал любого размера, уменьшаем сами."""
+    doc = update.message.document
+    if doc.file_size and doc.file_size > config.MAX_DOCUMENT_MB * 1024 * 1024:
+        await update.message.reply_text(
+            f"📎 Файл слишком большой. Пришлите изображение до {config.MAX_DOCUMENT_MB} МБ "
+            f"или отправьте его как фото."
+        )
+        return
+    if album_mode(update):
+        await collect_album(
+            update, ctx, AlbumItem(update.message.message_id, doc.file_id, doc.file_unique_id, is_document=True)
+        )
+        return
+    await start_generation(update, ctx, doc.file_id, doc.file_unique_id, is_document=True)
 
-    # Проверяем доступ
-    if not db.can_generate(user.id):
+
+async def show_paywall(message):
+    metrics.PAYWALL_HITS.inc()
+    kb = InlineKeyboardMarkup([[
+        InlineKeyboardButton("💳 Выбрать план", callback_data="show_plans")
+    ]])
+    await message.reply_text(PAYWALL, parse_mode=ParseMode.MARKDOWN, reply_markup=kb)
+
+
+async def follow_flight(message, flight: asyncio.Future):
+    """Дубликат фото, которое уже генерируется: без списания ждём результат первого запуска."""
+    metrics.COALESCED.inc()
+    sent = await message.reply_text(DUPLICATE)
+    ref = await asyncio.shield(flight)
+    if ref:
         kb = InlineKeyboardMarkup([[
-            InlineKeyboardButton("💳 Выбрать план", callback_data="show_plans")
+            InlineKeyboardButton("📦 Файлы для маркетплейса", callback_data=f"bundle:{ref}")
         ]])
-        await update.message.reply_text(PAYWALL, parse_mode=ParseMode.MARKDOWN, reply_markup=kb)
+        await sent.edit_text(DUPLICATE_DONE, reply_markup=kb)
+    else:
+        await sent.edit_text(DUPLICATE_FAILED)
+
+
+async def skip_duplicate(message):
+    """Дубликат фото из очереди worker.py: результат придёт ответом на первое сообщение."""
+    metrics.COALESCED.inc()
+    await message.reply_text(DUPLICATE)
+
+
+async def start_generation(update: Update, ctx: ContextTypes.DEFAULT_TYPE,
+                           file_id: str, file_unique_id: str, is_document: bool = False):
+    """
+    Двойное нажатие, ретрай клиента или пересылка присылают то же фото,
+    пока первая генерация ещё идёт, — повтор присоединяется к ней.
+    С JOB_QUEUE генерацию выполняет worker.py: повтор не списывается и не
+    ставится в очередь, пока задача с тем же фото не завершилась.
+    """
+    key = (update.effective_user.id, file_unique_id)
+    flight = inflight.get(key)
+    if flight is not None:
+        if config.JOB_QUEUE:
+            await skip_duplicate(update.message)
+        else:
+            await follow_flight(update.message, flight)
         return
+    inflight.claim(key)
+    ref = None
+    try:
+        # inflight закрывает окно до enqueue_job, таблица jobs — всё, что уже у воркеров
+        if config.JOB_QUEUE and await db.has_active_job(*key):
+            await skip_duplicate(update.message)
+            return
+        ref = await launch_generation(update, ctx, file_id, file_unique_id, is_document)
+    finally:
+        inflight.release(key, ref)
+
+
+async def launch_generation(update: Update, ctx: ContextTypes.DEFAULT_TYPE,
+                            file_id: str, file_unique_id: str, is_document: bool = False) -> str | None:
+    """Списание, статус и очередь. Возвращает ref доставленной генерации."""
+    user = update.effective_user
+    await db.ensure_user(user.id, user.username or "", user.first_name or "")
+
+    # Резервируем генерацию (атомарно: проверка лимита + списание)
+    reservation = await db.reserve_generation(user.id)
+    if reservation is None:
+        await show_paywall(update.message)
+        return None
 
-    # Сообщение о начале работы
-    status_msg = await update.message.reply_text(
-        ANALYZING, parse_mode=ParseMode.MARKDOWN
+    # Повторное фото (ретрай, пересылка) — анализ уже есть в кэше
+    file_key = f"{ANALYSIS_VERSION}:tg:{file_unique_id}"
+    product_info = await db.get_analysis(file_key, record_miss=False)
+    first_step = RENDERING if product_info else ANALYZING
+
+    try:
+        # Сообщение о начале работы
+        sent = await update.message.reply_text(
+            JOB_QUEUED if config.JOB_QUEUE else first_step, parse_mode=ParseMode.MARKDOWN
+        )
+        if config.JOB_QUEUE:
+            # Генерацию выполнит процесс worker.py — задача переживёт перезапуск бота
+            await db.enqueue_job(
+                user.id, update.effective_chat.id, update.message.message_id, sent.message_id,
+                file_id, file_unique_id, reservation.charged,
+                priority=PLAN_PRIORITY.get(reservation.charged, len(PLAN_PRIORITY)),
+                is_document=is_document,
+            )
+            return None
+    except Exception:
+        await db.refund_generation(reservation)
+        raise
+    status_msg = StatusMessage(ctx.bot, sent.chat_id, sent.message_id)
+
+    job = GenerationJob(
+        user_id=user.id,
+        chat_id=update.effective_chat.id,
+        message_id=update.message.message_id,
+        file_id=file_id,
+        file_key=file_key,
+        is_document=is_document,
+        reservation=reservation,
+        product_info=product_info,
+        ref=secrets.token_hex(6),
     )
+    queued = started = False
+
+    async def on_position(pos: int):
+        nonlocal queued
+        queued = True
+        await status_msg.edit_text(QUEUED.format(pos=pos), parse_mode=ParseMode.MARKDOWN)
 
+    async def run():
+        nonlocal started
+        started = True
+        if queued:
+            await status_msg.edit_text(first_step, parse_mode=ParseMode.MARKDOWN)
+        return job.ref if await run_generation(ctx.bot, job, status_msg) else None
+
+    # PRO идёт в очередь с наивысшим приоритетом
     try:
-        # ── ШАГ 1: Скачиваем фото ──
-        await ctx.bot.send_chat_action(update.effective_chat.id, ChatAction.TYPING)
-        photo = update.message.photo[-1]  # наибольшее разрешение
-        file = await ctx.bot.get_file(photo.file_id)
-        buf = BytesIO()
-        await file.download_to_memory(buf)
-        image_bytes = buf.getvalue()
-
-        # ── ШАГ 2: Claude анализирует товар ──
-        product_info = await analyze_product_with_gemini(image_bytes)
-        product_ru = product_info.get("product_ru", "товар")
-        logger.info(f"User {user.id} | Product: {product_info.get('product_en')} | Category: {product_info.get('category')}")
-
-        await status_msg.edit_text(PROMPTING, parse_mode=ParseMode.MARKDOWN)
-
-        # ── ШАГ 3: Генерируем 4 изображения ──
-        await status_msg.edit_text(RENDERING, parse_mode=ParseMode.MARKDOWN)
-        await ctx.bot.send_chat_action(update.effective_chat.id, ChatAction.UPLOAD_PHOTO)
-
-        scene_keys = ["display", "lifestyle", "interior", "closeup"]
-        tasks = []
-        for i, (key, scene_cfg) in enumerate(zip(scene_keys, SCENES)):
-            prompt = build_scene_prompt(product_info, key, scene_cfg)
-            seed = user.id % 9999 + i * 1000  # уникальный seed на пользователя
-            tasks.append(generate_image_pollinations(prompt, seed=seed))
-
-        # Параллельная генерация всех 4 изображений
-        images_bytes = await asyncio.gather(*tasks)
-
-        # ── ШАГ 4: Отправляем результат ──
-        media_group = []
-        for i, (img_bytes, scene_cfg) in enumerate(zip(images_bytes, SCENES)):
-            caption = f"{scene_cfg['emoji']} *{scene_cfg['name']}*" if i == 0 else ""
-            media_group.append(
-                InputMediaPhoto(
-                    media=BytesIO(img_bytes),
-                    caption=caption,
-                    parse_mode=ParseMode.MARKDOWN if caption else None
-                )
+        return await scheduler.submit(user.id, reservation.charged, run, on_position=on_position)
+    except asyncio.CancelledError:
+        # Остановка бота до начала генерации — возвращаем списанное
+        if not started:
+            await db.refund_generation(reservation)
+        raise
+
+
+# ── Альбомы ──────────────────────────────────────────────
+
+@dataclass(order=True)
+class AlbumItem:
+    """Фото из альбома; сортировка по message_id — порядок, в котором их прислали."""
+    message_id:     int
+    file_id:        str
+    file_unique_id: str
+    is_document:    bool = False
+
+
+# (user_id, media_group_id) → фото альбома, пришедшие за окно ALBUM_WINDOW
+_albums: dict[tuple[int, str], list[AlbumItem]] = {}
+
+
+def album_mode(update: Update) -> bool:
+    # С JOB_QUEUE каждое фото — отдельная задача worker.py
+    return config.ALBUM_BATCH and not config.JOB_QUEUE and bool(update.message.media_group_id)
+
+
+async def collect_album(update: Update, ctx: ContextTypes.DEFAULT_TYPE, item: AlbumItem):
+    """
+    Фото альбома приходят отдельными апдейтами. Первый ждёт ALBUM_WINDOW
+    и запускает весь альбом, остальные только добавляют своё фото.
+    """
+    key = (update.effective_user.id, update.message.media_group_id)
+    items = _albums.get(key)
+    if items is not None:
+        items.append(item)
+        return
+    _albums[key] = [item]
+    await asyncio.sleep(config.ALBUM_WINDOW)
+    await start_album(update, ctx, sorted(_albums.pop(key)))
+
+
+class SilentStatus:
+    """Статус товара альбома: общий прогресс ведёт run_album, здесь — только последний текст."""
+
+    def __init__(self):
+        self.text = ""
+
+    async def edit_text(self, text: str, **kwargs):
+        self.text = text
+
+    async def delete(self):
+        pass
+
+
+async def start_album(update: Update, ctx: ContextTypes.DEFAULT_TYPE, items: list[AlbumItem]):
+    """Повторы внутри альбома и фото, которые уже генерируются, не запускаются второй раз."""
+    user_id = update.effective_user.id
+    unique = []
+    for item in items:
+        key = (user_id, item.file_unique_id)
+        if inflight.get(key) is None:
+            inflight.claim(key)
+            unique.append(item)
+        else:
+            metrics.COALESCED.inc()
+    if not unique:
+        await update.message.reply_text(DUPLICATE)
+        return
+    refs = {}
+    try:
+        refs = await launch_album(update, ctx, unique, duplicates=len(items) - len(unique))
+    finally:
+        for item in unique:
+            inflight.release((user_id, item.file_unique_id), refs.get(item.message_id))
+
+
+async def launch_album(update: Update, ctx: ContextTypes.DEFAULT_TYPE, items: list[AlbumItem],
+                       duplicates: int = 0) -> dict[int, str]:
+    """
+    Альбом — одна задача планировщика: одно списание, один статус, одна сводка.
+    Возвращает {message_id фото: ref} доставленных генераций.
+    """
+    user = update.effective_user
+    await db.ensure_user(user.id, user.username or "", user.first_name or "")
+
+    # Все генерации альбома — одной транзакцией; баланса может хватить не на все фото
+    reservations = await db.reserve_generations(user.id, len(items))
+    if not reservations:
+        await show_paywall(update.message)
+        return {}
+    skipped = len(items) - len(reservations)
+    items = items[:len(reservations)]
+
+    try:
+        sent = await ctx.bot.send_message(
+            update.effective_chat.id,
+            ALBUM_STARTED.format(total=len(items), concurrency=min(len(items), config.ALBUM_CONCURRENCY)),
+            parse_mode=ParseMode.MARKDOWN,
+            reply_to_message_id=items[0].message_id,
+            allow_sending_without_reply=True,
+        )
+        jobs = []
+        for item, reservation in zip(items, reservations):
+            file_key = f"{ANALYSIS_VERSION}:tg:{item.file_unique_id}"
+            jobs.append(GenerationJob(
+                user_id=user.id,
+                chat_id=update.effective_chat.id,
+                message_id=item.message_id,
+                file_id=item.file_id,
+                file_key=file_key,
+                is_document=item.is_document,
+                reservation=reservation,
+                product_info=await db.get_analysis(file_key, record_miss=False),
+                ref=secrets.token_hex(6),
+                notify=False,
+            ))
+    except Exception:
+        for reservation in reservations:
+            await db.refund_generation(reservation)
+        raise
+    status_msg = StatusMessage(ctx.bot, sent.chat_id, sent.message_id)
+    queued = started = False
+
+    async def on_position(pos: int):
+        nonlocal queued
+        queued = True
+        await status_msg.edit_text(ALBUM_QUEUED.format(pos=pos), parse_mode=ParseMode.MARKDOWN)
+
+    async def run():
+        nonlocal started
+        started = True
+        if queued:
+            await status_msg.edit_text(
+                ALBUM_STARTED.format(total=len(jobs), concurrency=min(len(jobs), config.ALBUM_CONCURRENCY)),
+                parse_mode=ParseMode.MARKDOWN,
             )
+        results = await run_album(ctx.bot, jobs, status_msg, skipped, duplicates)
+        return {job.message_id: job.ref for job, ok in zip(jobs, results) if ok}
 
-        await status_msg.delete()
+    # Весь альбом — одно место в очереди с приоритетом тарифа
+    try:
+        return await scheduler.submit(user.id, reservations[0].charged, run, on_position=on_position)
+    except asyncio.CancelledError:
+        if not started:
+            for reservation in reservations:
+                await db.refund_generation(reservation)
+        raise
+
+
+async def run_album(bot, jobs: list[GenerationJob], status_msg, skipped: int = 0,
+                    duplicates: int = 0) -> list[bool]:
+    """
+    Товары альбома по ALBUM_CONCURRENCY одновременно. Сцены каждого товара
+    генерируются сразу, а отправляются по порядку альбома: товар ждёт,
+    пока закончится предыдущий. Прогресс — правками одного сообщения.
+    """
+    loop = asyncio.get_running_loop()
+    limit = asyncio.Semaphore(config.ALBUM_CONCURRENCY)
+    finished = [loop.create_future() for _ in jobs]
+    statuses = [SilentStatus() for _ in jobs]
+    results: list[bool] = [False] * len(jobs)
+    done = 0
+    last_edit = loop.time()
+
+    for i, job in enumerate(jobs):
+        job.deliver_after = finished[i - 1] if i else None
+
+    async def run_item(i: int):
+        nonlocal done, last_edit
+        started = False
+        try:
+            # Семафор захватывается в порядке альбома — предыдущий товар всегда уже запущен
+            async with limit:
+                started = True
+                results[i] = await run_generation(bot, jobs[i], statuses[i])
+        finally:
+            if not started:
+                await db.refund_generation(jobs[i].reservation)
+            if not finished[i].done():
+                finished[i].set_result(None)
+        done += 1
+        if done < len(jobs) and loop.time() - last_edit >= 2:
+            last_edit = loop.time()
+            await status_msg.edit_text(
+                ALBUM_PROGRESS.format(done=done, total=len(jobs)), parse_mode=ParseMode.MARKDOWN
+            )
+
+    await asyncio.gather(*(run_item(i) for i in range(len(jobs))))
+    await status_msg.delete()
+
+    lines = [f"✅ *Альбом готов: {sum(results)} из {len(jobs)}*", ""]
+    buttons = []
+    for i, (job, ok) in enumerate(zip(jobs, results)):
+        name = (job.product_info or {}).get("product_ru") or f"Товар {i + 1}"
+        lines.append(f"{i + 1}. {name.replace('*', '').replace('_', ' ')} — {'✅' if ok else '❌'}")
+        if ok:
+            buttons.append(InlineKeyboardButton(f"📦 {i + 1}", callback_data=f"bundle:{job.ref}"))
+    if duplicates:
+        lines.append(f"\nℹ️ Повторы пропущены без списания: {duplicates}")
+    if skipped:
+        lines.append(f"\n⚠️ Не хватило генераций ещё на {skipped} фото")
+
+    rows = [buttons[n:n + 5] for n in range(0, len(buttons), 5)]
+    rows.append([InlineKeyboardButton("📸 Новый товар", callback_data="send_photo")])
+    rows.append([InlineKeyboardButton("💳 Купить генерации", callback_data="show_plans")])
+    # Баланс заново: неудавшиеся товары уже вернули списанное
+    account = await db.get_account(jobs[0].user_id)
+    await bot.send_message(
+        jobs[0].chat_id,
+        "\n".join(lines) + balance_footer(account),
+        parse_mode=ParseMode.MARKDOWN,
+        reply_markup=InlineKeyboardMarkup(rows),
+        reply_to_message_id=jobs[0].message_id,
+        allow_sending_without_reply=True,
+    )
+    return results
+
+
+def balance_footer(account) -> str:
+    if account.plan == "free":
+        return f"\n\n🆓 Осталось бесплатных генераций: *{account.free_left}*"
+    if account.plan == "basic":
+        return f"\n\n💎 Осталось генераций: *{account.paid_left}*"
+    return "\n\n🚀 PRO активен — генерируйте без ограничений"
+
+
+async def run_generation(bot, job: GenerationJob, status_msg) -> bool:
+    """
+    Анализ, генерация 4 сцен и доставка. True — доставлена хотя бы одна сцена,
+    иначе генерация возвращается пользователю.
+    Генерация каждой сцены стартует, как только известен её промт, —
+    при потоковом ответе Gemini это происходит ещё до конца анализа.
+    """
+    delivered = cancelled = committed = False
+    product_info = job.product_info
+    loop = asyncio.get_running_loop()
+    started = loop.time()
+    ref = job.ref or secrets.token_hex(6)    # ссылка на генерацию для кнопок под результатом
+    scene_ids: dict[int, str] = {}
+    prompts = [loop.create_future() for _ in SCENES]
+    cache_keys = [""] * len(SCENES)
+    deliver_task = None
+
+    def seed_for(i: int) -> int:
+        return scene_seed(job.user_id, i)
+
+    def set_prompt(i: int, prompt: str):
+        if not prompts[i].done():
+            cache_keys[i] = render_key(prompt, seed_for(i), 1024, 1024)
+            prompts[i].set_result(prompt)
+
+    async def render_when_ready(i: int):
+        prompt = await asyncio.shield(prompts[i])
+        return await render_scene(prompt, seed=seed_for(i))
+
+    async def on_delivered():
+        nonlocal delivered
+        delivered = True
+
+    async def commit():
+        nonlocal committed
+        committed = True
+        await db.commit_generation(
+            job.reservation, (product_info or {}).get("product_en", "unknown"),
+            ref=ref, scenes=scene_ids, product_info=product_info, durable=job.durable,
+        )
 
-        # Отправляем альбом
-        await update.message.reply_media_group(media=media_group)
+    # Товар альбома: сцены генерируются сразу, а отправка ждёт предыдущий товар.
+    # Первый вызов фабрики отдаёт уже запущенную генерацию, повторный (ретрай) — новую
+    early: list[asyncio.Task | None] = []
+
+    async def wait_early(task: asyncio.Task):
+        return await task
+
+    def factory(i: int):
+        if early and early[i] is not None:
+            task, early[i] = early[i], None
+            return wait_early(task)
+        return render_when_ready(i)
+
+    async def deliver_in_order(*args):
+        await asyncio.shield(job.deliver_after)
+        return await deliver(*args)
+
+    try:
+        # ── ШАГ 3-4 запускаются сразу: каждая сцена ждёт свой промт ──
+        # Товар альбома — всегда одной медиагруппой: меньше запросов под лимитом чата
+        deliver = deliver_streaming if config.STREAM_SCENES and job.notify else deliver_album
+        if job.deliver_after is not None:
+            early = [asyncio.create_task(render_when_ready(i)) for i in range(len(SCENES))]
+        factories = [functools.partial(factory, i) for i in range(len(SCENES))]
+        run_deliver = deliver_in_order if job.deliver_after is not None else deliver
+        deliver_task = asyncio.create_task(run_deliver(bot, job, factories, cache_keys, status_msg, on_delivered))
+
+        if product_info is None:
+            # ── ШАГ 1: Скачиваем фото ──
+            await bot.send_chat_action(job.chat_id, ChatAction.TYPING)
+            with metrics.STAGE_SECONDS.labels("download").time():
+                file = await bot.get_file(job.file_id)
+                buf = BytesIO()
+                await file.download_to_memory(buf)
+            image = buf.getbuffer()  # без копии
+
+            # ── ШАГ 2: Gemini анализирует товар ──
+            image_key = f"{ANALYSIS_VERSION}:sha256:{hashlib.sha256(image).hexdigest()}"
+            product_info = await db.get_analysis(image_key)
+            if product_info is None:
+                if job.is_document or len(image) > config.ANALYSIS_MAX_BYTES:
+                    # Уменьшение и JPEG-кодирование — в отдельном процессе
+                    image = await loop.run_in_executor(
+                        image_pool, prepare_for_analysis, buf.getvalue(),
+                        config.ANALYSIS_MAX_SIDE, config.ANALYSIS_MAX_BYTES,
+                    )
+                with metrics.STAGE_SECONDS.labels("analyze").time():
+                    product_info = await analyze_product_with_gemini(
+                        image, on_scene=lambda key, prompt: set_prompt(SCENE_INDEX[key], prompt)
+                    )
+                await db.put_analysis([job.file_key, image_key], product_info)
+            else:
+                await db.put_analysis([job.file_key], product_info)
+
+            if not delivered:
+                await status_msg.edit_text(PROMPTING, parse_mode=ParseMode.MARKDOWN)
+                await status_msg.edit_text(RENDERING, parse_mode=ParseMode.MARKDOWN)
+
+        logger.info(f"User {job.user_id} | Product: {product_info.get('product_en')} | Category: {product_info.get('category')}")
+
+        # Промты, не пришедшие потоком (или из кэша анализа)
+        for i, scene_cfg in enumerate(SCENES):
+            set_prompt(i, build_scene_prompt(product_info, scene_cfg["key"], scene_cfg))
+        await bot.send_chat_action(job.chat_id, ChatAction.UPLOAD_PHOTO)
+
+        sent = await deliver_task
+        scene_ids.update(sent)
+        missing = [SCENES[i]["name"] for i in range(len(SCENES)) if i not in sent]
+        if missing:
+            logger.warning(f"User {job.user_id} | Missing scenes: {missing}")
+
+        if not job.notify:
+            return delivered
+        # Запись — до сообщения с кнопками: по ref из них генерация уже находится в БД
+        if delivered:
+            await commit()
 
         # Сообщение об успехе
+        account = job.reservation.account
+        preset = PRESETS.get(account.preset)
+        regen = [
+            InlineKeyboardButton(f"🔄 {SCENES[i]['name']}", callback_data=f"regen:{ref}:{i}")
+            for i in sorted(sent)
+        ] if config.SCENE_REGENERATIONS > 0 else []
         kb = InlineKeyboardMarkup([
+            [InlineKeyboardButton(
+                f"📦 Файлы для {preset['title']}" if preset else "📦 Файлы для маркетплейса",
+                callback_data=f"bundle:{ref}",
+            )],
+            *(regen[n:n + 2] for n in range(0, len(regen), 2)),
             [InlineKeyboardButton("📸 Новый товар", callback_data="send_photo")],
             [InlineKeyboardButton("💳 Купить генерации", callback_data="show_plans")],
         ])
-        uses_after = db.increment_uses(user.id)
-        free_left = max(0, config.FREE_GENERATIONS - uses_after)
-        plan = db.get_plan(user.id)
-
-        footer = ""
-        if plan == "free":
-            footer = f"\n\n🆓 Осталось бесплатных генераций: *{free_left}*"
-        elif plan == "basic":
-            footer = f"\n\n💎 Осталось генераций: *{db.get_paid_remaining(user.id)}*"
-        else:
-            footer = "\n\n🚀 PRO активен — генерируйте без ограничений"
 
-        await update.message.reply_text(
+        footer = balance_footer(account)
+        if missing:
+            footer += "\n\n⚠️ Не получилось: " + ", ".join(missing)
+
+        await bot.send_message(
+            job.chat_id,
             SUCCESS + footer,
             parse_mode=ParseMode.MARKDOWN,
-            reply_markup=kb
+            reply_markup=kb,
+            reply_to_message_id=job.message_id,
+            allow_sending_without_reply=True,
         )
 
-        db.log_generation(user.id, product_info.get("product_en", "unknown"))
-
     except httpx.HTTPStatusError as e:
-        logger.error(f"HTTP error for user {user.id}: {e}")
+        logger.error(f"HTTP error for user {job.user_id}: {e}")
         await status_msg.edit_text(
             "❌ Ошибка при обращении к API. Попробуйте позже или обратитесь в поддержку: @your_support"
         )
     except json.JSONDecodeError:
-        logger.error(f"JSON parse error for user {user.id}")
+        logger.error(f"JSON parse error for user {job.user_id}")
         await status_msg.edit_text(
             "❌ Не удалось распознать товар на фото. Попробуйте другое фото с более чётким изображением товара."
         )
     except Exception as e:
-        logger.error(f"Unexpected error for user {user.id}: {e}", exc_info=True)
+        logger.error(f"Unexpected error for user {job.user_id}: {e}", exc_info=True)
         await status_msg.edit_text(
             "❌ Что-то пошло не так. Попробуйте ещё раз или напишите в поддержку: @your_support"
         )
+    except asyncio.CancelledError:
+        cancelled = True
+        raise
+    finally:
+        if deliver_task is not None and not deliver_task.done():
+            deliver_task.cancel()
+        for task in early:
+            if task is not None:
+                task.cancel()
+        for prompt in prompts:
+            prompt.cancel()
+        job.product_info = product_info
+        metrics.GENERATIONS.labels("success" if delivered else "failed").inc()
+        metrics.STAGE_SECONDS.labels("generation").observe(loop.time() - started)
+        if delivered:
+            if not committed:
+                await commit()
+        elif not cancelled or job.refund_on_cancel:
+            await db.refund_generation(job.reservation)
+    return delivered
 
 
 async def handle_text(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
@@ -478,21 +1413,138 @@ async def handle_text(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
 # ЗАПУСК
 # ─────────────────────────────────────────────
 
-def main():
-    logger.info("Запуск SnapSell Bot...")
-    app = Application.builder().token(config.BOT_TOKEN).build()
+async def db_maintenance():
+    """Раз в сутки — чистка старых строк generations (агрегаты статистики остаются)."""
+    while True:
+        if config.GENERATIONS_KEEP_DAYS > 0:
+            try:
+                removed = await db.purge_generations(config.GENERATIONS_KEEP_DAYS)
+                if removed:
+                    logger.info(f"Purged {removed} generations older than {config.GENERATIONS_KEEP_DAYS} days")
+            except Exception as e:
+                logger.error(f"DB maintenance error: {e}")
+        await asyncio.sleep(24 * 3600)
+
+
+async def watch_jobs(interval: float = 5.0):
+    """Обновляет job_counts для метрики snapsell_jobs (режим JOB_QUEUE)."""
+    while True:
+        try:
+            counts = await db.count_jobs()
+            job_counts.update({status: counts.get(status, 0) for status in job_counts})
+        except Exception as e:
+            logger.error(f"Job count error: {e}")
+        await asyncio.sleep(interval)
+
+
+# Покупка PRO будит планировщик истечений — новый срок может быть ближайшим
+pro_changed = asyncio.Event()
+
+
+async def pro_expiry():
+    """
+    Истёкшие PRO переводятся в free одним UPDATE в момент ближайшего истечения.
+    Пока срок не наступил, БД не трогаем; чтения уже считают истёкший PRO бесплатным.
+    Сон ограничен часом — покупку в другом процессе (шарде) увидим не позже.
+    """
+    while True:
+        try:
+            next_expiry = await db.expire_pro()
+        except Exception as e:
+            logger.error(f"PRO expiry error: {e}")
+            next_expiry = None
+        delay = 3600.0
+        if next_expiry:
+            until = (datetime.fromisoformat(next_expiry) - datetime.utcnow()).total_seconds()
+            delay = min(delay, max(1.0, until))
+        pro_changed.clear()
+        try:
+            await asyncio.wait_for(pro_changed.wait(), timeout=delay)
+        except asyncio.TimeoutError:
+            pass
+
+
+async def on_startup(app: Application):
+    await http.start()
+    await scheduler.start()
+    app.bot_data["maintenance"] = asyncio.create_task(db_maintenance())
+    app.bot_data["pro_expiry"] = asyncio.create_task(pro_expiry())
+    if config.JOB_QUEUE:
+        app.bot_data["watch_jobs"] = asyncio.create_task(watch_jobs())
+    if config.METRICS_PORT:
+        app.bot_data["metrics_server"] = await metrics.start_server(config.METRICS_LISTEN, config.METRICS_PORT)
+
+
+async def on_shutdown(app: Application):
+    for name in ("maintenance", "pro_expiry", "watch_jobs"):
+        task = app.bot_data.pop(name, None)
+        if task:
+            task.cancel()
+    metrics_server = app.bot_data.pop("metrics_server", None)
+    if metrics_server:
+        metrics_server.close()
+    await scheduler.stop()
+    await http.close()
+    image_pool.shutdown(wait=False, cancel_futures=True)
+    db.close()
+
+
+def make_rate_limiter(processes: int = 1, worker: bool = False) -> TelegramRateLimiter | None:
+    """
+    processes — сколько процессов делят долю этой группы (шарды вебхука или
+    процессы worker.py); worker — лимитер для worker.py.
+    """
+    if not config.TELEGRAM_RATE_LIMIT:
+        return None
+    if worker:
+        share = config.TELEGRAM_WORKER_SHARE
+    else:
+        share = 1 - config.TELEGRAM_WORKER_SHARE if config.JOB_QUEUE else 1.0
+    return TelegramRateLimiter(
+        global_rate=config.TELEGRAM_GLOBAL_RATE * share / max(1, processes),
+        chat_rate=config.TELEGRAM_CHAT_RATE,
+        chat_burst=config.TELEGRAM_CHAT_BURST,
+        group_rate=config.TELEGRAM_GROUP_RATE,
+        max_retries=config.TELEGRAM_MAX_RETRIES,
+    )
+
+
+def build_application(updater: bool = True, processes: int = 1) -> Application:
+    """
+    Приложение со всеми хендлерами; без updater — для шардов вебхука.
+    processes — число шардов, делящих лимит запросов к Telegram.
+    """
+    builder = (
+        Application.builder()
+        .token(config.BOT_TOKEN)
+        .base_url(config.TELEGRAM_BASE_URL)
+        .base_file_url(config.TELEGRAM_FILE_URL)
+        # Апдейты обрабатываются параллельно, порядок для одного пользователя не
+        # гарантируется (хендлер фото ждёт всю генерацию); очередь генераций — в scheduler
+        .concurrent_updates(True)
+        .post_init(on_startup)
+        .post_shutdown(on_shutdown)
+    )
+    if not updater:
+        builder = builder.updater(None)
+    limiter = make_rate_limiter(processes)
+    if limiter:
+        builder = builder.rate_limiter(limiter)
+    app = builder.build()
 
     # Команды
     app.add_handler(CommandHandler("start",   cmd_start))
     app.add_handler(CommandHandler("help",    cmd_help))
     app.add_handler(CommandHandler("balance", cmd_balance))
     app.add_handler(CommandHandler("plans",   cmd_plans))
+    app.add_handler(CommandHandler("format",  cmd_format))
+    app.add_handler(CommandHandler("admin",   cmd_admin))
 
     # Фото
     app.add_handler(MessageHandler(filters.PHOTO, handle_photo))
 
     # Документы как фото (некоторые клиенты отправляют так)
-    app.add_handler(MessageHandler(filters.Document.IMAGE, handle_photo))
+    app.add_handler(MessageHandler(filters.Document.IMAGE, handle_document))
 
     # Кнопки
     app.add_handler(CallbackQueryHandler(cb_handler))
@@ -503,8 +1555,14 @@ def main():
 
     # Любой текст
     app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_text))
+    return app
+
 
-    app.run_polling(drop_pending_updates=True)
+def main():
+    logger.info("Запуск SnapSell Bot...")
+    app = build_application()
+    # Накопившиеся за время рестарта апдейты по умолчанию не выбрасываем
+    app.run_polling(drop_pending_updates=config.DROP_PENDING_UPDATES)
 
 
 if __name__ == "__main__":
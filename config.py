@@ -19,11 +19,125 @@ class Config:
     # ID администратора (для команды /admin)
     ADMIN_ID:         int = int(os.getenv("ADMIN_ID", "0"))
 
+    # ── База данных ──────────────────────────────────────────
+    DB_PATH:          str = os.getenv("DB_PATH", "snapsell.db")
+    # Потоки, в которых хэндлеры выполняют запросы к SQLite
+    DB_THREADS:       int = int(os.getenv("DB_THREADS", "4"))
+    # Кэш строк users в памяти: размер (0 — выключен) и TTL в секундах
+    USER_CACHE_SIZE:  int   = int(os.getenv("USER_CACHE_SIZE", "10000"))
+    USER_CACHE_TTL:   float = float(os.getenv("USER_CACHE_TTL", "300"))
+    # Отложенная запись журнала генераций и отметок кэшей: интервал (0 — сразу) и размер пачки
+    DB_FLUSH_INTERVAL: float = float(os.getenv("DB_FLUSH_INTERVAL", "1.0"))
+    DB_FLUSH_SIZE:     int   = int(os.getenv("DB_FLUSH_SIZE", "200"))
+    # Кэш анализов Gemini в SQLite (LRU по размеру), МБ
+    ANALYSIS_CACHE_MB: int  = int(os.getenv("ANALYSIS_CACHE_MB", "50"))
+    # Кэш готовых сцен: file_id в SQLite + (опционально) JPEG на диске
+    RENDER_CACHE_ENTRIES: int = int(os.getenv("RENDER_CACHE_ENTRIES", "10000"))
+    RENDER_CACHE_DIR:     str = os.getenv("RENDER_CACHE_DIR", "render_cache")
+    RENDER_CACHE_DISK_MB: int = int(os.getenv("RENDER_CACHE_DISK_MB", "0"))  # 0 — не хранить байты
+    # Строки generations старше — удаляются (статистика в stats_daily остаётся); 0 — хранить всё
+    GENERATIONS_KEEP_DAYS: int = int(os.getenv("GENERATIONS_KEEP_DAYS", "365"))
+
+    # ── Очередь генераций ────────────────────────────────────
+    GENERATION_WORKERS:  int = int(os.getenv("GENERATION_WORKERS", "8"))   # одновременных генераций
+    GENERATION_PER_USER: int = int(os.getenv("GENERATION_PER_USER", "1"))  # из них на одного пользователя
+
+    # Выполнять генерации в отдельных процессах worker.py через таблицу jobs
+    JOB_QUEUE:           bool  = os.getenv("JOB_QUEUE", "0") == "1"
+    WORKER_PROCESSES:    int   = int(os.getenv("WORKER_PROCESSES", "2"))
+    WORKER_CONCURRENCY:  int   = int(os.getenv("WORKER_CONCURRENCY", "4"))   # задач на процесс
+    JOB_LEASE:           float = float(os.getenv("JOB_LEASE", "60"))         # аренда задачи, сек
+    JOB_MAX_ATTEMPTS:    int   = int(os.getenv("JOB_MAX_ATTEMPTS", "3"))
+    JOB_POLL_INTERVAL:   float = float(os.getenv("JOB_POLL_INTERVAL", "0.5"))
+
+    # ── Альбомы: несколько товаров одним сообщением ─────────
+    ALBUM_BATCH:       bool  = os.getenv("ALBUM_BATCH", "1") == "1"
+    ALBUM_WINDOW:      float = float(os.getenv("ALBUM_WINDOW", "1.5"))  # с, ждём остальные фото альбома
+    ALBUM_CONCURRENCY: int   = int(os.getenv("ALBUM_CONCURRENCY", "3"))  # товаров альбома одновременно
+
+    # ── Генерация сцен (Pollinations) ────────────────────────
+    # Стартовый и минимальный лимит одновременных запросов (дальше — AIMD)
+    POLLINATIONS_CONCURRENCY:     int = int(os.getenv("POLLINATIONS_CONCURRENCY", "16"))
+    POLLINATIONS_MIN_CONCURRENCY: int = int(os.getenv("POLLINATIONS_MIN_CONCURRENCY", "2"))
+    RENDER_RETRIES:      int   = int(os.getenv("RENDER_RETRIES", "3"))
+    # Через сколько секунд отправляем готовые сцены, не дожидаясь остальных
+    SCENE_DEADLINE:      float = float(os.getenv("SCENE_DEADLINE", "90"))
+    # Сколько ещё ждём опоздавшие и перезапущенные сцены
+    SCENE_LATE_DEADLINE: float = float(os.getenv("SCENE_LATE_DEADLINE", "120"))
+    # Бесплатных перегенераций отдельной сцены («🔄») на одну генерацию; 0 — без кнопок
+    SCENE_REGENERATIONS: int   = int(os.getenv("SCENE_REGENERATIONS", "4"))
+    # Отправлять каждую сцену сразу по готовности (иначе — одним альбомом)
+    STREAM_SCENES:       bool  = os.getenv("STREAM_SCENES", "1") == "1"
+    # После потоковой отправки — ещё и общий альбом из уже загруженных фото
+    STREAM_FINAL_ALBUM:  bool  = os.getenv("STREAM_FINAL_ALBUM", "0") == "1"
+
+    # ── Входное фото для анализа ────────────────────────────
+    # Берём наименьший PhotoSize с меньшей стороной не меньше ANALYSIS_MIN_SIDE
+    ANALYSIS_MIN_SIDE:  int = int(os.getenv("ANALYSIS_MIN_SIDE", "768"))
+    # Больше — уменьшаем до ANALYSIS_MAX_SIDE и перекодируем в JPEG
+    ANALYSIS_MAX_SIDE:  int = int(os.getenv("ANALYSIS_MAX_SIDE", "1024"))
+    ANALYSIS_MAX_BYTES: int = int(os.getenv("ANALYSIS_MAX_BYTES", "400000"))
+    MAX_DOCUMENT_MB:    int = int(os.getenv("MAX_DOCUMENT_MB", "20"))  # лимит getFile в Bot API
+    IMAGE_WORKERS:      int = int(os.getenv("IMAGE_WORKERS", "2"))     # процессы для обработки фото
+
+    # ── HTTP-клиенты внешних API ─────────────────────────────
+    TELEGRAM_BASE_URL:      str   = os.getenv("TELEGRAM_BASE_URL", "https://api.telegram.org/bot")
+    TELEGRAM_FILE_URL:      str   = os.getenv("TELEGRAM_FILE_URL", "https://api.telegram.org/file/bot")
+    GEMINI_BASE_URL:        str   = os.getenv("GEMINI_BASE_URL", "https://generativelanguage.googleapis.com")
+    POLLINATIONS_BASE_URL:  str   = os.getenv("POLLINATIONS_BASE_URL", "https://image.pollinations.ai")
+    GEMINI_TIMEOUT:         float = float(os.getenv("GEMINI_TIMEOUT", "60"))
+    POLLINATIONS_TIMEOUT:   float = float(os.getenv("POLLINATIONS_TIMEOUT", "120"))
+    HTTP_CONNECT_TIMEOUT:   float = float(os.getenv("HTTP_CONNECT_TIMEOUT", "10"))
+    GEMINI_MAX_CONNECTIONS:       int = int(os.getenv("GEMINI_MAX_CONNECTIONS", "20"))
+    POLLINATIONS_MAX_CONNECTIONS: int = int(os.getenv("POLLINATIONS_MAX_CONNECTIONS", "40"))
+    HTTP_MAX_KEEPALIVE:     int   = int(os.getenv("HTTP_MAX_KEEPALIVE", "20"))
+    HTTP_KEEPALIVE_EXPIRY:  float = float(os.getenv("HTTP_KEEPALIVE_EXPIRY", "30"))
+    # HTTP/2 требует: pip install "httpx[http2]"
+    HTTP2:                  bool  = os.getenv("HTTP2", "0") == "1"
+    # Потоковый ответ Gemini: генерация сцен стартует до конца анализа
+    GEMINI_STREAM:          bool  = os.getenv("GEMINI_STREAM", "1") == "1"
+    # full — Gemini пишет промты всех сцен; compact — только атрибуты товара
+    # по строгой схеме, промты собираются из шаблонов (в ~5 раз меньше токенов)
+    ANALYSIS_MODE:          str   = os.getenv("ANALYSIS_MODE", "full")
+
+    # ── Исходящие запросы к Telegram ────────────────────────
+    # Лимиты Bot API: ~30 сообщений/с на бота, ~1/с в личный чат, 20/мин в группу.
+    # Глобальный лимит — один на все процессы: с JOB_QUEUE доля TELEGRAM_WORKER_SHARE
+    # у worker.py (доставка сцен), остальное — у бота; внутри группы делится поровну
+    TELEGRAM_RATE_LIMIT:  bool  = os.getenv("TELEGRAM_RATE_LIMIT", "1") == "1"
+    TELEGRAM_GLOBAL_RATE: float = float(os.getenv("TELEGRAM_GLOBAL_RATE", "30"))
+    TELEGRAM_WORKER_SHARE: float = float(os.getenv("TELEGRAM_WORKER_SHARE", "0.8"))
+    TELEGRAM_CHAT_RATE:   float = float(os.getenv("TELEGRAM_CHAT_RATE", "1"))
+    TELEGRAM_CHAT_BURST:  int   = int(os.getenv("TELEGRAM_CHAT_BURST", "8"))   # сообщений подряд в чат
+    TELEGRAM_GROUP_RATE:  float = float(os.getenv("TELEGRAM_GROUP_RATE", "0.33"))
+    TELEGRAM_MAX_RETRIES: int   = int(os.getenv("TELEGRAM_MAX_RETRIES", "3"))  # повторов после RetryAfter
+
+    # ── Метрики (Prometheus, GET /metrics) ──────────────────
+    # 0 — выключено; шард вебхука i слушает METRICS_PORT + i
+    METRICS_PORT:        int = int(os.getenv("METRICS_PORT", "0"))
+    METRICS_LISTEN:      str = os.getenv("METRICS_LISTEN", "127.0.0.1")
+    # Воркеры worker.py: процесс i слушает WORKER_METRICS_PORT + i
+    WORKER_METRICS_PORT: int = int(os.getenv("WORKER_METRICS_PORT", "0"))
+
+    # ── Приём апдейтов ───────────────────────────────────────
+    DROP_PENDING_UPDATES: bool = os.getenv("DROP_PENDING_UPDATES", "0") == "1"
+    # Вебхук (python webhook.py): публичный https-адрес, например https://bot.example.com/telegram
+    WEBHOOK_URL:     str = os.getenv("WEBHOOK_URL", "")
+    WEBHOOK_LISTEN:  str = os.getenv("WEBHOOK_LISTEN", "0.0.0.0")
+    WEBHOOK_PORT:    int = int(os.getenv("WEBHOOK_PORT", "8080"))
+    WEBHOOK_PATH:    str = os.getenv("WEBHOOK_PATH", "/telegram")
+    # Проверяется в X-Telegram-Bot-Api-Secret-Token; пусто — генерируется при старте
+    WEBHOOK_SECRET:  str = os.getenv("WEBHOOK_SECRET", "")
+    WEBHOOK_SHARDS:  int = int(os.getenv("WEBHOOK_SHARDS", "2"))   # процессы-обработчики
+    WEBHOOK_MAX_CONNECTIONS: int = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", "40"))
+
     def validate(self):
         if not self.BOT_TOKEN:
             raise ValueError("BOT_TOKEN не задан!")
         if not self.GEMINI_API_KEY:
             raise ValueError("GEMINI_API_KEY не задан!")
+        if self.JOB_QUEUE and not 0 < self.TELEGRAM_WORKER_SHARE < 1:
+            raise ValueError("TELEGRAM_WORKER_SHARE должен быть между 0 и 1")
 
 
 config = Config()
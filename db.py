@@ -2,27 +2,355 @@
 База данных SnapSell Bot — SQLite (без внешних зависимостей)
 """
 
+import asyncio
+import functools
+import json
+import logging
 import sqlite3
 import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from dataclasses import dataclass
 from datetime import datetime, timedelta
+from typing import Callable
+
+logger = logging.getLogger(__name__)
+
+# Действующий план в SQL: истёкший PRO считается бесплатным
+_EFFECTIVE_PLAN = (
+    "CASE WHEN plan = 'pro' AND pro_until IS NOT NULL AND pro_until <= :now "
+    "THEN 'free' ELSE plan END"
+)
+
+
+# Статистика для /admin: таблицы и триггеры (по одному выражению — внутри транзакции миграции)
+_STATS_SCHEMA = (
+    """
+    -- Счётчики для /admin: поддерживаются триггерами, чтение — O(1)
+    CREATE TABLE IF NOT EXISTS stats_counters (
+        name   TEXT PRIMARY KEY,
+        value  INTEGER NOT NULL DEFAULT 0
+    )
+    """,
+    """
+    -- Дневные агрегаты по плану; переживают чистку старых generations
+    CREATE TABLE IF NOT EXISTS stats_daily (
+        day          TEXT NOT NULL,
+        plan         TEXT NOT NULL,
+        generations  INTEGER NOT NULL DEFAULT 0,
+        new_users    INTEGER NOT NULL DEFAULT 0,
+        purchases    INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (day, plan)
+    )
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS trg_stats_gen AFTER INSERT ON generations
+    BEGIN
+        UPDATE stats_counters SET value = value + 1 WHERE name = 'total_gens';
+        INSERT INTO stats_daily (day, plan, generations)
+        VALUES (date(NEW.created_at), NEW.plan, 1)
+        ON CONFLICT(day, plan) DO UPDATE SET generations = generations + 1;
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS trg_stats_user AFTER INSERT ON users
+    BEGIN
+        UPDATE stats_counters SET value = value + 1 WHERE name = 'total_users';
+        UPDATE stats_counters SET value = value + 1
+        WHERE name = 'paid_users' AND NEW.plan != 'free';
+        INSERT INTO stats_daily (day, plan, new_users)
+        VALUES (date(NEW.created_at), NEW.plan, 1)
+        ON CONFLICT(day, plan) DO UPDATE SET new_users = new_users + 1;
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS trg_stats_plan AFTER UPDATE OF plan ON users
+    WHEN (OLD.plan = 'free') != (NEW.plan = 'free')
+    BEGIN
+        UPDATE stats_counters
+        SET value = value + (CASE WHEN NEW.plan = 'free' THEN -1 ELSE 1 END)
+        WHERE name = 'paid_users';
+    END
+    """,
+)
+
+
+@dataclass
+class Account:
+    """Снимок аккаунта: действующий план, счётчики и срок PRO."""
+    user_id:   int
+    plan:      str = "free"
+    free_uses: int = 0
+    paid_left: int = 0
+    pro_until: str | None = None
+    preset:    str = ""          # формат файлов для маркетплейса (postprocess.PRESETS)
+
+    @property
+    def free_left(self) -> int:
+        from config import config
+        return max(0, config.FREE_GENERATIONS - self.free_uses)
+
+    @property
+    def can_generate(self) -> bool:
+        if self.plan == "pro":
+            return True
+        if self.plan == "basic":
+            return self.paid_left > 0
+        return self.free_left > 0
+
+
+@dataclass
+class Reservation:
+    """Зарезервированная генерация. charged — с какого плана списали (pro — без списания)."""
+    user_id: int
+    charged: str
+    account: Account
+
+
+class _LRUCache:
+    """
+    Потокобезопасный LRU-кэш с TTL.
+    epoch растёт при каждой инвалидации и записи: читатель, прочитавший
+    строку до чужой записи, не положит в кэш устаревшее значение.
+    """
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.epoch = 0
+        self._data: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return None
+            expires, value = item
+            if expires < time.monotonic():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def put(self, key, value, epoch: int | None = None):
+        """epoch=None — значение только что записано в БД и заведомо актуально."""
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            if epoch is None:
+                self.epoch += 1
+            elif epoch != self.epoch:
+                return
+            self._data[key] = (time.monotonic() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def invalidate(self, key):
+        with self._lock:
+            self.epoch += 1
+            self._data.pop(key, None)
 
 
 class Database:
-    def __init__(self, db_path: str = "snapsell.db"):
+    """
+    Одно соединение-писатель (под self._lock) и по одному соединению-читателю
+    на поток. PRAGMA применяются один раз при открытии, подготовленные
+    выражения переиспользуются через кэш sqlite3 (cached_statements).
+    Строки users кэшируются в памяти (LRU + TTL) и обновляются при записи.
+
+    Журнал генераций и отметки использования кэшей пишутся отложенно:
+    копятся в памяти и уходят одной транзакцией раз в flush_interval секунд,
+    при flush_size записях, при close() — или вместе с ближайшей синхронной
+    записью (списание, возврат, покупка). Поэтому после сбоя в БД всегда
+    лежит префикс истории операций: отложенная запись не может потеряться,
+    если сохранилась любая более поздняя синхронная. flush_interval=0 — без буфера.
+    """
+
+    STATEMENT_CACHE = 128
+
+    def __init__(self, db_path: str = "snapsell.db", user_cache_size: int = 10000,
+                 user_cache_ttl: float = 300, analysis_cache_bytes: int = 50 * 1024 * 1024,
+                 flush_interval: float = 1.0, flush_size: int = 200):
         self.db_path = db_path
+        self._users = _LRUCache(user_cache_size, user_cache_ttl)
+        self.analysis_cache_bytes = analysis_cache_bytes
+        self.cache_counters = {
+            "analysis_hits": 0, "analysis_misses": 0,
+            "render_hits": 0, "render_misses": 0,
+        }
+        self._counters_lock = threading.Lock()
         self._lock = threading.Lock()
+        self._local = threading.local()
+        self._readers: list[sqlite3.Connection] = []
+        self._readers_lock = threading.Lock()
+
+        # Буфер отложенных записей
+        self.flush_interval = flush_interval
+        self.flush_size = flush_size
+        self._pending_gens: list[tuple] = []
+        self._pending_touches: dict[tuple[str, str], list] = {}   # (таблица, key) → [hits, last_used]
+        self._buffer_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._closed = False
+
+        self._writer = self._connect()
         self._init_db()
+        self._flusher = None
+        if flush_interval > 0:
+            self._flusher = threading.Thread(target=self._flush_loop, name="db-flush", daemon=True)
+            self._flusher.start()
 
-    def _conn(self):
-        conn = sqlite3.connect(self.db_path, check_same_thread=False)
+    def _connect(self, readonly: bool = False) -> sqlite3.Connection:
+        conn = sqlite3.connect(
+            self.db_path, check_same_thread=False, cached_statements=self.STATEMENT_CACHE
+        )
         conn.row_factory = sqlite3.Row
+        # Таймаут — до смены журнала: её тоже ждут процессы, стартующие одновременно
+        conn.execute("PRAGMA busy_timeout=5000")
         conn.execute("PRAGMA journal_mode=WAL")
         conn.execute("PRAGMA foreign_keys=ON")
+        if readonly:
+            conn.execute("PRAGMA query_only=ON")
         return conn
 
+    def _read(self) -> sqlite3.Connection:
+        """Соединение-читатель текущего потока (создаётся при первом обращении)."""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._connect(readonly=True)
+            self._local.conn = conn
+            with self._readers_lock:
+                self._readers.append(conn)
+        return conn
+
+    @contextmanager
+    def _write(self):
+        """
+        Транзакция на соединении-писателе: commit при выходе, rollback при ошибке.
+        Накопленные отложенные записи применяются в начале той же транзакции.
+        """
+        with self._lock:
+            gens, touches = self._take_pending()
+            try:
+                with self._writer:
+                    self._apply_pending(self._writer, gens, touches)
+                    yield self._writer
+            except BaseException:
+                self._restore_pending(gens, touches)
+                raise
+
+    # ── Отложенные записи ──
+
+    def _take_pending(self) -> tuple[list, dict]:
+        with self._buffer_lock:
+            gens, self._pending_gens = self._pending_gens, []
+            touches, self._pending_touches = self._pending_touches, {}
+        return gens, touches
+
+    def _restore_pending(self, gens: list, touches: dict):
+        """Транзакция откатилась — возвращаем записи в начало буфера."""
+        with self._buffer_lock:
+            self._pending_gens[:0] = gens
+            for key, (hits, last_used) in touches.items():
+                self._merge_touch(key, hits, last_used)
+
+    def _merge_touch(self, key: tuple[str, str], hits: int, last_used: float):
+        item = self._pending_touches.get(key)
+        if item is None:
+            self._pending_touches[key] = [hits, last_used]
+        else:
+            item[0] += hits
+            item[1] = max(item[1], last_used)
+
+    @staticmethod
+    def _apply_pending(conn: sqlite3.Connection, gens: list, touches: dict):
+        if not gens and not touches:
+            return
+        # Явный BEGIN: иначе RELEASE внешней точки сохранения закоммитит раньше времени
+        if not conn.in_transaction:
+            conn.execute("BEGIN")
+        insert = (
+            "INSERT INTO generations (user_id, product, plan, created_at, ref, scenes, product_info) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)"
+        )
+        conn.execute("SAVEPOINT pending")
+        try:
+            conn.executemany(insert, gens)
+        except sqlite3.IntegrityError:
+            # Битая строка не должна навсегда блокировать все последующие транзакции:
+            # пишем по одной и пропускаем только её
+            conn.execute("ROLLBACK TO pending")
+            for gen in gens:
+                try:
+                    conn.execute(insert, gen)
+                except sqlite3.IntegrityError as e:
+                    logger.error(f"Dropped buffered generation {gen}: {e}")
+        conn.execute("RELEASE pending")
+        for table in ("analysis_cache", "render_cache"):
+            rows = [(hits, last_used, key) for (t, key), (hits, last_used) in touches.items() if t == table]
+            if rows:
+                conn.executemany(
+                    f"UPDATE {table} SET hits = hits + ?, last_used = MAX(last_used, ?) WHERE key = ?",
+                    rows
+                )
+
+    def _buffer(self, gen: tuple | None = None, touch: tuple[str, str] | None = None):
+        """Ставит запись в буфер; без буфера (flush_interval=0) — пишет сразу."""
+        if self._flusher is None or self._closed:
+            with self._write() as conn:
+                self._apply_pending(conn, [gen] if gen else [], {touch: [1, time.time()]} if touch else {})
+            return
+        with self._buffer_lock:
+            if gen:
+                self._pending_gens.append(gen)
+            if touch:
+                self._merge_touch(touch, 1, time.time())
+            size = len(self._pending_gens) + len(self._pending_touches)
+        if size >= self.flush_size:
+            self._wake.set()
+
+    def flush(self):
+        """Записывает накопленное одной транзакцией."""
+        with self._buffer_lock:
+            if not self._pending_gens and not self._pending_touches:
+                return
+        with self._write():
+            pass
+
+    def _flush_loop(self):
+        while not self._closed:
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                # Записи остались в буфере — повторим на следующем цикле
+                logger.error(f"DB flush failed: {e}")
+
+    def close(self):
+        self._closed = True
+        if self._flusher is not None:
+            self._wake.set()
+            self._flusher.join()
+        self.flush()
+        with self._readers_lock:
+            for conn in self._readers:
+                conn.close()
+            self._readers.clear()
+        with self._lock:
+            self._writer.close()
+
     def _init_db(self):
-        with self._lock, self._conn() as conn:
+        # Схема и миграции — одной транзакцией BEGIN IMMEDIATE: воркеры и шарды
+        # стартуют одновременно, второй процесс ждёт и видит уже готовую схему
+        with self._write() as conn:
             conn.executescript("""
+                BEGIN IMMEDIATE;
+
                 CREATE TABLE IF NOT EXISTS users (
                     user_id     INTEGER PRIMARY KEY,
                     username    TEXT DEFAULT '',
@@ -44,10 +372,130 @@ class Database:
                 );
 
                 CREATE INDEX IF NOT EXISTS idx_gen_user ON generations(user_id);
+
+                -- Кэш анализов Gemini: ключ — file_unique_id или SHA-256 изображения
+                CREATE TABLE IF NOT EXISTS analysis_cache (
+                    key         TEXT PRIMARY KEY,
+                    result      TEXT NOT NULL,
+                    size        INTEGER NOT NULL,
+                    hits        INTEGER DEFAULT 0,
+                    last_used   REAL NOT NULL,
+                    created_at  TEXT DEFAULT (datetime('now'))
+                );
+
+                CREATE INDEX IF NOT EXISTS idx_analysis_lru ON analysis_cache(last_used);
+
+                -- Кэш готовых сцен: file_id в Telegram и (опционально) файл на диске
+                CREATE TABLE IF NOT EXISTS render_cache (
+                    key         TEXT PRIMARY KEY,
+                    file_id     TEXT DEFAULT NULL,
+                    path        TEXT DEFAULT NULL,
+                    size        INTEGER DEFAULT 0,
+                    hits        INTEGER DEFAULT 0,
+                    last_used   REAL NOT NULL,
+                    created_at  TEXT DEFAULT (datetime('now'))
+                );
+
+                CREATE INDEX IF NOT EXISTS idx_render_lru ON render_cache(last_used);
+
+                -- Очередь генераций для процессов worker.py
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id                INTEGER PRIMARY KEY AUTOINCREMENT,
+                    user_id           INTEGER NOT NULL,
+                    chat_id           INTEGER NOT NULL,
+                    message_id        INTEGER NOT NULL,
+                    status_message_id INTEGER NOT NULL,
+                    file_id           TEXT NOT NULL,
+                    file_unique_id    TEXT NOT NULL,
+                    is_document       INTEGER DEFAULT 0,
+                    charged           TEXT NOT NULL,
+                    priority          INTEGER DEFAULT 0,
+                    status            TEXT DEFAULT 'queued',
+                    attempts          INTEGER DEFAULT 0,
+                    worker            TEXT DEFAULT NULL,
+                    lease_until       REAL DEFAULT NULL,
+                    error             TEXT DEFAULT NULL,
+                    created_at        TEXT DEFAULT (datetime('now')),
+                    updated_at        TEXT DEFAULT (datetime('now'))
+                );
+
+                CREATE INDEX IF NOT EXISTS idx_jobs_claim ON jobs(status, priority, id);
+                -- Незавершённая задача того же фото — повтор не ставится в очередь
+                CREATE INDEX IF NOT EXISTS idx_jobs_active ON jobs(user_id, file_unique_id)
+                    WHERE status IN ('queued', 'running');
             """)
+            self._migrate(conn)
+
+    def _migrate(self, conn: sqlite3.Connection):
+        """Досоздаёт колонки и таблицы, которых нет в базах старых версий (внутри транзакции _init_db)."""
+        columns = {r["name"] for r in conn.execute("PRAGMA table_info(generations)")}
+        if "plan" not in columns:
+            conn.execute("ALTER TABLE generations ADD COLUMN plan TEXT DEFAULT ''")
+        # ref — ссылка на генерацию из кнопок, scenes — JSON {сцена: file_id}
+        if "ref" not in columns:
+            conn.execute("ALTER TABLE generations ADD COLUMN ref TEXT DEFAULT NULL")
+        if "scenes" not in columns:
+            conn.execute("ALTER TABLE generations ADD COLUMN scenes TEXT DEFAULT NULL")
+        # Анализ товара (JSON) — перегенерация одной сцены без Gemini; regens — сколько уже было
+        if "product_info" not in columns:
+            conn.execute("ALTER TABLE generations ADD COLUMN product_info TEXT DEFAULT NULL")
+        if "regens" not in columns:
+            conn.execute("ALTER TABLE generations ADD COLUMN regens INTEGER NOT NULL DEFAULT 0")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_gen_created ON generations(created_at)")
+        conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_gen_ref ON generations(ref) WHERE ref IS NOT NULL")
+
+        user_columns = {r["name"] for r in conn.execute("PRAGMA table_info(users)")}
+        if "preset" not in user_columns:
+            conn.execute("ALTER TABLE users ADD COLUMN preset TEXT DEFAULT ''")
+        # Ближайшее окончание PRO и пачка истёкших — без полного прохода по users
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_users_pro_until ON users(pro_until) WHERE plan = 'pro'")
+
+        seeded = conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'stats_counters'"
+        ).fetchone()
+        for statement in _STATS_SCHEMA:
+            conn.execute(statement)
+        if not seeded:
+            # Первый запуск со статистикой — заполняем агрегаты по уже накопленным данным
+            conn.execute("""
+                INSERT OR REPLACE INTO stats_counters (name, value)
+                SELECT 'total_users', COUNT(*) FROM users
+                UNION ALL SELECT 'paid_users', COUNT(*) FROM users WHERE plan != 'free'
+                UNION ALL SELECT 'total_gens', COUNT(*) FROM generations
+            """)
+            conn.execute("""
+                INSERT OR REPLACE INTO stats_daily (day, plan, generations, new_users)
+                SELECT day, plan, SUM(gens), SUM(users) FROM (
+                    SELECT date(created_at) AS day, plan, COUNT(*) AS gens, 0 AS users
+                    FROM generations GROUP BY 1, 2
+                    UNION ALL
+                    SELECT date(created_at), 'free', 0, COUNT(*)
+                    FROM users GROUP BY 1
+                ) GROUP BY day, plan
+            """)
+
+    def _user_row(self, user_id: int, cached: bool = True) -> dict | None:
+        """Строка users из кэша, при промахе (или cached=False) — из БД."""
+        row = self._users.get(user_id) if cached else None
+        if row is not None:
+            return row
+        epoch = self._users.epoch
+        found = self._read().execute("""
+            SELECT username, first_name, plan, free_uses, paid_left, pro_until, preset
+            FROM users WHERE user_id = ?
+        """, (user_id,)).fetchone()
+        if not found:
+            return None
+        row = dict(found)
+        self._users.put(user_id, row, epoch=epoch)
+        return row
 
     def ensure_user(self, user_id: int, username: str = "", first_name: str = ""):
-        with self._lock, self._conn() as conn:
+        """Создаёт пользователя; пишет в БД только если профиль изменился."""
+        row = self._user_row(user_id)
+        if row is not None and row["username"] == username and row["first_name"] == first_name:
+            return
+        with self._write() as conn:
             conn.execute("""
                 INSERT INTO users (user_id, username, first_name)
                 VALUES (?, ?, ?)
@@ -56,76 +504,106 @@ class Database:
                     first_name = excluded.first_name,
                     updated_at = datetime('now')
             """, (user_id, username, first_name))
-
-    def get_uses(self, user_id: int) -> int:
-        with self._conn() as conn:
-            row = conn.execute(
-                "SELECT free_uses FROM users WHERE user_id = ?", (user_id,)
-            ).fetchone()
-        return row["free_uses"] if row else 0
+        self._users.invalidate(user_id)
 
     def get_plan(self, user_id: int) -> str:
-        with self._conn() as conn:
-            row = conn.execute(
-                "SELECT plan, pro_until FROM users WHERE user_id = ?", (user_id,)
-            ).fetchone()
+        """Только чтение: истёкший PRO — уже free, строку переписывает expire_pro()."""
+        return self.get_account(user_id).plan
+
+    # ── Аккаунт и списание генераций ──
+
+    def get_account(self, user_id: int, cached: bool = True) -> Account:
+        """
+        План, счётчики и срок PRO одним запросом (или из кэша, без записи в БД).
+        cached=False — мимо кэша: строку менял другой процесс (списание в боте для worker.py).
+        """
+        row = self._user_row(user_id, cached)
         if not row:
-            return "free"
-        if row["plan"] == "pro" and row["pro_until"]:
-            if datetime.fromisoformat(row["pro_until"]) > datetime.utcnow():
-                return "pro"
-            else:
-                # PRO истёк
-                self._expire_pro(user_id)
-                return "free"
-        return row["plan"]
-
-    def _expire_pro(self, user_id: int):
-        with self._lock, self._conn() as conn:
-            conn.execute(
-                "UPDATE users SET plan='free', pro_until=NULL, updated_at=datetime('now') WHERE user_id=?",
-                (user_id,)
-            )
+            return Account(user_id)
+        plan = row["plan"]
+        # Даты в формате isoformat сравниваются как строки
+        if plan == "pro" and row["pro_until"] and row["pro_until"] <= datetime.utcnow().isoformat():
+            plan = "free"
+        return Account(user_id, plan, row["free_uses"], row["paid_left"], row["pro_until"], row["preset"])
 
-    def get_paid_remaining(self, user_id: int) -> int:
-        with self._conn() as conn:
-            row = conn.execute(
-                "SELECT paid_left FROM users WHERE user_id = ?", (user_id,)
-            ).fetchone()
-        return row["paid_left"] if row else 0
+    def reserve_generation(self, user_id: int) -> Reservation | None:
+        """
+        Атомарно резервирует одну генерацию одним условным UPDATE.
+        Возвращает None, если лимит исчерпан — параллельные запросы
+        одного пользователя не могут пройти проверку оба.
+        """
+        reserved = self.reserve_generations(user_id, 1)
+        return reserved[0] if reserved else None
 
-    def can_generate(self, user_id: int) -> bool:
-        plan = self.get_plan(user_id)
-        if plan == "pro":
-            return True
-        if plan == "basic":
-            return self.get_paid_remaining(user_id) > 0
-        # free plan
+    def reserve_generations(self, user_id: int, count: int) -> list[Reservation]:
+        """
+        До count генераций одной транзакцией (альбом). Резервирует, сколько
+        позволяет баланс: длина списка меньше count — остаток не оплачен.
+        """
         from config import config
-        return self.get_uses(user_id) < config.FREE_GENERATIONS
+        params = {"user_id": user_id, "now": datetime.utcnow().isoformat(), "limit": config.FREE_GENERATIONS}
+        rows = []
+        with self._write() as conn:
+            for _ in range(count):
+                row = conn.execute(f"""
+                    UPDATE users SET
+                        free_uses  = free_uses + (CASE WHEN {_EFFECTIVE_PLAN} = 'free' THEN 1 ELSE 0 END),
+                        paid_left  = paid_left - (CASE WHEN {_EFFECTIVE_PLAN} = 'basic' THEN 1 ELSE 0 END),
+                        updated_at = datetime('now')
+                    WHERE user_id = :user_id AND (
+                        (plan = 'pro' AND (pro_until IS NULL OR pro_until > :now))
+                        OR (plan = 'basic' AND paid_left > 0)
+                        OR ({_EFFECTIVE_PLAN} = 'free' AND free_uses < :limit)
+                    )
+                    RETURNING username, first_name, plan, free_uses, paid_left, pro_until, preset,
+                              {_EFFECTIVE_PLAN} AS effective_plan
+                """, params).fetchone()
+                if not row:
+                    break
+                rows.append(dict(row))
+        reserved = []
+        for row in rows:
+            effective_plan = row.pop("effective_plan")
+            account = Account(
+                user_id, effective_plan, row["free_uses"], row["paid_left"], row["pro_until"], row["preset"]
+            )
+            reserved.append(Reservation(user_id, effective_plan, account))
+        if rows:
+            self._users.put(user_id, rows[-1])
+        return reserved
 
-    def increment_uses(self, user_id: int) -> int:
-        """Списываем одну генерацию. Возвращает новое кол-во free_uses."""
-        plan = self.get_plan(user_id)
-        with self._lock, self._conn() as conn:
-            if plan == "basic":
-                conn.execute(
-                    "UPDATE users SET paid_left = MAX(0, paid_left - 1), updated_at=datetime('now') WHERE user_id=?",
-                    (user_id,)
-                )
-            elif plan == "free":
-                conn.execute(
-                    "UPDATE users SET free_uses = free_uses + 1, updated_at=datetime('now') WHERE user_id=?",
-                    (user_id,)
-                )
-            # PRO — не списываем
-            row = conn.execute(
-                "SELECT free_uses FROM users WHERE user_id=?", (user_id,)
-            ).fetchone()
-        return row["free_uses"] if row else 0
+    def commit_generation(self, reservation: Reservation, product: str = "",
+                          ref: str | None = None, scenes: dict | None = None,
+                          product_info: dict | None = None, durable: bool = False):
+        """
+        Генерация доставлена — фиксируем её в журнале: file_id сцен для
+        повторной выдачи и анализ товара для перегенерации отдельных сцен.
+        durable — записать сразу, а не из буфера: строку прочитает другой
+        процесс (генерацию доставил worker.py, кнопку под ней обработает бот).
+        Читатели в этом процессе сами вызывают flush().
+        """
+        self.log_generation(reservation.user_id, product, reservation.charged, ref, scenes, product_info)
+        if durable:
+            self.flush()
+
+    def refund_generation(self, reservation: Reservation):
+        """Генерация не удалась — возвращаем списанное."""
+        if reservation.charged not in ("free", "basic"):
+            return
+        column = "free_uses = MAX(0, free_uses - 1)" if reservation.charged == "free" \
+            else "paid_left = paid_left + 1"
+        with self._write() as conn:
+            conn.execute(
+                f"UPDATE users SET {column}, updated_at=datetime('now') WHERE user_id=?",
+                (reservation.user_id,)
+            )
+        self._users.invalidate(reservation.user_id)
+
+    def can_generate(self, user_id: int) -> bool:
+        return self.get_account(user_id).can_generate
 
     def set_plan(self, user_id: int, plan: str, generations: int = 0, days: int = 0):
-        with self._lock, self._conn() as conn:
+        with self._write() as conn:
             if plan == "basic":
                 conn.execute("""
                     UPDATE users SET
@@ -143,29 +621,372 @@ class Database:
                         updated_at = datetime('now')
                     WHERE user_id = ?
                 """, (pro_until, user_id))
+            conn.execute("""
+                INSERT INTO stats_daily (day, plan, purchases) VALUES (date('now'), ?, 1)
+                ON CONFLICT(day, plan) DO UPDATE SET purchases = purchases + 1
+            """, (plan,))
+        self._users.invalidate(user_id)
+
+    def expire_pro(self) -> str | None:
+        """
+        Переводит все истёкшие PRO в free одним UPDATE по индексу.
+        Возвращает ближайший pro_until из оставшихся (None — PRO ни у кого нет).
+        """
+        now = datetime.utcnow().isoformat()
+        with self._write() as conn:
+            expired = conn.execute("""
+                UPDATE users SET plan = 'free', pro_until = NULL, updated_at = datetime('now')
+                WHERE plan = 'pro' AND pro_until <= ?
+                RETURNING user_id
+            """, (now,)).fetchall()
+            next_expiry = conn.execute(
+                "SELECT MIN(pro_until) FROM users WHERE plan = 'pro' AND pro_until IS NOT NULL"
+            ).fetchone()[0]
+        for row in expired:
+            self._users.invalidate(row["user_id"])
+        if expired:
+            logger.info(f"PRO expired for {len(expired)} users")
+        return next_expiry
+
+    def log_generation(self, user_id: int, product: str = "", plan: str = "",
+                       ref: str | None = None, scenes: dict | None = None,
+                       product_info: dict | None = None):
+        # Время фиксируем сейчас: строка может попасть в БД позже (отложенная запись)
+        created_at = datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")
+        scenes_json = json.dumps(scenes) if scenes else None
+        info_json = json.dumps(product_info, ensure_ascii=False) if product_info else None
+        self._buffer(gen=(user_id, product, plan, created_at, ref, scenes_json, info_json))
+
+    def get_generation(self, ref: str) -> dict | None:
+        """Генерация по ref: {"user_id", "product", "scenes": {сцена: file_id}}."""
+        self.flush()  # строка могла ещё не выйти из буфера
+        row = self._read().execute(
+            "SELECT user_id, product, scenes FROM generations WHERE ref = ?", (ref,)
+        ).fetchone()
+        if not row:
+            return None
+        return {
+            "user_id": row["user_id"],
+            "product": row["product"],
+            "scenes": {int(i): file_id for i, file_id in json.loads(row["scenes"] or "{}").items()},
+        }
+
+    def claim_regeneration(self, ref: str, user_id: int, limit: int) -> dict | None:
+        """
+        Списывает одну перегенерацию сцены из лимита генерации ref.
+        Возвращает {"product_info", "regens"} или None (чужая, старая, без анализа, лимит).
+        """
+        self.flush()
+        with self._write() as conn:
+            row = conn.execute("""
+                UPDATE generations SET regens = regens + 1
+                WHERE ref = ? AND user_id = ? AND product_info IS NOT NULL AND regens < ?
+                RETURNING product_info, regens
+            """, (ref, user_id, limit)).fetchone()
+        if not row:
+            return None
+        return {"product_info": json.loads(row["product_info"]), "regens": row["regens"]}
 
-    def log_generation(self, user_id: int, product: str = ""):
-        with self._lock, self._conn() as conn:
+    def release_regeneration(self, ref: str):
+        """Перегенерация не удалась — возвращаем её в лимит."""
+        with self._write() as conn:
+            conn.execute("UPDATE generations SET regens = regens - 1 WHERE ref = ? AND regens > 0", (ref,))
+
+    def set_generation_scene(self, ref: str, scene: int, file_id: str):
+        """Новая версия сцены — её же отдаёт «📦 Файлы»."""
+        with self._write() as conn:
             conn.execute(
-                "INSERT INTO generations (user_id, product) VALUES (?, ?)",
-                (user_id, product)
+                "UPDATE generations SET scenes = json_set(COALESCE(scenes, '{}'), ?, ?) WHERE ref = ?",
+                (f'$."{scene}"', file_id, ref),
             )
 
+    def set_preset(self, user_id: int, preset: str):
+        with self._write() as conn:
+            conn.execute(
+                "UPDATE users SET preset = ?, updated_at = datetime('now') WHERE user_id = ?",
+                (preset, user_id)
+            )
+        self._users.invalidate(user_id)
+
+    # ── Кэш анализов товара ──
+
+    def _count(self, name: str):
+        with self._counters_lock:
+            self.cache_counters[name] += 1
+
+    def get_analysis(self, *keys: str, record_miss: bool = True) -> dict | None:
+        """Первый найденный по ключам анализ; None — промах."""
+        for key in keys:
+            row = self._read().execute(
+                "SELECT result FROM analysis_cache WHERE key = ?", (key,)
+            ).fetchone()
+            if row:
+                self._buffer(touch=("analysis_cache", key))
+                self._count("analysis_hits")
+                return json.loads(row["result"])
+        if record_miss:
+            self._count("analysis_misses")
+        return None
+
+    def put_analysis(self, keys: list[str], product_info: dict):
+        """Сохраняет анализ под всеми ключами и вытесняет старые записи сверх лимита."""
+        result = json.dumps(product_info, ensure_ascii=False)
+        size = len(result.encode("utf-8"))
+        now = time.time()
+        with self._write() as conn:
+            conn.executemany("""
+                INSERT INTO analysis_cache (key, result, size, last_used)
+                VALUES (?, ?, ?, ?)
+                ON CONFLICT(key) DO UPDATE SET
+                    result = excluded.result,
+                    size = excluded.size,
+                    last_used = excluded.last_used
+            """, [(key, result, size, now) for key in keys])
+            total = conn.execute("SELECT COALESCE(SUM(size), 0) AS n FROM analysis_cache").fetchone()["n"]
+            if total > self.analysis_cache_bytes:
+                # LRU: удаляем самые давно использованные, пока не уложимся в лимит
+                conn.execute("""
+                    DELETE FROM analysis_cache WHERE key IN (
+                        SELECT key FROM (
+                            SELECT key, size, SUM(size) OVER (ORDER BY last_used, key) AS running
+                            FROM analysis_cache
+                        ) WHERE running - size < ?
+                    )
+                """, (total - self.analysis_cache_bytes,))
+
+    # ── Кэш готовых сцен ──
+
+    def get_render(self, key: str) -> dict | None:
+        """{"file_id", "path"} для сцены или None."""
+        row = self._read().execute(
+            "SELECT file_id, path FROM render_cache WHERE key = ?", (key,)
+        ).fetchone()
+        if not row or not (row["file_id"] or row["path"]):
+            self._count("render_misses")
+            return None
+        self._buffer(touch=("render_cache", key))
+        self._count("render_hits")
+        return dict(row)
+
+    def put_render(self, key: str, file_id: str | None = None, path: str | None = None,
+                   size: int = 0, max_entries: int = 10000, max_bytes: int = 0) -> list[str]:
+        """
+        Сохраняет file_id и/или путь к файлу сцены (непереданные поля не трогаются).
+        Возвращает пути файлов, вытесненных по LRU — их нужно удалить с диска.
+        """
+        evicted = []
+        with self._write() as conn:
+            conn.execute("""
+                INSERT INTO render_cache (key, file_id, path, size, last_used)
+                VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT(key) DO UPDATE SET
+                    file_id   = COALESCE(excluded.file_id, file_id),
+                    path      = COALESCE(excluded.path, path),
+                    size      = CASE WHEN excluded.path IS NULL THEN size ELSE excluded.size END,
+                    last_used = excluded.last_used
+            """, (key, file_id, path, size if path else 0, time.time()))
+
+            # Лимит файлов на диске: у старых записей убираем только файл, file_id остаётся
+            total = conn.execute(
+                "SELECT COALESCE(SUM(size), 0) AS n FROM render_cache WHERE path IS NOT NULL"
+            ).fetchone()["n"]
+            if total > max_bytes:
+                rows = conn.execute("""
+                    SELECT key, path FROM (
+                        SELECT key, path, size, SUM(size) OVER (ORDER BY last_used, key) AS running
+                        FROM render_cache WHERE path IS NOT NULL
+                    ) WHERE running - size < ?
+                """, (total - max_bytes,)).fetchall()
+                conn.executemany(
+                    "UPDATE render_cache SET path = NULL, size = 0 WHERE key = ?",
+                    [(r["key"],) for r in rows]
+                )
+                evicted += [r["path"] for r in rows]
+
+            # Лимит записей
+            rows = conn.execute("""
+                SELECT key, path FROM render_cache
+                ORDER BY last_used DESC, key DESC LIMIT -1 OFFSET ?
+            """, (max_entries,)).fetchall()
+            if rows:
+                conn.executemany("DELETE FROM render_cache WHERE key = ?", [(r["key"],) for r in rows])
+                evicted += [r["path"] for r in rows if r["path"]]
+        return evicted
+
+    # ── Очередь генераций (jobs) ──
+    # queued → running (с арендой lease_until) → done / failed.
+    # Воркер продлевает аренду heartbeat'ом; аренда истекла — задачу забирает другой.
+
+    def enqueue_job(self, user_id: int, chat_id: int, message_id: int, status_message_id: int,
+                    file_id: str, file_unique_id: str, charged: str, priority: int = 0,
+                    is_document: bool = False) -> int:
+        with self._write() as conn:
+            cur = conn.execute("""
+                INSERT INTO jobs (user_id, chat_id, message_id, status_message_id, file_id,
+                                  file_unique_id, is_document, charged, priority)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+            """, (user_id, chat_id, message_id, status_message_id, file_id,
+                  file_unique_id, int(is_document), charged, priority))
+        return cur.lastrowid
+
+    def has_active_job(self, user_id: int, file_unique_id: str) -> bool:
+        """Есть ли в очереди или у воркера задача с этим фото пользователя."""
+        row = self._read().execute("""
+            SELECT 1 FROM jobs
+            WHERE user_id = ? AND file_unique_id = ? AND status IN ('queued', 'running')
+            LIMIT 1
+        """, (user_id, file_unique_id)).fetchone()
+        return row is not None
+
+    def claim_job(self, worker: str, lease: float, max_attempts: int) -> dict | None:
+        """Атомарно забирает следующую задачу (новую или с истёкшей арендой)."""
+        now = time.time()
+        with self._write() as conn:
+            row = conn.execute("""
+                UPDATE jobs SET
+                    status = 'running',
+                    worker = :worker,
+                    lease_until = :lease_until,
+                    attempts = attempts + 1,
+                    updated_at = datetime('now')
+                WHERE id = (
+                    SELECT id FROM jobs
+                    WHERE (status = 'queued' OR (status = 'running' AND lease_until < :now))
+                      AND attempts < :max_attempts
+                    ORDER BY priority, id
+                    LIMIT 1
+                )
+                RETURNING *
+            """, {"worker": worker, "lease_until": now + lease, "now": now,
+                  "max_attempts": max_attempts}).fetchone()
+        return dict(row) if row else None
+
+    def heartbeat_job(self, job_id: int, worker: str, lease: float) -> bool:
+        """Продлевает аренду. False — задачу уже забрал другой воркер."""
+        with self._write() as conn:
+            cur = conn.execute(
+                "UPDATE jobs SET lease_until = ? WHERE id = ? AND worker = ? AND status = 'running'",
+                (time.time() + lease, job_id, worker)
+            )
+        return cur.rowcount == 1
+
+    def finish_job(self, job_id: int, worker: str, status: str = "done", error: str | None = None):
+        with self._write() as conn:
+            conn.execute("""
+                UPDATE jobs SET status = ?, error = ?, lease_until = NULL, updated_at = datetime('now')
+                WHERE id = ? AND worker = ?
+            """, (status, error, job_id, worker))
+
+    def reap_jobs(self, max_attempts: int, keep_days: int = 7) -> list[dict]:
+        """
+        Помечает failed задачи, исчерпавшие попытки (воркер падал на каждой),
+        и удаляет старые завершённые. Возвращает помеченные — им нужен возврат генерации.
+        """
+        with self._write() as conn:
+            rows = conn.execute("""
+                UPDATE jobs SET status = 'failed', error = 'attempts exhausted',
+                                lease_until = NULL, updated_at = datetime('now')
+                WHERE attempts >= ?
+                  AND (status = 'queued' OR (status = 'running' AND lease_until < ?))
+                RETURNING *
+            """, (max_attempts, time.time())).fetchall()
+            conn.execute(
+                "DELETE FROM jobs WHERE status IN ('done', 'failed') AND updated_at < datetime('now', ?)",
+                (f"-{keep_days} days",)
+            )
+        return [dict(r) for r in rows]
+
+    def count_jobs(self) -> dict:
+        """{статус: число} незавершённых задач — для метрики snapsell_jobs (bot.watch_jobs)."""
+        rows = self._read().execute(
+            "SELECT status, COUNT(*) AS n FROM jobs WHERE status IN ('queued', 'running') GROUP BY status"
+        ).fetchall()
+        return {r["status"]: r["n"] for r in rows}
+
     # ── Статистика (для /admin) ──
 
+    # Все значения — из stats_counters / stats_daily, без сканирования generations
+
     def get_stats(self) -> dict:
-        with self._conn() as conn:
-            total_users = conn.execute("SELECT COUNT(*) as n FROM users").fetchone()["n"]
-            total_gens  = conn.execute("SELECT COUNT(*) as n FROM generations").fetchone()["n"]
-            paid_users  = conn.execute(
-                "SELECT COUNT(*) as n FROM users WHERE plan != 'free'"
-            ).fetchone()["n"]
-            today_gens  = conn.execute(
-                "SELECT COUNT(*) as n FROM generations WHERE date(created_at)=date('now')"
-            ).fetchone()["n"]
+        self.flush()
+        conn = self._read()
+        counters = {r["name"]: r["value"] for r in conn.execute("SELECT name, value FROM stats_counters")}
+        today_gens = conn.execute(
+            "SELECT COALESCE(SUM(generations), 0) AS n FROM stats_daily WHERE day = date('now')"
+        ).fetchone()["n"]
         return {
-            "total_users": total_users,
-            "paid_users":  paid_users,
-            "total_gens":  total_gens,
+            "total_users": counters.get("total_users", 0),
+            "paid_users":  counters.get("paid_users", 0),
+            "total_gens":  counters.get("total_gens", 0),
             "today_gens":  today_gens,
         }
+
+    def get_stats_range(self, days: int) -> dict:
+        """Итоги за последние days дней (включая сегодня) по планам: {plan: {generations, new_users, purchases}}."""
+        rows = self._read().execute("""
+            SELECT plan, SUM(generations) AS generations, SUM(new_users) AS new_users,
+                   SUM(purchases) AS purchases
+            FROM stats_daily WHERE day > date('now', ?)
+            GROUP BY plan
+        """, (f"-{days} days",)).fetchall()
+        return {
+            r["plan"] or "unknown": {k: r[k] for k in ("generations", "new_users", "purchases")}
+            for r in rows
+        }
+
+    def purge_generations(self, keep_days: int, batch: int = 5000) -> int:
+        """
+        Удаляет строки generations старше keep_days дней пачками по batch,
+        не держа блокировку записи надолго. Агрегаты в stats_* не меняются.
+        """
+        removed = 0
+        while True:
+            with self._write() as conn:
+                cur = conn.execute("""
+                    DELETE FROM generations WHERE id IN (
+                        SELECT id FROM generations WHERE created_at < datetime('now', ?) LIMIT ?
+                    )
+                """, (f"-{keep_days} days", batch))
+            removed += cur.rowcount
+            if cur.rowcount < batch:
+                return removed
+
+
+class AsyncDatabase:
+    """
+    Асинхронный фасад над Database для хэндлеров бота.
+    Каждый публичный метод Database доступен как корутина и выполняется
+    в выделенном пуле потоков — fsync и ожидание блокировок SQLite
+    не останавливают event loop.
+    """
+
+    def __init__(self, database: Database, max_workers: int = 4,
+                 on_call: Callable[[str, float], None] | None = None):
+        self.sync = database
+        self.on_call = on_call   # (метод, секунды с учётом ожидания потока) — для метрик
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="db")
+
+    async def run(self, fn, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        if self.on_call is None:
+            return await loop.run_in_executor(self._executor, functools.partial(fn, *args, **kwargs))
+        start = time.perf_counter()
+        try:
+            return await loop.run_in_executor(self._executor, functools.partial(fn, *args, **kwargs))
+        finally:
+            self.on_call(getattr(fn, "__name__", "call"), time.perf_counter() - start)
+
+    def __getattr__(self, name):
+        attr = getattr(self.sync, name)
+        if name.startswith("_") or not callable(attr):
+            return attr
+
+        async def call(*args, **kwargs):
+            return await self.run(attr, *args, **kwargs)
+
+        call.__name__ = name
+        return call
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+        self.sync.close()
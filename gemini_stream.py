@@ -0,0 +1,43 @@
+"""
+Инкрементальный разбор потокового ответа Gemini (streamGenerateContent, SSE).
+Промт каждой сцены из "scenes" отдаётся в колбэк, как только его строка
+пришла целиком, — генерация изображения стартует до конца ответа модели.
+"""
+
+import json
+import re
+from typing import Callable
+
+
+def _scene_pattern(key: str) -> re.Pattern:
+    # "key": "...строка с экранированием..." — только закрытая кавычкой строка
+    return re.compile(r'"%s"\s*:\s*"((?:[^"\\]|\\.)*)"' % re.escape(key))
+
+
+class SceneStreamParser:
+    def __init__(self, keys: list[str], on_scene: Callable[[str, str], None]):
+        self.on_scene = on_scene
+        self.text = ""
+        self._patterns = {key: _scene_pattern(key) for key in keys}
+        self._scenes_at = -1
+
+    def feed(self, chunk: str):
+        self.text += chunk
+        if self._scenes_at < 0:
+            self._scenes_at = self.text.find('"scenes"')
+            if self._scenes_at < 0:
+                return
+        for key, pattern in list(self._patterns.items()):
+            m = pattern.search(self.text, self._scenes_at)
+            if m:
+                del self._patterns[key]
+                self.on_scene(key, json.loads(f'"{m.group(1)}"'))
+
+    def feed_sse_line(self, line: str):
+        """Строка SSE вида `data: {...}` с очередным фрагментом ответа."""
+        if not line.startswith("data:"):
+            return
+        event = json.loads(line[5:])
+        for candidate in event.get("candidates", [])[:1]:
+            for part in candidate.get("content", {}).get("parts", []):
+                self.feed(part.get("text", ""))
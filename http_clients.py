@@ -0,0 +1,60 @@
+"""
+HTTP-клиенты SnapSell Bot — по одному долгоживущему httpx.AsyncClient на апстрим.
+Создаются при старте Application и закрываются при остановке:
+соединения (TCP+TLS) переиспользуются между запросами и пользователями.
+"""
+
+import logging
+
+import httpx
+
+from config import config
+
+logger = logging.getLogger(__name__)
+
+
+def _make_client(base_url: str, timeout: float, max_connections: int, **kwargs) -> httpx.AsyncClient:
+    limits = httpx.Limits(
+        max_connections=max_connections,
+        max_keepalive_connections=min(config.HTTP_MAX_KEEPALIVE, max_connections),
+        keepalive_expiry=config.HTTP_KEEPALIVE_EXPIRY,
+    )
+    timeout = httpx.Timeout(timeout, connect=config.HTTP_CONNECT_TIMEOUT)
+    try:
+        return httpx.AsyncClient(
+            base_url=base_url, limits=limits, timeout=timeout, http2=config.HTTP2, **kwargs
+        )
+    except ImportError:
+        # http2=True требует пакет h2 (pip install "httpx[http2]")
+        logger.warning("HTTP/2 недоступен (нет пакета h2), используем HTTP/1.1")
+        return httpx.AsyncClient(base_url=base_url, limits=limits, timeout=timeout, **kwargs)
+
+
+class HttpClients:
+    """Пул клиентов: gemini и pollinations. До start() атрибуты равны None."""
+
+    def __init__(self):
+        self.gemini: httpx.AsyncClient | None = None
+        self.pollinations: httpx.AsyncClient | None = None
+
+    async def start(self):
+        if self.gemini is None:
+            self.gemini = _make_client(
+                config.GEMINI_BASE_URL,
+                timeout=config.GEMINI_TIMEOUT,
+                max_connections=config.GEMINI_MAX_CONNECTIONS,
+            )
+        if self.pollinations is None:
+            self.pollinations = _make_client(
+                config.POLLINATIONS_BASE_URL,
+                timeout=config.POLLINATIONS_TIMEOUT,
+                max_connections=config.POLLINATIONS_MAX_CONNECTIONS,
+                follow_redirects=True,
+            )
+
+    async def close(self):
+        for name in ("gemini", "pollinations"):
+            client = getattr(self, name)
+            if client is not None:
+                await client.aclose()
+                setattr(self, name, None)
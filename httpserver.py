@@ -0,0 +1,113 @@
+"""
+Минимальный встроенный HTTP/1.1-сервер на asyncio (без внешних зависимостей).
+Используется для вебхука Telegram и фейковых апстримов бенчмарка.
+Поддерживает keep-alive и тело с Content-Length; chunked-запросы
+не принимаются (411), потоковые ответы отдаются chunked.
+"""
+
+import asyncio
+import logging
+import urllib.parse
+from dataclasses import dataclass, field
+from http import HTTPStatus
+from typing import AsyncIterator, Awaitable, Callable
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class Request:
+    method:  str
+    path:    str
+    query:   dict
+    headers: dict   # имена заголовков в нижнем регистре
+    body:    bytes
+
+
+@dataclass
+class Response:
+    status:       int = 200
+    body:         bytes = b""
+    content_type: str = "text/plain; charset=utf-8"
+    headers:      dict = field(default_factory=dict)
+    stream:       AsyncIterator[bytes] | None = None   # вместо body — chunked-ответ
+
+
+Handler = Callable[[Request], Awaitable[Response]]
+
+
+async def _read_request(reader: asyncio.StreamReader, max_body: int, idle_timeout: float) -> Request | Response | None:
+    try:
+        line = await asyncio.wait_for(reader.readline(), timeout=idle_timeout)
+    except asyncio.TimeoutError:
+        return None
+    if not line:
+        return None
+    method, target, _version = line.decode("latin-1").split(" ", 2)
+    headers = {}
+    while True:
+        raw = await reader.readline()
+        if raw in (b"\r\n", b"\n", b""):
+            break
+        name, _, value = raw.decode("latin-1").partition(":")
+        headers[name.strip().lower()] = value.strip()
+
+    if "chunked" in headers.get("transfer-encoding", "").lower():
+        return Response(HTTPStatus.LENGTH_REQUIRED)
+    length = int(headers.get("content-length") or 0)
+    if length > max_body:
+        return Response(HTTPStatus.REQUEST_ENTITY_TOO_LARGE)
+    body = await reader.readexactly(length) if length else b""
+
+    url = urllib.parse.urlsplit(target)
+    return Request(method.upper(), url.path, dict(urllib.parse.parse_qsl(url.query)), headers, body)
+
+
+async def _write_response(writer: asyncio.StreamWriter, resp: Response, keep_alive: bool):
+    status = HTTPStatus(resp.status)
+    head = [
+        f"HTTP/1.1 {status.value} {status.phrase}",
+        "Transfer-Encoding: chunked" if resp.stream is not None else f"Content-Length: {len(resp.body)}",
+        f"Content-Type: {resp.content_type}",
+        f"Connection: {'keep-alive' if keep_alive else 'close'}",
+    ]
+    head += [f"{k}: {v}" for k, v in resp.headers.items()]
+    writer.write(("\r\n".join(head) + "\r\n\r\n").encode("latin-1"))
+    if resp.stream is None:
+        writer.write(resp.body)
+    else:
+        async for chunk in resp.stream:
+            if chunk:
+                writer.write(b"%x\r\n%s\r\n" % (len(chunk), chunk))
+                await writer.drain()
+        writer.write(b"0\r\n\r\n")
+    await writer.drain()
+
+
+async def serve(handler: Handler, host: str, port: int,
+                max_body: int = 10 * 1024 * 1024, idle_timeout: float = 75.0) -> asyncio.Server:
+    """Запускает сервер; keep-alive соединение без запросов дольше idle_timeout закрывается."""
+    async def on_client(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                req = await _read_request(reader, max_body, idle_timeout)
+                if req is None:
+                    break
+                if isinstance(req, Response):
+                    await _write_response(writer, req, keep_alive=False)
+                    break
+                try:
+                    resp = await handler(req)
+                except Exception as e:
+                    logger.error(f"HTTP handler error on {req.method} {req.path}: {e}", exc_info=True)
+                    resp = Response(HTTPStatus.INTERNAL_SERVER_ERROR, b"internal error")
+                keep_alive = req.headers.get("connection", "").lower() != "close"
+                await _write_response(writer, resp, keep_alive)
+                if not keep_alive:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    return await asyncio.start_server(on_client, host, port)
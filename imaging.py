@@ -0,0 +1,42 @@
+"""
+Подготовка входного фото для анализа SnapSell Bot.
+Функции без состояния — безопасно вызываются в ProcessPoolExecutor.
+"""
+
+from io import BytesIO
+
+from PIL import Image, ImageOps
+
+
+def pick_photo_size(sizes: list, min_side: int):
+    """
+    Наименьший PhotoSize, у которого меньшая сторона не меньше min_side.
+    Если таких нет — самый большой из доступных.
+    """
+    by_area = sorted(sizes, key=lambda s: s.width * s.height)
+    for size in by_area:
+        if min(size.width, size.height) >= min_side:
+            return size
+    return by_area[-1]
+
+
+def prepare_for_analysis(data: bytes, max_side: int, max_bytes: int) -> bytes:
+    """
+    Уменьшает изображение до max_side по большей стороне и перекодирует в JPEG
+    не больше max_bytes (понижая качество, затем размер). EXIF-поворот применяется.
+    """
+    with Image.open(BytesIO(data)) as src:
+        img = ImageOps.exif_transpose(src)
+        if img.mode != "RGB":
+            img = img.convert("RGB")
+        img.thumbnail((max_side, max_side), Image.LANCZOS)
+
+        while True:
+            for quality in (85, 75, 65, 55):
+                out = BytesIO()
+                img.save(out, format="JPEG", quality=quality, optimize=True)
+                if out.tell() <= max_bytes:
+                    return out.getvalue()
+            if max(img.size) <= 256:
+                return out.getvalue()
+            img = img.resize((img.width * 3 // 4, img.height * 3 // 4), Image.LANCZOS)
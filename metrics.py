@@ -0,0 +1,217 @@
+"""
+Встроенные метрики SnapSell Bot (без внешних зависимостей):
+гистограммы времени этапов, счётчики исходов и значения «на сейчас».
+Наблюдения пишутся из event loop — без блокировок, только
+perf_counter, bisect и пара сложений. Экспорт — текстовый формат
+Prometheus (GET /metrics) и краткая сводка для /admin.
+"""
+
+import bisect
+import time
+from contextlib import contextmanager
+from typing import Callable
+
+from httpserver import Request, Response, serve
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120)
+
+_registry: list = []
+
+
+def _label_str(names: tuple, values: tuple, extra: str = "") -> str:
+    pairs = [f'{n}="{v}"' for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class _Family:
+    kind = ""
+
+    def __init__(self, name: str, doc: str, labels: tuple = ()):
+        self.name = name
+        self.doc = doc
+        self.label_names = labels
+        self._children: dict[tuple, object] = {}
+        _registry.append(self)
+
+    def labels(self, *values):
+        child = self._children.get(values)
+        if child is None:
+            child = self._children[values] = self._new_child()
+        return child
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def header(self) -> list[str]:
+        return [f"# HELP {self.name} {self.doc}", f"# TYPE {self.name} {self.kind}"]
+
+
+class _HistogramChild:
+    __slots__ = ("buckets", "counts", "sum", "count")
+
+    def __init__(self, buckets: tuple):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    @contextmanager
+    def time(self):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start)
+
+    def quantile(self, q: float) -> float | None:
+        """Оценка квантиля по корзинам (линейно внутри корзины)."""
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            if seen + n >= rank and n:
+                lower = self.buckets[i - 1] if i > 0 else 0.0
+                upper = self.buckets[i] if i < len(self.buckets) else self.buckets[-1]
+                return lower + (upper - lower) * (rank - seen) / n
+            seen += n
+        return self.buckets[-1]
+
+
+class Histogram(_Family):
+    kind = "histogram"
+
+    def __init__(self, name: str, doc: str, labels: tuple = (), buckets: tuple = DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        super().__init__(name, doc, labels)
+
+    def _new_child(self):
+        return _HistogramChild(self.buckets)
+
+    def render(self) -> list[str]:
+        lines = self.header()
+        for values, child in self._children.items():
+            cumulative = 0
+            for bound, n in zip(self.buckets + (float("inf"),), child.counts):
+                cumulative += n
+                le = 'le="+Inf"' if bound == float("inf") else f'le="{float(bound)!r}"'
+                lines.append(f"{self.name}_bucket{_label_str(self.label_names, values, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_label_str(self.label_names, values)} {child.sum}")
+            lines.append(f"{self.name}_count{_label_str(self.label_names, values)} {child.count}")
+        return lines
+
+
+class _CounterChild:
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount: float = 1):
+        self.value += amount
+
+
+class Counter(_Family):
+    kind = "counter"
+
+    def _new_child(self):
+        return _CounterChild()
+
+    def inc(self, amount: float = 1):
+        self.labels().inc(amount)
+
+    def render(self) -> list[str]:
+        return self.header() + [
+            f"{self.name}{_label_str(self.label_names, values)} {child.value}"
+            for values, child in self._children.items()
+        ]
+
+
+class GaugeFunc(_Family):
+    """Значение, вычисляемое в момент чтения: {значения меток: число}."""
+    kind = "gauge"
+
+    def __init__(self, name: str, doc: str, fn: Callable[[], dict], labels: tuple = (), kind: str = "gauge"):
+        super().__init__(name, doc, labels)
+        self.fn = fn
+        self.kind = kind
+
+    def labels(self, *values):
+        raise TypeError(f"{self.name}: GaugeFunc is computed by its function, labels() is not supported")
+
+    def values(self) -> dict:
+        try:
+            return self.fn()
+        except Exception:
+            return {}
+
+    def render(self) -> list[str]:
+        return self.header() + [
+            f"{self.name}{_label_str(self.label_names, values)} {value}"
+            for values, value in self.values().items()
+        ]
+
+
+def render() -> str:
+    lines = []
+    for family in _registry:
+        lines += family.render()
+    return "\n".join(lines) + "\n"
+
+
+async def start_server(host: str, port: int):
+    """HTTP-эндпоинт GET /metrics в формате Prometheus."""
+    async def handle(req: Request) -> Response:
+        if req.path != "/metrics":
+            return Response(404)
+        return Response(body=render().encode(), content_type="text/plain; version=0.0.4; charset=utf-8")
+
+    return await serve(handle, host, port)
+
+
+# ── Метрики бота ─────────────────────────────────────────
+
+STAGE_SECONDS = Histogram(
+    "snapsell_stage_seconds", "Duration of generation pipeline stages", labels=("stage",)
+)
+DB_CALL_SECONDS = Histogram(
+    "snapsell_db_call_seconds", "Database call latency including executor wait", labels=("method",),
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 5),
+)
+GENERATIONS = Counter("snapsell_generations_total", "Finished generations by result", labels=("result",))
+SCENES = Counter("snapsell_scenes_total", "Rendered scenes by result", labels=("result",))
+PAYWALL_HITS = Counter("snapsell_paywall_hits_total", "Generation attempts rejected by the paywall")
+COALESCED = Counter("snapsell_coalesced_total", "Duplicate photos attached to an in-flight generation")
+
+
+def summary() -> list[str]:
+    """Строки для /admin: p50/p95 по этапам и счётчики."""
+    lines = []
+    for (stage,), child in STAGE_SECONDS._children.items():
+        if child.count:
+            lines.append(f"{stage}: p50 {child.quantile(0.5):.2f}s, p95 {child.quantile(0.95):.2f}s (n={child.count})")
+    # Самые частые вызовы БД
+    calls = sorted(DB_CALL_SECONDS._children.items(), key=lambda kv: -kv[1].count)[:5]
+    for (method,), child in calls:
+        if child.count:
+            lines.append(
+                f"db.{method}: p50 {child.quantile(0.5) * 1000:.1f}ms, "
+                f"p95 {child.quantile(0.95) * 1000:.1f}ms (n={child.count})"
+            )
+    for family in _registry:
+        if isinstance(family, Counter):
+            for values, child in family._children.items():
+                name = family.name.removeprefix("snapsell_").removesuffix("_total")
+                lines.append(f"{name}{'/' + '/'.join(values) if values else ''}: {child.value:g}")
+        elif isinstance(family, GaugeFunc):
+            for values, value in family.values().items():
+                name = family.name.removeprefix("snapsell_").removesuffix("_total")
+                lines.append(f"{name}{'/' + '/'.join(values) if values else ''}: {value:g}")
+    return lines
@@ -0,0 +1,72 @@
+"""
+Подготовка готовых сцен под требования маркетплейсов.
+Кадрирование под пропорции площадки, подбор качества JPEG/WebP
+под лимит размера файла, без метаданных (EXIF, ICC).
+Функции без состояния — выполняются в ProcessPoolExecutor.
+"""
+
+from io import BytesIO
+
+from PIL import Image, ImageOps
+
+# Пресеты: размер кадра (ш×в), формат, лимит файла в байтах
+PRESETS = {
+    "wb": {
+        "title":     "Wildberries",
+        "size":      (900, 1200),
+        "format":    "JPEG",
+        "max_bytes": 1_000_000,
+    },
+    "ozon": {
+        "title":     "Ozon",
+        "size":      (1200, 1600),
+        "format":    "WEBP",
+        "max_bytes": 1_000_000,
+    },
+    "square": {
+        "title":     "Квадрат 1:1 (Avito, Яндекс Маркет)",
+        "size":      (1000, 1000),
+        "format":    "JPEG",
+        "max_bytes": 500_000,
+    },
+}
+
+EXTENSIONS = {"JPEG": "jpg", "WEBP": "webp"}
+
+
+def _encode(img: Image.Image, fmt: str, quality: int) -> bytes:
+    out = BytesIO()
+    if fmt == "WEBP":
+        img.save(out, format="WEBP", quality=quality, method=4)
+    else:
+        img.save(out, format="JPEG", quality=quality, optimize=True, progressive=True)
+    return out.getvalue()
+
+
+def _fit_budget(img: Image.Image, fmt: str, max_bytes: int) -> bytes:
+    """Наибольшее качество (40–95), при котором файл укладывается в max_bytes."""
+    lo, hi = 40, 95
+    best = None
+    while lo <= hi:
+        quality = (lo + hi) // 2
+        data = _encode(img, fmt, quality)
+        if len(data) <= max_bytes:
+            best, lo = data, quality + 1
+        else:
+            hi = quality - 1
+    return best if best is not None else _encode(img, fmt, 40)
+
+
+def render_preset(data: bytes, preset: str) -> bytes:
+    """Сцена под пресет: кадрирование по центру, ресайз, кодирование под лимит."""
+    cfg = PRESETS[preset]
+    with Image.open(BytesIO(data)) as src:
+        img = src.convert("RGB")
+    img = ImageOps.fit(img, cfg["size"], Image.LANCZOS, centering=(0.5, 0.5))
+    # Пиксели без метаданных исходника
+    img.info = {}
+    return _fit_budget(img, cfg["format"], cfg["max_bytes"])
+
+
+def file_name(preset: str, index: int, scene_key: str) -> str:
+    return f"{preset}_{index + 1}_{scene_key}.{EXTENSIONS[PRESETS[preset]['format']]}"
@@ -0,0 +1,168 @@
+"""
+Ограничение исходящих запросов к Telegram Bot API.
+Глобальный token bucket на бота и отдельный — на каждый чат (личные
+и группы с разными лимитами). Ожидающие запросы обслуживаются по
+приоритету: отправка результатов раньше правок статуса. RetryAfter
+приостанавливает чат на указанное время, запрос повторяется.
+"""
+
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+from datetime import timedelta
+from typing import Any
+
+from telegram.error import RetryAfter
+from telegram.ext import BaseRateLimiter
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Приоритеты: меньше — раньше
+DELIVERY = 0
+PROGRESS = 1
+
+# Лимиты Telegram считают сообщения; getFile, answerCallbackQuery и т.п. не ограничиваем
+LIMITED_PREFIXES = ("send", "edit", "copy", "forward")
+PROGRESS_ENDPOINTS = {"editMessageText", "editMessageReplyMarkup"}
+BUCKET_IDLE = 60.0  # с, после которых пустое ведро чата удаляется
+
+THROTTLED = metrics.Counter(
+    "snapsell_telegram_throttled_total", "Telegram requests delayed or dropped by the rate limiter",
+    labels=("event",),
+)
+
+
+class TokenBucket:
+    """rate токенов в секунду, не больше capacity; очередь ожидающих — по (приоритет, порядок)."""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self._waiters: list[tuple[int, int, asyncio.Future]] = []
+        self._seq = itertools.count()
+        self._pump: asyncio.Task | None = None
+
+    @property
+    def idle(self) -> bool:
+        return not self._waiters and time.monotonic() - self.updated > BUCKET_IDLE
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def ready(self) -> bool:
+        now = time.monotonic()
+        self._refill(now)
+        return not self._waiters and now >= self.paused_until and self.tokens >= 1
+
+    def try_acquire(self) -> bool:
+        if not self.ready():
+            return False
+        self.tokens -= 1
+        return True
+
+    async def acquire(self, priority: int = DELIVERY):
+        if self.try_acquire():
+            return
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._seq), future))
+        if self._pump is None or self._pump.done():
+            self._pump = asyncio.create_task(self._serve())
+        await future
+
+    def pause(self, seconds: float):
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+        if self._waiters and (self._pump is None or self._pump.done()):
+            self._pump = asyncio.create_task(self._serve())
+
+    async def _serve(self):
+        while self._waiters:
+            now = time.monotonic()
+            self._refill(now)
+            if now < self.paused_until:
+                await asyncio.sleep(self.paused_until - now)
+            elif self.tokens < 1:
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+            else:
+                _, _, future = heapq.heappop(self._waiters)
+                if not future.done():  # отменённые ожидания токен не тратят
+                    self.tokens -= 1
+                    future.set_result(None)
+
+
+class TelegramRateLimiter(BaseRateLimiter[int]):
+    """
+    rate_limit_args — приоритет запроса (DELIVERY, PROGRESS); по умолчанию
+    правки сообщений — PROGRESS, остальное — DELIVERY.
+    sendChatAction без свободного токена не ждёт, а пропускается.
+    """
+
+    def __init__(self, global_rate: float = 30.0, chat_rate: float = 1.0, chat_burst: int = 8,
+                 group_rate: float = 20 / 60, max_retries: int = 3):
+        self.global_rate = global_rate
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.group_rate = group_rate
+        self.max_retries = max_retries
+        self._global: TokenBucket | None = None
+        self._chats: dict[Any, TokenBucket] = {}
+        self._last_prune = 0.0
+
+    async def initialize(self):
+        self._global = TokenBucket(self.global_rate, max(1.0, self.global_rate))
+
+    async def shutdown(self):
+        self._chats.clear()
+
+    def _chat_bucket(self, chat_id) -> TokenBucket:
+        now = time.monotonic()
+        if now - self._last_prune > BUCKET_IDLE:
+            self._last_prune = now
+            for key in [key for key, bucket in self._chats.items() if bucket.idle]:
+                del self._chats[key]
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            # Отрицательный id или @username — группа или канал
+            group = isinstance(chat_id, str) or int(chat_id) < 0
+            rate = self.group_rate if group else self.chat_rate
+            bucket = self._chats[chat_id] = TokenBucket(rate, self.chat_burst)
+        return bucket
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        if not endpoint.startswith(LIMITED_PREFIXES):
+            return await callback(*args, **kwargs)
+        chat_id = data.get("chat_id")
+        chat = self._chat_bucket(chat_id) if chat_id is not None else None
+        priority = rate_limit_args if rate_limit_args is not None else (
+            PROGRESS if endpoint in PROGRESS_ENDPOINTS else DELIVERY
+        )
+
+        if endpoint == "sendChatAction":
+            # Индикатор «печатает…» не сообщение и устаревает за секунды: токен чата
+            # не тратим, а если чат или бот упёрлись в лимит — пропускаем
+            if (chat is not None and not chat.ready()) or not self._global.try_acquire():
+                THROTTLED.labels("dropped").inc()
+                return True
+            return await callback(*args, **kwargs)
+
+        for attempt in range(self.max_retries + 1):
+            # Сначала ведро чата: медленный чат не держит глобальные токены
+            if chat is not None:
+                await chat.acquire(priority)
+            await self._global.acquire(priority)
+            try:
+                return await callback(*args, **kwargs)
+            except RetryAfter as e:
+                if attempt == self.max_retries:
+                    raise
+                delay = e.retry_after.total_seconds() if isinstance(e.retry_after, timedelta) else float(e.retry_after)
+                THROTTLED.labels("retry_after").inc()
+                logger.warning(f"Telegram flood limit on {endpoint} (chat {chat_id}): retry in {delay:g}s")
+                (chat or self._global).pause(delay)
@@ -0,0 +1,79 @@
+"""
+Кэш готовых сцен SnapSell Bot.
+Генерация Pollinations детерминирована по (prompt, seed, width, height):
+повторный результат отправляем по Telegram file_id — без генерации и без
+повторной загрузки байтов. Опционально храним сами JPEG на диске (LRU по размеру).
+"""
+
+import asyncio
+import hashlib
+import logging
+import os
+from pathlib import Path
+
+from db import AsyncDatabase
+
+logger = logging.getLogger(__name__)
+
+
+def render_key(prompt: str, seed: int, width: int, height: int) -> str:
+    raw = f"{prompt}\x00{seed}\x00{width}\x00{height}"
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+def _write_file(path: Path, data: bytes):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_suffix(".tmp")
+    tmp.write_bytes(data)
+    os.replace(tmp, path)
+
+
+def _remove_files(paths: list[str]):
+    for p in paths:
+        try:
+            os.remove(p)
+        except FileNotFoundError:
+            pass
+
+
+class RenderCache:
+    """
+    lookup() возвращает str (file_id) или bytes (файл с диска), либо None.
+    disk_bytes=0 — байты на диск не сохраняются, кэшируются только file_id.
+    """
+
+    def __init__(self, db: AsyncDatabase, directory: str, disk_bytes: int = 0,
+                 max_entries: int = 10000):
+        self.db = db
+        self.directory = Path(directory)
+        self.disk_bytes = disk_bytes
+        self.max_entries = max_entries
+
+    async def lookup(self, key: str) -> str | bytes | None:
+        row = await self.db.get_render(key)
+        if row is None:
+            return None
+        if row["file_id"]:
+            return row["file_id"]
+        try:
+            return await asyncio.to_thread(Path(row["path"]).read_bytes)
+        except OSError:
+            logger.warning(f"Render cache file missing: {row['path']}")
+            return None
+
+    async def store_bytes(self, key: str, data: bytes):
+        if self.disk_bytes <= 0 or len(data) > self.disk_bytes:
+            return
+        path = self.directory / key[:2] / f"{key}.jpg"
+        await asyncio.to_thread(_write_file, path, data)
+        await self._put(key, path=str(path), size=len(data))
+
+    async def store_file_id(self, key: str, file_id: str):
+        await self._put(key, file_id=file_id)
+
+    async def _put(self, key: str, **fields):
+        evicted = await self.db.put_render(
+            key, max_entries=self.max_entries, max_bytes=self.disk_bytes, **fields
+        )
+        if evicted:
+            await asyncio.to_thread(_remove_files, evicted)
@@ -0,0 +1,153 @@
+"""
+Движок генерации сцен SnapSell Bot поверх Pollinations.
+- повторы с экспоненциальной задержкой и джиттером (429 / 5xx / сетевые ошибки);
+- адаптивный лимит одновременных запросов (AIMD): растёт на успехах,
+  вдвое падает на 429/5xx;
+- дедлайн на пачку сцен: готовые отдаются сразу, опоздавшие и упавшие
+  догенерируются отдельно.
+"""
+
+import asyncio
+import logging
+import random
+import time
+from typing import Awaitable, Callable
+
+import httpx
+
+logger = logging.getLogger(__name__)
+
+RETRYABLE_STATUS = {429, 500, 502, 503, 504}
+
+
+def is_retryable(exc: BaseException) -> bool:
+    if isinstance(exc, httpx.HTTPStatusError):
+        return exc.response.status_code in RETRYABLE_STATUS
+    return isinstance(exc, (httpx.TransportError, asyncio.TimeoutError))
+
+
+def _retry_after(exc: BaseException) -> float | None:
+    if isinstance(exc, httpx.HTTPStatusError):
+        try:
+            return float(exc.response.headers.get("retry-after", ""))
+        except ValueError:
+            return None
+    return None
+
+
+class AIMDLimiter:
+    """Лимит одновременных запросов: +1/limit на успех, ×backoff на перегрузку."""
+
+    def __init__(self, initial: int, minimum: int = 1, maximum: int = 64,
+                 backoff: float = 0.5, cooldown: float = 1.0):
+        self.limit = float(initial)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.backoff = backoff
+        self.cooldown = cooldown
+        self.in_flight = 0
+        self._last_decrease = 0.0
+        self._cond = asyncio.Condition()
+
+    async def __aenter__(self):
+        async with self._cond:
+            while self.in_flight >= int(self.limit):
+                await self._cond.wait()
+            self.in_flight += 1
+        return self
+
+    async def __aexit__(self, *exc):
+        async with self._cond:
+            self.in_flight -= 1
+            self._cond.notify_all()
+
+    def on_success(self):
+        self.limit = min(self.maximum, self.limit + 1 / self.limit)
+
+    def on_overload(self):
+        # Одна волна ошибок — одно снижение, а не по разу на каждый запрос
+        now = time.monotonic()
+        if now - self._last_decrease >= self.cooldown:
+            self._last_decrease = now
+            self.limit = max(self.minimum, self.limit * self.backoff)
+            logger.warning(f"Pollinations overloaded, concurrency limit -> {int(self.limit)}")
+
+
+class RenderEngine:
+    def __init__(self, fetch: Callable[..., Awaitable[bytes]], limiter: AIMDLimiter,
+                 retries: int = 3, base_delay: float = 1.0, max_delay: float = 20.0):
+        self.fetch = fetch
+        self.limiter = limiter
+        self.retries = retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    async def render(self, prompt: str, seed: int, width: int = 1024, height: int = 1024) -> bytes:
+        """Одна сцена с повторами; исчерпав попытки, пробрасывает последнюю ошибку."""
+        for attempt in range(self.retries + 1):
+            try:
+                async with self.limiter:
+                    img = await self.fetch(prompt, seed=seed, width=width, height=height)
+                self.limiter.on_success()
+                return img
+            except Exception as e:
+                if not is_retryable(e) or attempt == self.retries:
+                    raise
+                self.limiter.on_overload()
+                # Full jitter: случайная задержка до base * 2^attempt
+                delay = _retry_after(e) or random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+                logger.info(f"Scene retry {attempt + 1}/{self.retries} in {delay:.1f}s: {e}")
+                await asyncio.sleep(delay)
+
+    @staticmethod
+    async def gather_partial(factories: list[Callable[[], Awaitable]], deadline: float):
+        """
+        Запускает все сцены и ждёт не дольше deadline секунд.
+        Возвращает (готовые {i: результат}, незавершённые {i: task}):
+        опоздавшие задачи продолжают работать, упавшие перезапускаются один раз.
+        """
+        tasks = {i: asyncio.create_task(factory()) for i, factory in enumerate(factories)}
+        await asyncio.wait(tasks.values(), timeout=deadline)
+        done, pending = {}, {}
+        for i, task in tasks.items():
+            if not task.done():
+                pending[i] = task
+            elif task.exception() is not None:
+                logger.warning(f"Scene {i} failed, regenerating: {task.exception()}")
+                pending[i] = asyncio.create_task(factories[i]())
+            else:
+                done[i] = task.result()
+        return done, pending
+
+    @staticmethod
+    async def stream(factories: list[Callable[[], Awaitable]], deadline: float):
+        """
+        Асинхронный генератор (i, результат) в порядке готовности сцен.
+        Упавшая сцена перезапускается один раз, после второй ошибки
+        отдаётся (i, исключение). По истечении deadline незавершённые отменяются.
+        """
+        loop = asyncio.get_running_loop()
+        end = loop.time() + deadline
+        tasks = {asyncio.create_task(factory()): i for i, factory in enumerate(factories)}
+        retried = set()
+        try:
+            while tasks:
+                done, _ = await asyncio.wait(
+                    tasks, timeout=max(0.0, end - loop.time()), return_when=asyncio.FIRST_COMPLETED
+                )
+                if not done:
+                    break
+                for task in done:
+                    i = tasks.pop(task)
+                    exc = task.exception()
+                    if exc is None:
+                        yield i, task.result()
+                    elif i not in retried:
+                        logger.warning(f"Scene {i} failed, regenerating: {exc}")
+                        retried.add(i)
+                        tasks[asyncio.create_task(factories[i]())] = i
+                    else:
+                        yield i, exc
+        finally:
+            for task in tasks:
+                task.cancel()
@@ -0,0 +1,95 @@
+"""
+Библиотека шаблонов сцен по категориям товара.
+В компактном режиме Gemini возвращает только атрибуты товара,
+а промты четырёх сцен собираются здесь локально.
+"""
+
+CATEGORIES = [
+    "clothing", "accessories", "electronics", "food", "cosmetics",
+    "jewelry", "home_decor", "toys", "sports", "other",
+]
+
+# Уточнения к SCENES[*].prompt_desc: категория → ключ сцены → детали
+CATEGORY_DETAILS = {
+    "clothing": {
+        "display":   "neatly styled on a minimalist mannequin or folded on a boutique table, fabric drape visible",
+        "lifestyle": "worn by a stylish model, full outfit visible, natural pose, street or loft setting",
+        "interior":  "hanging on a wooden clothes rack in a bright bedroom, soft linen textures around",
+        "closeup":   "fabric weave, stitching and seams in focus, tactile textile detail",
+    },
+    "accessories": {
+        "display":   "placed on a velvet-covered pedestal with subtle props, boutique window style",
+        "lifestyle": "carried or worn by a fashionable person, hands and accessory in frame",
+        "interior":  "resting on a hallway console table next to keys and a small plant",
+        "closeup":   "hardware, clasps and material grain in sharp focus",
+    },
+    "electronics": {
+        "display":   "on a sleek matte desk surface with soft rim light, tech showroom style",
+        "lifestyle": "person using the device naturally at work or at home, screen glow",
+        "interior":  "on a modern home office desk with laptop, lamp and cable-free setup",
+        "closeup":   "ports, buttons and surface finish, precise industrial design detail",
+    },
+    "food": {
+        "display":   "styled on a rustic wooden board with fresh ingredients around, food magazine look",
+        "lifestyle": "hands serving or tasting the product at a cozy table, steam and warmth",
+        "interior":  "on a bright kitchen counter with natural ingredients and ceramic dishes",
+        "closeup":   "appetizing texture, crumbs, gloss and freshness, shallow depth of field",
+    },
+    "cosmetics": {
+        "display":   "on a glossy acrylic podium with water drops and soft pastel gradient",
+        "lifestyle": "person applying the product in front of a mirror, glowing skin, beauty editorial",
+        "interior":  "on a marble bathroom shelf with towels, candles and greenery",
+        "closeup":   "product texture swatch and packaging details, dewy highlights",
+    },
+    "jewelry": {
+        "display":   "on a black velvet bust or ring holder, sparkling highlights, luxury boutique",
+        "lifestyle": "worn on neck, wrist or hand of an elegant model, soft skin tones",
+        "interior":  "in an open jewelry box on a vanity table with soft morning light",
+        "closeup":   "gemstone facets and metal polish, brilliant reflections, macro lens",
+    },
+    "home_decor": {
+        "display":   "on a styled shelf with books and ceramics, gallery-like composition",
+        "lifestyle": "person arranging the item in a cozy living room, relaxed atmosphere",
+        "interior":  "as the focal point of a designer living room, balanced composition",
+        "closeup":   "material texture, glaze, weave or wood grain in detail",
+    },
+    "toys": {
+        "display":   "on a bright colorful backdrop with playful props, cheerful mood",
+        "lifestyle": "happy child playing with the toy on a soft rug, candid joy",
+        "interior":  "in a tidy modern kids room with pastel decor",
+        "closeup":   "safe rounded edges, colors and material quality in detail",
+    },
+    "sports": {
+        "display":   "on a concrete podium with dynamic lighting, athletic brand style",
+        "lifestyle": "athlete using the product in action outdoors or in a gym, motion energy",
+        "interior":  "in a home gym corner with mats and weights, morning light",
+        "closeup":   "grip, material and technical details, crisp performance look",
+    },
+    "other": {
+        "display":   "centered on a clean pedestal, neutral premium backdrop",
+        "lifestyle": "person naturally interacting with the product in everyday life",
+        "interior":  "placed naturally in a modern home setting",
+        "closeup":   "key details and materials in sharp focus",
+    },
+}
+
+SUFFIX = "photorealistic, 8K resolution, sharp focus, commercial product photography"
+
+
+def template_scene_prompt(product_info: dict, scene_key: str, scene_desc: str) -> str:
+    """Промт сцены из атрибутов товара, описания сцены и уточнений категории."""
+    name = product_info.get("product_en") or "product"
+    colors = ", ".join(c for c in product_info.get("colors", []) if c) or "neutral"
+    style = product_info.get("style") or "modern"
+    category = product_info.get("category") if product_info.get("category") in CATEGORY_DETAILS else "other"
+
+    parts = [f"Professional commercial photography, {name}, {colors} colors"]
+    if product_info.get("material"):
+        parts.append(f"made of {product_info['material']}")
+    parts.append(f"{style} style")
+    if product_info.get("features"):
+        parts.append(product_info["features"])
+    parts.append(scene_desc)
+    parts.append(CATEGORY_DETAILS[category][scene_key])
+    parts.append(SUFFIX)
+    return ", ".join(parts)
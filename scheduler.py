@@ -0,0 +1,180 @@
+"""
+Планировщик генераций SnapSell Bot.
+Ограниченный пул воркеров с приоритетной очередью: pro > basic > free.
+Внутри одного плана — честная очередь по пользователям: вторая задача
+пользователя встаёт после первых задач остальных, а одновременно у одного
+пользователя выполняется не больше per_user задач.
+SingleFlight — повторы выполняющейся задачи ждут её результат вместо запуска.
+"""
+
+import asyncio
+import bisect
+import itertools
+import logging
+from collections import defaultdict
+from dataclasses import dataclass, field
+from typing import Any, Awaitable, Callable, Hashable
+
+logger = logging.getLogger(__name__)
+
+PLAN_PRIORITY = {"pro": 0, "basic": 1, "free": 2}
+
+PositionCallback = Callable[[int], Awaitable[None]]
+
+
+@dataclass(order=True)
+class _Entry:
+    sort_key: tuple
+    user_id: int = field(compare=False)
+    job: Callable[[], Awaitable[Any]] = field(compare=False)
+    future: asyncio.Future = field(compare=False)
+    on_position: PositionCallback | None = field(compare=False, default=None)
+    position: int = field(compare=False, default=0)
+
+
+class GenerationScheduler:
+    def __init__(self, workers: int = 8, per_user: int = 1):
+        self.workers = workers
+        self.per_user = per_user
+        self._queue: list[_Entry] = []          # отсортирован по sort_key
+        self._running: defaultdict[int, int] = defaultdict(int)
+        self._outstanding: defaultdict[int, int] = defaultdict(int)
+        self._seq = itertools.count()
+        self._cond: asyncio.Condition | None = None
+        self._tasks: list[asyncio.Task] = []
+
+    @property
+    def queued(self) -> int:
+        return len(self._queue)
+
+    @property
+    def active(self) -> int:
+        return sum(self._running.values())
+
+    async def start(self):
+        self._cond = asyncio.Condition()
+        self._tasks = [
+            asyncio.create_task(self._worker(), name=f"generation-worker-{i}")
+            for i in range(self.workers)
+        ]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        for entry in self._queue:
+            entry.future.cancel()
+        self._queue.clear()
+
+    async def submit(self, user_id: int, plan: str, job: Callable[[], Awaitable[Any]],
+                     on_position: PositionCallback | None = None) -> Any:
+        """
+        Ставит job в очередь и ждёт результата.
+        on_position(n) вызывается, когда меняется место в очереди (1 — следующий).
+        """
+        loop = asyncio.get_running_loop()
+        async with self._cond:
+            user_round = self._outstanding[user_id]
+            self._outstanding[user_id] += 1
+            entry = _Entry(
+                sort_key=(PLAN_PRIORITY.get(plan, len(PLAN_PRIORITY)), user_round, next(self._seq)),
+                user_id=user_id,
+                job=job,
+                future=loop.create_future(),
+                on_position=on_position,
+            )
+            bisect.insort(self._queue, entry)
+            self._cond.notify()
+        self._report_positions()
+        try:
+            return await entry.future
+        finally:
+            if not entry.future.done():
+                # Отмена до начала выполнения — убираем из очереди
+                entry.future.cancel()
+                if entry in self._queue:
+                    self._queue.remove(entry)
+                    self._release(entry.user_id, running=False)
+
+    def _pop_eligible(self) -> _Entry | None:
+        for i, entry in enumerate(self._queue):
+            if self._running.get(entry.user_id, 0) < self.per_user:
+                return self._queue.pop(i)
+        return None
+
+    def _release(self, user_id: int, running: bool):
+        if running:
+            self._running[user_id] -= 1
+            if not self._running[user_id]:
+                del self._running[user_id]
+        self._outstanding[user_id] -= 1
+        if not self._outstanding[user_id]:
+            del self._outstanding[user_id]
+
+    def _report_positions(self):
+        # Первые idle задач сейчас заберут свободные воркеры — их не беспокоим
+        idle = max(0, self.workers - self.active)
+        for pos, entry in enumerate(self._queue[idle:], start=1):
+            if entry.on_position and entry.position != pos:
+                entry.position = pos
+                asyncio.create_task(self._safe_callback(entry.on_position, pos))
+
+    @staticmethod
+    async def _safe_callback(callback: PositionCallback, pos: int):
+        try:
+            await callback(pos)
+        except Exception as e:
+            logger.warning(f"Queue position update failed: {e}")
+
+    async def _worker(self):
+        while True:
+            async with self._cond:
+                entry = self._pop_eligible()
+                while entry is None:
+                    await self._cond.wait()
+                    entry = self._pop_eligible()
+                self._running[entry.user_id] += 1
+            self._report_positions()
+            try:
+                if not entry.future.done():
+                    entry.future.set_result(await entry.job())
+            except asyncio.CancelledError:
+                entry.future.cancel()
+                raise
+            except Exception as e:
+                if not entry.future.done():
+                    entry.future.set_exception(e)
+            finally:
+                async with self._cond:
+                    self._release(entry.user_id, running=True)
+                    self._cond.notify_all()
+
+
+class SingleFlight:
+    """
+    Выполняющиеся задачи по ключу. Пока задача с ключом не завершилась,
+    повтор не запускает вторую, а ждёт future первой.
+    """
+
+    def __init__(self):
+        self._flights: dict[Hashable, asyncio.Future] = {}
+
+    def __len__(self) -> int:
+        return len(self._flights)
+
+    def get(self, key: Hashable) -> asyncio.Future | None:
+        return self._flights.get(key)
+
+    def claim(self, key: Hashable) -> asyncio.Future:
+        """Занимает ключ; проверка get() и claim() — без await между ними."""
+        if key in self._flights:
+            raise KeyError(f"{key!r} is already in flight")
+        future = self._flights[key] = asyncio.get_running_loop().create_future()
+        return future
+
+    def release(self, key: Hashable, result: Any = None):
+        """Освобождает ключ и отдаёт результат всем ожидающим."""
+        future = self._flights.pop(key, None)
+        if future is not None and not future.done():
+            future.set_result(result)
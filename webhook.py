@@ -0,0 +1,189 @@
+"""
+Приём апдейтов SnapSell Bot через вебхук.
+Фронт-процесс поднимает встроенный HTTP-сервер, проверяет секретный токен
+(X-Telegram-Bot-Api-Secret-Token) и раскладывает апдейты по шардам
+по user_id: все апдейты одного пользователя попадают в один процесс, так
+что состояние в памяти (альбомы, склейка дублей фото) остаётся общим.
+Внутри шарда апдейты обрабатываются параллельно (concurrent_updates), и
+порядок их обработки для одного пользователя не гарантируется: например,
+successful_payment и следующее фото могут выполняться одновременно.
+Каждый шард — обычное Application без updater.
+
+При остановке вебхук не удаляется: пока сервис перезапускается,
+Telegram копит апдейты у себя и доставит их после старта.
+
+Запуск: python webhook.py [--shards N]
+"""
+
+import argparse
+import asyncio
+import hmac
+import json
+import logging
+import multiprocessing
+import secrets
+import signal
+from http import HTTPStatus
+
+from telegram import Bot, Update
+
+from config import config
+from httpserver import Request, Response, serve
+
+logger = logging.getLogger("webhook")
+
+WATCHDOG_INTERVAL = 5
+
+
+def shard_key(update: dict) -> int:
+    """user_id автора апдейта (или id чата); для прочих апдейтов — update_id."""
+    for value in update.values():
+        if not isinstance(value, dict):
+            continue
+        for field in ("from", "user", "chat"):
+            obj = value.get(field)
+            if isinstance(obj, dict) and "id" in obj:
+                return obj["id"]
+    return update.get("update_id", 0)
+
+
+# ── Шард ─────────────────────────────────────────────────
+
+async def shard_main(index: int, shards: int, queue):
+    if config.METRICS_PORT:
+        config.METRICS_PORT += index
+    import bot as snapsell
+
+    # Лимит на бота общий — каждому шарду своя доля
+    app = snapsell.build_application(updater=False, processes=shards)
+    await app.initialize()
+    await app.post_init(app)
+    await app.start()
+    logger.info(f"Shard {index} started")
+
+    loop = asyncio.get_running_loop()
+    try:
+        while True:
+            raw = await loop.run_in_executor(None, queue.get)
+            if raw is None:
+                break
+            try:
+                update = Update.de_json(json.loads(raw), app.bot)
+            except Exception as e:
+                logger.error(f"Shard {index}: bad update: {e}")
+                continue
+            await app.update_queue.put(update)
+    finally:
+        # stop() дожидается обработки уже поставленных в очередь апдейтов
+        await app.stop()
+        await app.post_shutdown(app)
+        await app.shutdown()
+        logger.info(f"Shard {index} stopped")
+
+
+def run_shard(index: int, shards: int, queue):
+    # Останавливает шарды фронт: сначала закрывает приём, потом дренирует очереди
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    asyncio.run(shard_main(index, shards, queue))
+
+
+# ── Фронт ────────────────────────────────────────────────
+
+class ShardPool:
+    def __init__(self, shards: int):
+        self.ctx = multiprocessing.get_context("spawn")
+        self.queues = [self.ctx.Queue() for _ in range(shards)]
+        self.procs = [self._spawn(i) for i in range(shards)]
+
+    def _spawn(self, index: int):
+        proc = self.ctx.Process(
+            target=run_shard, args=(index, len(self.queues), self.queues[index]), name=f"shard-{index}"
+        )
+        proc.start()
+        return proc
+
+    def dispatch(self, key: int, raw: bytes):
+        self.queues[key % len(self.queues)].put(raw)
+
+    def revive(self):
+        """Перезапуск упавших шардов; их очередь с непрочитанными апдейтами сохраняется."""
+        for i, proc in enumerate(self.procs):
+            if not proc.is_alive():
+                logger.error(f"Shard {i} exited with code {proc.exitcode}, restarting")
+                self.procs[i] = self._spawn(i)
+
+    def stop(self):
+        for queue in self.queues:
+            queue.put(None)
+        for proc in self.procs:
+            proc.join()
+
+
+async def front_main(shards: int):
+    secret = config.WEBHOOK_SECRET or secrets.token_urlsafe(32)
+    pool = ShardPool(shards)
+
+    async def handle(req: Request) -> Response:
+        if req.path != config.WEBHOOK_PATH:
+            return Response(HTTPStatus.NOT_FOUND)
+        if req.method != "POST":
+            return Response(HTTPStatus.METHOD_NOT_ALLOWED)
+        token = req.headers.get("x-telegram-bot-api-secret-token", "")
+        if not hmac.compare_digest(token.encode(), secret.encode()):
+            return Response(HTTPStatus.FORBIDDEN)
+        try:
+            update = json.loads(req.body)
+        except ValueError:
+            return Response(HTTPStatus.BAD_REQUEST)
+        if not isinstance(update, dict):
+            return Response(HTTPStatus.BAD_REQUEST)
+        pool.dispatch(shard_key(update), req.body)
+        return Response(HTTPStatus.OK)
+
+    server = await serve(handle, config.WEBHOOK_LISTEN, config.WEBHOOK_PORT)
+    logger.info(f"Webhook listening on {config.WEBHOOK_LISTEN}:{config.WEBHOOK_PORT}{config.WEBHOOK_PATH}, {shards} shards")
+
+    if config.WEBHOOK_URL:
+        async with Bot(config.BOT_TOKEN, base_url=config.TELEGRAM_BASE_URL,
+                       base_file_url=config.TELEGRAM_FILE_URL) as tg:
+            await tg.set_webhook(
+                url=config.WEBHOOK_URL,
+                secret_token=secret,
+                allowed_updates=Update.ALL_TYPES,
+                max_connections=config.WEBHOOK_MAX_CONNECTIONS,
+                drop_pending_updates=config.DROP_PENDING_UPDATES,
+            )
+        logger.info(f"Webhook set to {config.WEBHOOK_URL}")
+    else:
+        logger.warning("WEBHOOK_URL не задан — setWebhook пропущен, только локальный приём")
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+
+    try:
+        while not stop.is_set():
+            try:
+                await asyncio.wait_for(stop.wait(), timeout=WATCHDOG_INTERVAL)
+            except asyncio.TimeoutError:
+                pool.revive()
+    finally:
+        # Новые апдейты не принимаем (Telegram повторит их позже), принятые дорабатываем
+        server.close()
+        await loop.run_in_executor(None, pool.stop)
+        logger.info("Webhook stopped")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="SnapSell webhook server")
+    parser.add_argument("--shards", type=int, default=config.WEBHOOK_SHARDS)
+    args = parser.parse_args()
+    config.validate()
+    logging.basicConfig(format="%(asctime)s | %(levelname)s | %(name)s | %(message)s", level=logging.INFO)
+    asyncio.run(front_main(max(1, args.shards)))
+
+
+if __name__ == "__main__":
+    main()
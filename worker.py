@@ -0,0 +1,206 @@
+"""
+Воркеры генераций SnapSell Bot (режим JOB_QUEUE=1).
+Бот только ставит задачу в таблицу jobs, а процессы worker.py забирают её
+с арендой (lease) и heartbeat'ом, генерируют сцены и доставляют через Bot API.
+Упавший или перезапущенный воркер не теряет задачи: по истечении аренды
+их забирает другой процесс.
+
+Запуск: python worker.py [--processes N]
+"""
+
+import argparse
+import asyncio
+import logging
+import multiprocessing
+import os
+import signal
+import socket
+import time
+
+from telegram import Bot
+from telegram.ext import ExtBot
+from telegram.constants import ParseMode
+
+import bot as snapsell
+import metrics
+from config import config
+from db import Account, Reservation
+
+logger = logging.getLogger("worker")
+
+FAILED_TEXT = "❌ Не удалось выполнить генерацию. Генерация возвращена на баланс — попробуйте ещё раз."
+
+
+async def process_job(tg: Bot, row: dict) -> bool:
+    db = snapsell.db
+    job = snapsell.GenerationJob(
+        user_id=row["user_id"],
+        chat_id=row["chat_id"],
+        message_id=row["message_id"],
+        file_id=row["file_id"],
+        file_key=f"{snapsell.ANALYSIS_VERSION}:tg:{row['file_unique_id']}",
+        # Счётчики после списания — для подвала сообщения об успехе; списывал бот, кэш воркера устарел
+        reservation=Reservation(row["user_id"], row["charged"], await db.get_account(row["user_id"], cached=False)),
+        is_document=bool(row["is_document"]),
+        # Потеря аренды или остановка воркера — задачу повторит другой; вернёт reap()
+        refund_on_cancel=False,
+        durable=True,
+    )
+    job.product_info = await db.get_analysis(job.file_key, record_miss=False)
+    status = snapsell.StatusMessage(tg, row["chat_id"], row["status_message_id"])
+    try:
+        await status.edit_text(
+            snapsell.RENDERING if job.product_info else snapsell.ANALYZING, parse_mode=ParseMode.MARKDOWN
+        )
+    except Exception as e:
+        logger.warning(f"Job {row['id']}: status update failed: {e}")
+    return await snapsell.run_generation(tg, job, status)
+
+
+async def run_with_lease(tg: Bot, worker: str, row: dict):
+    """
+    Выполняет задачу, продлевая аренду; потеряв аренду — прекращает работу.
+    Генерация возвращается только при окончательном исходе: failed здесь или reap().
+    """
+    db = snapsell.db
+    job_task = asyncio.create_task(process_job(tg, row))
+    lost = False
+
+    async def heartbeat():
+        nonlocal lost
+        while True:
+            await asyncio.sleep(config.JOB_LEASE / 3)
+            if not await db.heartbeat_job(row["id"], worker, config.JOB_LEASE):
+                logger.warning(f"Job {row['id']}: lease lost, stopping")
+                lost = True
+                job_task.cancel()
+                return
+
+    hb = asyncio.create_task(heartbeat())
+    try:
+        # failed — run_generation уже вернул генерацию
+        delivered = await job_task
+        await db.finish_job(row["id"], worker, "done" if delivered else "failed")
+    except asyncio.CancelledError:
+        if not lost:
+            raise
+    except Exception as e:
+        # Упали до run_generation — списанное никто не вернул
+        logger.error(f"Job {row['id']} failed: {e}", exc_info=True)
+        await db.finish_job(row["id"], worker, "failed", error=str(e))
+        await db.refund_generation(Reservation(row["user_id"], row["charged"], Account(row["user_id"])))
+    finally:
+        hb.cancel()
+
+
+async def reap(tg: Bot):
+    """Задачи, исчерпавшие попытки, — возврат генерации и сообщение пользователю."""
+    db = snapsell.db
+    for row in await db.reap_jobs(config.JOB_MAX_ATTEMPTS):
+        logger.error(f"Job {row['id']} exhausted {row['attempts']} attempts")
+        await db.refund_generation(Reservation(row["user_id"], row["charged"], Account(row["user_id"])))
+        try:
+            await tg.edit_message_text(FAILED_TEXT, chat_id=row["chat_id"], message_id=row["status_message_id"])
+        except Exception as e:
+            logger.warning(f"Job {row['id']}: notify failed: {e}")
+
+
+async def worker_main(name: str, index: int = 0, processes: int = 1):
+    db = snapsell.db
+    # Лимит на бота общий — процессам worker.py доля TELEGRAM_WORKER_SHARE, каждому поровну
+    tg = ExtBot(
+        config.BOT_TOKEN, base_url=config.TELEGRAM_BASE_URL, base_file_url=config.TELEGRAM_FILE_URL,
+        rate_limiter=snapsell.make_rate_limiter(processes, worker=True),
+    )
+    await tg.initialize()
+    await snapsell.http.start()
+    metrics_server = None
+    if config.WORKER_METRICS_PORT:
+        metrics_server = await metrics.start_server(config.METRICS_LISTEN, config.WORKER_METRICS_PORT + index)
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+
+    slots = asyncio.Semaphore(config.WORKER_CONCURRENCY)
+    running: set[asyncio.Task] = set()
+    metrics.GaugeFunc("snapsell_worker_jobs_running", "Jobs running in this worker", lambda: {(): len(running)})
+    watcher = asyncio.create_task(snapsell.watch_jobs())
+    last_reap = 0.0
+    logger.info(f"Worker {name} started")
+    try:
+        while not stop.is_set():
+            if time.monotonic() - last_reap > config.JOB_LEASE:
+                last_reap = time.monotonic()
+                await reap(tg)
+
+            await slots.acquire()
+            row = await db.claim_job(name, config.JOB_LEASE, config.JOB_MAX_ATTEMPTS)
+            if row is None:
+                slots.release()
+                try:
+                    await asyncio.wait_for(stop.wait(), timeout=config.JOB_POLL_INTERVAL)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            logger.info(f"Worker {name} claimed job {row['id']} (attempt {row['attempts']})")
+            task = asyncio.create_task(run_with_lease(tg, name, row))
+            running.add(task)
+            task.add_done_callback(running.discard)
+            task.add_done_callback(lambda _: slots.release())
+
+        # Даём текущим задачам доработать; недоделанные заберёт другой воркер
+        if running:
+            logger.info(f"Worker {name} stopping, waiting for {len(running)} jobs")
+            _, unfinished = await asyncio.wait(running, timeout=config.JOB_LEASE)
+            for task in unfinished:
+                task.cancel()
+            await asyncio.gather(*unfinished, return_exceptions=True)
+    finally:
+        watcher.cancel()
+        if metrics_server:
+            metrics_server.close()
+        await snapsell.http.close()
+        await tg.shutdown()
+        db.close()
+
+
+def run_worker(index: int, processes: int = 1):
+    name = f"{socket.gethostname()}:{os.getpid()}:{index}"
+    asyncio.run(worker_main(name, index, processes))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="SnapSell generation workers")
+    parser.add_argument("--processes", type=int, default=config.WORKER_PROCESSES)
+    args = parser.parse_args()
+    config.validate()
+
+    if args.processes <= 1:
+        run_worker(0)
+        return
+
+    ctx = multiprocessing.get_context("spawn")
+    procs = [ctx.Process(target=run_worker, args=(i, args.processes), name=f"worker-{i}") for i in range(args.processes)]
+    for p in procs:
+        p.start()
+
+    def forward(signum, frame):
+        for p in procs:
+            if p.is_alive():
+                p.terminate()
+
+    signal.signal(signal.SIGTERM, forward)
+    try:
+        for p in procs:
+            p.join()
+    except KeyboardInterrupt:
+        # SIGINT уже получили все процессы группы
+        for p in procs:
+            p.join()
+
+
+if __name__ == "__main__":
+    main()